@@ -1,10 +1,22 @@
 import logging
 import os
-from google.cloud import bigquery
-from google.oauth2 import service_account
 from datetime import datetime
-import json
+import time
 import traceback
+from collections import Counter
+from functools import lru_cache, partial
+import staging_source
+from code_dictionary import CodeDomain, code_key
+from bq_session import get_session, session_for
+from etl_metrics import current_metrics
+from etl_run import run_curated
+from sharded_source import fetch_sharded_batches
+from warehouse_materializer import materialize_facts
+from fhir_fields import Derived, Field, Repeated, compile_columns, integer, interned, load_resource, text
+from load_manager import CompletedJob, LoadManager
+from parquet_sink import (
+    TABLE_SCHEMAS, ColumnBuffer, record_batch_to_json_rows, submit_record_batch_load, write_record_batch_local,
+)
 
 # --------------------
 # Configuration
@@ -16,50 +28,50 @@ ETL_CONFIG = {
     "BQ_DATASET_CURATED": "fhir_curated_sample",
     "BQ_TABLE_CURATED": "eob_items",
     "BATCH_SIZE": 5000,
-    #"KEY_PATH": os.environ.get("BQ_KEY_PATH", "/keys/bq_key.json")  # fallback if env var not set
+    "ADAPTIVE_BATCHES": True,  # resize batches from observed fan-out, starting at BATCH_SIZE (see adaptive_batcher.py)
+    # Resume from CHECKPOINT_PATH. The scan is sorted by (load_timestamp, id) in one query, so a first
+    # run (no checkpoint yet) over a large table can fail with "resources exceeded": run it with
+    # SHARDS > 1, so each shard sorts only its own rows.
+    "INCREMENTAL": True,
+    "CHECKPOINT_PATH": "etl_checkpoints.db",
+    "SINK": "parquet",  # "parquet" (load job), "json" (load_table_from_json) or "local" (Parquet files on disk)
+    "LOCAL_SINK_DIR": "curated_parquet",
+    "COALESCE_LOADS": True,  # buffer batches into fewer, larger load jobs (see load_manager.LOAD_CONFIG)
+    "SKIP_UNCHANGED": True,  # skip EOBs whose fingerprint matches the last loaded version (see fingerprints.py)
+    "FINGERPRINT_PATH": "etl_fingerprints.db",
+    "SHARDS": 1,  # > 1 reads the staging table as that many hash shards, concurrently (see sharded_source.py)
+    "CODE_DICTIONARY": True,  # record new codings and append them to the code dimension (see code_dictionary.py)
+    "PROFILE": True,  # plan workers/batches from a pushdown count and the last profile, and profile the run (see etl_profile.py)
+    "MATERIALIZE": True,  # after a run, rebuild the changed warehouse fact partitions (see warehouse_materializer.py)
     "KEY_PATH": "/keys/bq_key.json"
-
 }
 
 # --------------------
-# Setup BigQuery client
+# BigQuery session (client and credentials are created on first use)
 # --------------------
-credentials = service_account.Credentials.from_service_account_file(ETL_CONFIG["KEY_PATH"])
-bq_client = bigquery.Client(credentials=credentials, project=ETL_CONFIG["BQ_PROJECT"])
-# List tables in fhir_staging
-tables = list(bq_client.list_tables("fhir_staging"))
-for t in tables:
-    print(t.table_id)
+bq_session = get_session(ETL_CONFIG["BQ_PROJECT"], ETL_CONFIG["KEY_PATH"])
 
 # --------------------
 # Fetch batches from staging
 # --------------------
-def fetch_staging_batches(batch_size=5000):
-    query = f"""
-        SELECT explanationofbenefit_id AS eob_id, resource, load_timestamp
-        FROM `{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_RAW']}.{ETL_CONFIG['BQ_TABLE_RAW']}`
-    """
-    query_job = bq_client.query(query)
-    iterator = query_job.result(page_size=batch_size)
-
-    batch = []
-    for row in iterator:
-        batch.append({
-            "eob_id": row["eob_id"],
-            "resource": row["resource"]
-        })
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
-
-    if batch:
-        yield batch
+# Top-level resource keys transform_batch reads; the staging scan projects only these
+RESOURCE_PATHS = ["item"]
+
+def fetch_staging_batches(batch_size=5000, client=None, since=None, ordered=False, paths=RESOURCE_PATHS, shards=1,
+                          batcher=None):
+    client = client or bq_session.client
+    table_id = staging_source.staging_table_id(ETL_CONFIG)
+    if shards > 1:
+        return fetch_sharded_batches(
+            client, table_id, batch_size, shards, since=since, ordered=ordered, paths=paths, batcher=batcher
+        )
+    return staging_source.fetch_staging_batches(
+        client, table_id, batch_size, since=since, ordered=ordered, paths=paths, batcher=batcher
+    )
 
 # --------------------
 # Transform function
 # --------------------
-from datetime import datetime, timezone
-
 def parse_fhir_datetime(dt_str):
     """Parse FHIR datetime string to Python datetime object, safely."""
     if not dt_str:
@@ -69,243 +81,170 @@ def parse_fhir_datetime(dt_str):
     except Exception:
         return None
 
-def safe_bq_timestamp(dt_obj):
-    """Convert datetime to ISO string suitable for BigQuery, or None."""
-    return dt_obj.isoformat() if dt_obj else None
-def parse_fhir_datetime(dt_str):
-    """Parse FHIR datetime string to Python datetime object, safely."""
-    if not dt_str:
-        return None
-    try:
-        return datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
-    except Exception:
-        return None
+@lru_cache(maxsize=65536)
+def fhir_datetime(dt_str):
+    """``parse_fhir_datetime``, cached: the same service periods repeat across items."""
+    return parse_fhir_datetime(dt_str)
+
+# Declarative spec for one curated eob_items row, compiled once at import.
+# Paths tolerate the dict-vs-list shapes Synthea emits (see fhir_fields).
+# Code/system/display strings repeat across items, so they are interned. Converters also coerce
+# or reject values of the wrong type (e.g. "sequence": "1"), so a bad item is dropped on its own.
+# *_key columns are stable surrogate keys into the code dimension (code_dictionary.code_key).
+ITEM_FIELDS = {
+    "sequence": Field("sequence", integer),
+    "diagnosis_sequence": Field("diagnosisSequence[0]", integer),
+    "category_system": Field("category.coding[0].system", interned),
+    "category_code": Field("category.coding[0].code", interned),
+    "category_display": Field("category.coding[0].display", interned),
+    "product_system": Field("productOrService.coding[0].system", interned),
+    "product_code": Field("productOrService.coding[0].code", interned),
+    "product_display": Field("productOrService.coding[0].display", interned),
+    "product_text": Field("productOrService.text", interned),
+    "service_start": Field("servicedPeriod.start", fhir_datetime),
+    "service_end": Field("servicedPeriod.end", fhir_datetime),
+    "location_system": Field(("location.coding[0].system", "locationCodeableConcept.coding[0].system"), interned),
+    "location_code": Field(("location.coding[0].code", "locationCodeableConcept.coding[0].code"), interned),
+    "location_display": Field(("location.coding[0].display", "locationCodeableConcept.coding[0].display"), interned),
+    "encounter": Field("encounter.reference", text),
+    "quantity": Field("quantity.value", float),
+    "unit_price": Field(("unitPrice.value", "quantity.unitPrice"), float),
+    # Net amount, falling back to the first total
+    "net_value": Field(("net.value", "total[0].amount.value"), float),
+    "net_currency": Field(("net.currency", "total[0].amount.currency"), interned),
+    "adjudication": Repeated("adjudication", {
+        "code": Field("category.coding[0].code", interned),
+        "display": Field("category.coding[0].display", interned),
+        "value": Field("amount.value", float),
+        "currency": Field("amount.currency", interned),
+        "system": Field("category.coding[0].system", interned),
+        "code_key": Derived(("category.coding[0].system", "category.coding[0].code"), code_key),
+    }),
+    "amount": Repeated("amount", {
+        "value": Field("value", float),
+        "currency": Field("currency", interned),
+    }),
+    "category_key": Derived(("category.coding[0].system", "category.coding[0].code"), code_key),
+    "product_key": Derived(("productOrService.coding[0].system", "productOrService.coding[0].code"), code_key),
+    "location_key": Derived((
+        ("location.coding[0].system", "locationCodeableConcept.coding[0].system"),
+        ("location.coding[0].code", "locationCodeableConcept.coding[0].code"),
+    ), code_key),
+}
+extract_item = compile_columns(ITEM_FIELDS)
+
+# Code dimension domains found in the eob_items record batches
+ITEM_CODE_DOMAINS = {
+    "item_category": CodeDomain("category_key", "category_system", "category_code", "category_display"),
+    "item_product": CodeDomain("product_key", "product_system", "product_code", "product_display"),
+    "item_location": CodeDomain("location_key", "location_system", "location_code", "location_display"),
+    "adjudication_category": CodeDomain("code_key", "system", "code", "display", within="adjudication"),
+}
 
-def safe_bq_timestamp(dt_obj):
-    """Convert datetime to ISO string suitable for BigQuery, or None."""
-    return dt_obj.isoformat() if dt_obj else None
+class ItemColumns(ColumnBuffer):
+    """Column lists for a batch of curated eob_items rows."""
+
+    def __init__(self, load_timestamp=None):
+        super().__init__(TABLE_SCHEMAS["eob_items"], load_timestamp)
+        self.item_appenders = self.appenders(ITEM_FIELDS)
+        self.append_eob_id = self.columns["eob_id"].append
+
+def transform_resource(eob_id, resource, columns):
+    """Append the curated eob_items rows of one parsed ExplanationOfBenefit to ``columns``; return how many."""
+    appended = 0
+    items = resource.get("item")
+    if not isinstance(items, list):
+        items = [items] if isinstance(items, dict) else []
+    for item in items:
+        try:
+            extract_item(item, columns.item_appenders)
+        except Exception as e:
+            logging.error(f"Failed to transform record {eob_id}: {type(e).__name__} - {e}")
+            logging.error(traceback.format_exc())
+            continue
+        columns.append_eob_id(eob_id)
+        appended += 1
+    return appended
 
-'''def transform_eob_items_bq(batch):
-    records = []
-    for row in batch:
-        rid, resource = row[1], row[2]'''
 def transform_batch(batch):
-    curated_records = []
+    """Arrow record batch of curated eob_items rows for a batch of staging rows."""
+    columns = ItemColumns()
+    fanout = Counter()  # items per EOB
+    parse_seconds = 0.0
     for row in batch:
-        #rid, resource = row[1], row[2]
-        resource = row["resource"]
-        eob_id = row["eob_id"]
-
-        #eob_id = resource.get("id")
-        #eob_id = eob_id
-        #resource = record["resource"]
-        resource = json.loads(resource) if isinstance(resource, str) else resource
-        #eob_id = row["eob_id"]
-        items = resource.get("item",[])
-        #print(f"items:  {items}")
-        for item in items:
-            try:
-                # Sequence
-                seq = item.get("sequence")
-                if isinstance(seq, list):
-                    sequence = seq[0] if seq else None
-                else:
-                    sequence = seq
-
-                # Category
-                category = item.get("category")
-                cat_coding = {}
-
-                if isinstance(category, dict):
-                    cat_coding = category.get("coding", [{}])[0]
-                elif isinstance(category, list) and len(category) > 0:
-                    cat_coding = category[0].get("coding", [{}])[0]
-
-                category_system = cat_coding.get("system")
-                category_code = cat_coding.get("code")
-                category_display = cat_coding.get("display")
-
-                # Product / Service
-                product = item.get("productOrService", {})
-                prod_coding = product.get("coding", [{}])[0] if product else {}
-                product_system = prod_coding.get("system")
-                product_code = prod_coding.get("code")
-                product_display = prod_coding.get("display")
-                product_text = product.get("text")
+        start = time.perf_counter()
+        resource = load_resource(row["resource"])
+        parse_seconds += time.perf_counter() - start
+        if isinstance(resource, dict):
+            fanout[transform_resource(row["eob_id"], resource, columns)] += 1
 
-                # Service period
-                serviced = item.get("servicedPeriod", {})
-                service_start = safe_bq_timestamp(parse_fhir_datetime(serviced.get("start")))
-                service_end = safe_bq_timestamp(parse_fhir_datetime(serviced.get("end")))
-
-                # --------------------
-                # Location
-                # --------------------
-                # Check multiple possible keys: 'location', 'locationCodeableConcept'
-                location_field = item.get("location") or item.get("locationCodeableConcept", {})
-                if isinstance(location_field, list):
-                    loc_obj = location_field[0] if location_field else {}
-                elif isinstance(location_field, dict):
-                    loc_obj = location_field
-                else:
-                    loc_obj = {}
-
-                # extract coding
-                loc_coding_list = loc_obj.get("coding", [{}])
-                loc_coding = loc_coding_list[0] if loc_coding_list else {}
-
-                location_system = loc_coding.get("system")
-                location_code = loc_coding.get("code")
-                location_display = loc_coding.get("display")
-
-                # --------------------
-                    # Encounter
-                # --------------------
-                encounter_field = item.get("encounter", [])
-                if isinstance(encounter_field, list):
-                    # array of objects with 'reference'
-                    encounter_refs = [e.get("reference") for e in encounter_field if e.get("reference")]
-                    encounter = encounter_refs[0] if encounter_refs else None
-                elif isinstance(encounter_field, dict):
-                    # single dict
-                    encounter = encounter_field.get("reference")
-                else:
-                    encounter = None
-
-                # Quantity / price / net
-                quantity = float(item.get("quantity", {}).get("value", 0)) if "quantity" in item else None
-                unit_price = float(item.get("quantity", {}).get("unitPrice", 0)) if "quantity" in item else None
-                #quantity = float(item.get("quantity", {}).get("value", 0)) if "quantity" in resource else None
-                #unit_price = float(item.get("quantity", {}).get("unitPrice", 0)) if "quantity" in resource else None
-
-                # Net / total amounts
-                net_value = None
-                net_currency = None
-                if "net" in item:
-                    net_value = float(item["net"].get("value", 0)) if item["net"].get("value") else None
-                    net_currency = item["net"].get("currency")
-                else:
-                    totals = item.get("total", [])
-                if totals:
-                    net_value = float(totals[0].get("amount", {}).get("value", 0)) if totals[0].get("amount") else None
-                    net_currency = totals[0].get("amount", {}).get("currency") if totals[0].get("amount") else None
-
-                '''net_value = None
-                net_currency = None
-                if "net" in resource:
-                    net_value = float(item["net"].get("value", 0)) if item["net"].get("value") else None
-                    net_currency =item["net"].get("currency")
-                else:
-                    # fallback to total field
-                    totals = item.get("total", [])
-                if totals:
-                    net_value = float(totals[0].get("amount", {}).get("value", 0)) if totals[0].get("amount") else None
-                    net_currency = totals[0].get("amount", {}).get("currency") if totals[0].get("amount") else None'''
-
-                # Diagnosis sequence
-                #diagnosis_sequence = item.get("diagnosisSequence", [])
-
-                #diagnosis_sequences = item.get("diagnosisSequence", [])
-                #diagnosis_sequence = diagnosis_sequences[0] if diagnosis_sequences else None
-                diagnosis_sequences = item.get("diagnosisSequence", [])
-                # Ensure it’s always a list for BigQuery
-                diagnosis_sequence = diagnosis_sequences[0] if diagnosis_sequences else None
-
-
-                # Adjudication
-                adjudication_list = []
-                for adj in item.get("adjudication", []):
-                    adj_cat = adj.get("category", {}).get("coding", [{}])[0]
-                    adjudication_list.append({
-                        "code": adj_cat.get("code"),
-                        "display": adj_cat.get("display"),
-                        "value": float(adj.get("amount", {}).get("value", 0)) if adj.get("amount") else None,
-                        "currency": adj.get("amount", {}).get("currency") if adj.get("amount") else None
-                    })
-
-                # Amount (optional per-item amounts)
-                amount_list = []
-                for amt in item.get("amount", []):
-                    amount_list.append({
-                        "value": float(amt.get("value", 0)) if amt.get("value") else None,
-                        "currency": amt.get("currency")
-                    })
-
-                # Build curated record
-                curated_records.append({
-                    "eob_id": eob_id,
-                    "sequence": sequence,
-                    "diagnosis_sequence": diagnosis_sequence,
-                    "category_system": category_system,
-                    "category_code": category_code,
-                    "category_display": category_display,
-                    "product_system": product_system,
-                    "product_code": product_code,
-                    "product_display": product_display,
-                    "product_text": product_text,
-                    "service_start": service_start,
-                    "service_end": service_end,
-                    "location_system": location_system,
-                    "location_code": location_code,
-                    "location_display": location_display,
-                    "encounter": encounter,
-                    "quantity": quantity,
-                    "unit_price": unit_price,
-                    "net_value": net_value,
-                    "net_currency": net_currency,
-                    "adjudication": adjudication_list,
-                    "amount": amount_list,
-                    "load_timestamp": datetime.utcnow().isoformat()
-                })
-
-            except Exception as e:
-                #logging.error(f"Failed to transform record {eob_id}: {e}")
-                logging.error(f"Failed to transform record {eob_id}: {type(e).__name__} - {e}")
-                logging.error(traceback.format_exc())
-
-    logging.info(f"Transformed {len(curated_records)} records in this batch")
-    return curated_records
+    current_metrics().observe("parse", parse_seconds)
+    current_metrics().count_values("items_per_eob", fanout)
+    logging.info(f"Transformed {columns.rows} records in this batch")
+    return columns.to_record_batch()
 
 # --------------------
 # Load batch into curated table
 # --------------------
-def load_batch_to_bq(batch):
-    table_id = f"{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_CURATED']}.{ETL_CONFIG['BQ_TABLE_CURATED']}"
-    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
-    job = bq_client.load_table_from_json(batch, table_id, job_config=job_config)
-    job.result()
-    logging.info(f"Loaded {len(batch)} records into {table_id}")
+def submit_load_job(batch, job_id=None, client=None):
+    """Start appending ``batch`` (a record batch from transform_batch) with the configured sink; returns the job."""
+    table = ETL_CONFIG["BQ_TABLE_CURATED"]
+    if ETL_CONFIG["SINK"] == "local":
+        write_record_batch_local(batch, ETL_CONFIG["LOCAL_SINK_DIR"], table)
+        return CompletedJob()
+
+    session = bq_session if client is None else session_for(client)
+    table_id = f"{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_CURATED']}.{table}"
+    if ETL_CONFIG["SINK"] == "parquet":
+        return submit_record_batch_load(session.client, batch, table_id, job_id=job_id)
+
+    from google.cloud import bigquery
+
+    # Reuse the target's cached schema so the load job does not autodetect types on every batch;
+    # columns the table does not have yet (e.g. code keys) are dropped until it is migrated
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_APPEND", schema=session.table_schema(table_id), ignore_unknown_values=True,
+    )
+    rows = record_batch_to_json_rows(batch)
+    return session.client.load_table_from_json(rows, table_id, job_config=job_config, job_id=job_id)
+
+def load_batch_to_bq(batch, client=None):
+    submit_load_job(batch, client=client).result()
+    logging.info(f"Loaded {len(batch)} records into {ETL_CONFIG['BQ_TABLE_CURATED']}")
+
+def make_load_manager(client=None):
+    """A LoadManager coalescing transformed batches into fewer load jobs on the curated table."""
+    client = client or bq_session.client
+    return LoadManager(
+        partial(submit_load_job, client=client),
+        name=ETL_CONFIG["BQ_TABLE_CURATED"],
+        lookup_job=getattr(client, "get_job", None),
+    )
 
 # --------------------
 # Run pipeline
 # --------------------
-def run_pipeline():
-    for batch_num, batch in enumerate(fetch_staging_batches(ETL_CONFIG["BATCH_SIZE"]), start=1):
-        transformed = transform_batch(batch)
-        load_batch_to_bq(transformed)
-        logging.info(f"Batch {batch_num} processed successfully")
+def run_pipeline(client=None, incremental=None, checkpoints=None, **pipeline_options):
+    """Fetch, transform and load overlapped; see etl_run.run_curated and etl_pipeline.run_pipelined.
+
+    In incremental mode only staging rows past the stored load_timestamp watermark are read,
+    and the watermark advances as each batch commits. With SKIP_UNCHANGED, EOBs whose projected
+    resource is unchanged since they last loaded are dropped before the transform. With
+    ADAPTIVE_BATCHES, batch sizes follow the item rows each EOB turns into. With CODE_DICTIONARY,
+    codings not seen by earlier runs are appended to the code dimension after the load. With
+    PROFILE, the run is sized from a server-side row count and the last run's profile, and
+    profiled as it goes.
+    """
+    client = client or bq_session.client
+    return run_curated(
+        ETL_CONFIG, ETL_CONFIG["BQ_TABLE_CURATED"], partial(load_batch_to_bq, client=client), transform_batch,
+        client=client, incremental=incremental, checkpoints=checkpoints, paths=RESOURCE_PATHS,
+        make_load_manager=make_load_manager, code_domains=ITEM_CODE_DOMAINS, fanout="items_per_eob",
+        **pipeline_options,
+    )
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     run_pipeline()
-'''if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-
-    # Fetch only the first batch of 5–10 records
-    test_batches = fetch_staging_batches(batch_size=5)
-    test_batch = next(test_batches, [])
-
-    if not test_batch:
-        print("No records found in staging.")
-    else:
-        print(f"Fetched {len(test_batch)} records for testing.")
-
-        # Transform
-        transformed = transform_batch(test_batch)
-        print(f"Transformed {len(transformed)} records.")
-        print("Sample transformed record:")
-        print(transformed[0])
-
-        # Optionally load to BQ
-        load_batch_to_bq(transformed)
-        print("Test batch loaded successfully.")'''
+    if ETL_CONFIG["MATERIALIZE"] and ETL_CONFIG["SINK"] != "local":
+        materialize_facts()
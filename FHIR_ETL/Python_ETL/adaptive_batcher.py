@@ -0,0 +1,181 @@
+"""Source batch sizing from measured transform output.
+
+A fixed source batch size (N staging resources) gives very uneven work: one
+EOB may fan out into a single item row or into dozens with nested
+adjudication arrays. ``AdaptiveBatcher`` learns, from each transformed
+batch, how much output a byte of source resource turns into:
+
+* output rows per source byte,
+* estimated serialized output bytes per source byte,
+
+and cuts source batches by their resource bytes so that each batch's output
+lands near ``TARGET_ROWS`` rows and ``TARGET_BYTES`` bytes, and so that the
+batches the pipeline can hold at once (``inflight``) stay within
+``MEMORY_BUDGET``. Because the limit is in source bytes, a run of large
+resources shortens the batch being cut right away, even though the fetch
+stage reads several batches ahead of the transform feedback. Limits move by
+at most a factor of ``MAX_STEP`` per batch, and a batch has between
+``MIN_BATCH`` and ``MAX_BATCH`` rows. When resources are not measurable
+(already-parsed dicts) the same targets are applied per source row instead.
+
+A batcher can be ``seed``-ed with the ratios of an earlier run (see
+``etl_profile``) instead of learning them from scratch.
+
+Sources call ``batcher.full(rows, nbytes)`` as they add rows to a batch;
+``pipeline_batcher`` hooks ``observe`` into ``run_pipelined`` as its
+``on_transformed`` callback.
+"""
+import threading
+
+from etl_pipeline import PIPELINE_CONFIG
+from load_manager import estimate_json_bytes
+
+ADAPTIVE_CONFIG = {
+    "TARGET_ROWS": 50000,            # output rows per batch
+    "TARGET_BYTES": 32 * 2**20,      # estimated serialized output bytes per batch
+    "MEMORY_BUDGET": 512 * 2**20,    # source + output bytes across all batches in flight
+    "MIN_BATCH": 100,
+    "MAX_BATCH": 50000,
+    "SMOOTHING": 0.3,                # weight of the newest observation in the running averages
+    "MAX_STEP": 2.0,                 # largest factor a limit may change by at once
+}
+
+
+def output_size(result):
+    """``(rows, bytes)`` of a transform result: a list of row dicts, an Arrow batch/table, or a dict of lists."""
+    if hasattr(result, "num_rows") and hasattr(result, "nbytes"):
+        return result.num_rows, result.nbytes
+    if isinstance(result, dict):
+        sizes = [output_size(rows) for rows in result.values()]
+        return sum(r for r, _ in sizes), sum(b for _, b in sizes)
+    return len(result), estimate_json_bytes(result)
+
+
+def source_size(batch):
+    """Resource bytes of a source batch: ``row["resource"]`` dicts or ``(id, resource_id, resource)`` tuples."""
+    total = 0
+    for row in batch:
+        resource = row["resource"] if isinstance(row, dict) else row[-1]
+        if isinstance(resource, (str, bytes)):
+            total += len(resource)
+    return total
+
+
+class AdaptiveBatcher:
+    def __init__(self, initial=None, inflight=1, target_rows=None, target_bytes=None, memory_budget=None,
+                 min_batch=None, max_batch=None, smoothing=None, max_step=None,
+                 measure=output_size, measure_source=source_size):
+        self.target_rows = ADAPTIVE_CONFIG["TARGET_ROWS"] if target_rows is None else target_rows
+        self.target_bytes = ADAPTIVE_CONFIG["TARGET_BYTES"] if target_bytes is None else target_bytes
+        self.memory_budget = ADAPTIVE_CONFIG["MEMORY_BUDGET"] if memory_budget is None else memory_budget
+        self.min_batch = ADAPTIVE_CONFIG["MIN_BATCH"] if min_batch is None else min_batch
+        self.max_batch = ADAPTIVE_CONFIG["MAX_BATCH"] if max_batch is None else max_batch
+        self.smoothing = ADAPTIVE_CONFIG["SMOOTHING"] if smoothing is None else smoothing
+        self.max_step = ADAPTIVE_CONFIG["MAX_STEP"] if max_step is None else max_step
+        self.inflight = max(1, inflight)
+        self.measure = measure
+        self.measure_source = measure_source
+
+        self._lock = threading.Lock()
+        self.batch_size = self._clamp(initial or self.min_batch)  # row limit
+        self.batch_bytes = None       # source byte limit, once output per source byte is known
+        self.rows_per_byte = None     # output rows per source byte
+        self.bytes_per_byte = None    # output bytes per source byte
+        self.rows_per_row = None      # output rows per source row, for unmeasurable sources
+        self.bytes_per_row = None     # output bytes per source row, for unmeasurable sources
+        self.history = []             # (source rows, source bytes, output rows, output bytes) per batch
+
+    def _clamp(self, size):
+        return int(max(self.min_batch, min(self.max_batch, size)))
+
+    def _average(self, current, sample):
+        return sample if current is None else current + self.smoothing * (sample - current)
+
+    def _step(self, current, wanted):
+        return wanted if current is None else max(current / self.max_step, min(current * self.max_step, wanted))
+
+    def seed(self, rows_per_byte, bytes_per_byte):
+        """Start from output per source byte known in advance (e.g. the last run's profile)."""
+        with self._lock:
+            self.rows_per_byte = rows_per_byte
+            self.bytes_per_byte = bytes_per_byte
+            self.batch_bytes = self._limit(rows_per_byte, bytes_per_byte, 1)
+            self.batch_size = self.max_batch
+
+    def full(self, rows, nbytes):
+        """True once a batch of ``rows`` source rows and ``nbytes`` resource bytes should be cut."""
+        if rows >= self.batch_size:
+            return True
+        limit = self.batch_bytes
+        return limit is not None and rows >= self.min_batch and nbytes >= limit
+
+    # --------------------
+    # Feedback
+    # --------------------
+    def observe(self, batch, result):
+        """Record a transformed source ``batch`` and its ``result``, and move the limits."""
+        if not batch:
+            return
+        source_rows, source_bytes = len(batch), self.measure_source(batch)
+        out_rows, out_bytes = self.measure(result)
+        with self._lock:
+            self.history.append((source_rows, source_bytes, out_rows, out_bytes))
+            if source_bytes:
+                self.rows_per_byte = self._average(self.rows_per_byte, out_rows / source_bytes)
+                self.bytes_per_byte = self._average(self.bytes_per_byte, out_bytes / source_bytes)
+                self.batch_bytes = self._step(self.batch_bytes, self._limit(self.rows_per_byte, self.bytes_per_byte, 1))
+                self.batch_size = self.max_batch
+            else:
+                self.rows_per_row = self._average(self.rows_per_row, out_rows / source_rows)
+                self.bytes_per_row = self._average(self.bytes_per_row, out_bytes / source_rows)
+                self.batch_size = self._clamp(self._step(
+                    self.batch_size, self._limit(self.rows_per_row, self.bytes_per_row, 0)
+                ))
+
+    def _limit(self, rows_per_unit, bytes_per_unit, source_bytes_per_unit):
+        """Source units (bytes or rows) per batch that meet every target."""
+        limits = [self.target_rows / max(rows_per_unit, 1e-9)]
+        if bytes_per_unit:
+            limits.append(self.target_bytes / bytes_per_unit)
+        if bytes_per_unit + source_bytes_per_unit:
+            limits.append(self.memory_budget / self.inflight / (bytes_per_unit + source_bytes_per_unit))
+        return min(limits)
+
+    def stats(self):
+        """Summary of the observed batches, for logs and run reports."""
+        with self._lock:
+            outputs = [rows for _, _, rows, _ in self.history]
+            return {
+                "batches": len(self.history),
+                "batch_size": self.batch_size,
+                "batch_bytes": int(self.batch_bytes) if self.batch_bytes is not None else None,
+                "output_rows_min": min(outputs, default=0),
+                "output_rows_max": max(outputs, default=0),
+            }
+
+
+def pipeline_batcher(pipeline_options, initial=None, **batcher_options):
+    """An ``AdaptiveBatcher`` wired into ``run_pipelined``'s ``pipeline_options`` (``on_transformed``).
+
+    ``inflight`` defaults to the batches ``run_pipelined`` can hold at once with these options.
+    An ``on_transformed`` already in the options is still called.
+    """
+    if "inflight" not in batcher_options:
+        batcher_options["inflight"] = sum(
+            PIPELINE_CONFIG[key] if pipeline_options.get(option) is None else pipeline_options[option]
+            for option, key in (
+                ("prefetch", "PREFETCH_BATCHES"),
+                ("workers", "TRANSFORM_WORKERS"),
+                ("max_inflight_loads", "MAX_INFLIGHT_LOADS"),
+            )
+        )
+    batcher = AdaptiveBatcher(initial, **batcher_options)
+    previous = pipeline_options.get("on_transformed")
+
+    def on_transformed(batch, result):
+        batcher.observe(batch, result)
+        if previous is not None:
+            previous(batch, result)
+
+    pipeline_options["on_transformed"] = on_transformed
+    return batcher
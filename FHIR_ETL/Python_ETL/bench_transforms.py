@@ -0,0 +1,191 @@
+"""Reproducible benchmark for the curated EOB transforms.
+
+Runs ``EOBS_etl.transform_batch``, the coverage ``transform_batch`` and the
+run planning that replaced the ``estimate_coverage_count`` pre-pass (a
+pushdown ``count_staging_rows`` on a ``local_bq`` staging table plus
+``etl_profile.plan_run``) over seeded synthetic EOBs (see
+``synthetic_eob.py``) at several sizes and writes one JSON results file, so
+runs can be diffed between commits without touching BigQuery.
+
+Every (case, size) runs in a fresh spawned process so peak RSS belongs to
+that case alone. Throughput is the best of ``--repeat`` timed runs;
+allocations come from a separate ``tracemalloc`` run (it slows the
+interpreter, so it is never timed).
+
+    python bench_transforms.py --sizes 1000,10000 --out bench_results.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from synthetic_eob import generate_rows
+
+BENCH_CONFIG = {
+    "SIZES": [1000, 5000, 20000],
+    "REPEAT": 3,
+    "SEED": 42,
+    "ITEMS_PER_EOB": (1, 12),
+    "COVERAGE_PER_EOB": (1, 2),
+    "SHAPE": "mixed",
+    "MALFORMED_RATE": 0.01,
+    "OUTPUT": "bench_results.json",
+}
+
+CASES = ["items_transform_batch", "coverage_transform_batch", "plan_run"]
+
+
+# --------------------
+# Cases
+# --------------------
+def _case_callable(case):
+    """Return ``(prepare, run)``: ``prepare`` shapes the staging rows, ``run`` returns output row count."""
+    if case == "items_transform_batch":
+        from EOBS_etl import transform_batch
+        return (lambda rows: rows), (lambda batch: len(transform_batch(batch)))
+    if case == "coverage_transform_batch":
+        from etl_eob_items_coverage import transform_batch
+        return (lambda rows: rows), (lambda batch: len(transform_batch(batch)))
+    if case == "plan_run":
+        from etl_profile import plan_run
+        from local_bq import LocalBigQueryClient
+        from staging_source import count_staging_rows
+
+        table_id = "bench.fhir_staging.explanationofbenefits"
+
+        def stage(rows):
+            client = LocalBigQueryClient()
+            client.insert_rows(table_id, [
+                {"explanationofbenefit_id": r["eob_id"], "resource": r["resource"], "load_timestamp": r["load_timestamp"]}
+                for r in rows
+            ])
+            return client
+
+        # Counted server-side; the row count stands in for output rows
+        return stage, (lambda client: plan_run(count_staging_rows(client, table_id))["eobs"])
+    raise ValueError(f"Unknown case: {case}")
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(case, size, options):
+    """Measure one case at one size; meant to run in its own process."""
+    logging.disable(logging.CRITICAL)
+    prepare, run = _case_callable(case)
+    rows = generate_rows(
+        size,
+        seed=options["SEED"],
+        items_per_eob=options["ITEMS_PER_EOB"],
+        coverage_per_eob=options["COVERAGE_PER_EOB"],
+        shape=options["SHAPE"],
+        malformed_rate=options["MALFORMED_RATE"],
+    )
+    batch = prepare(rows)
+    input_bytes = sum(len(r["resource"]) for r in rows)
+    rss_before = _peak_rss_bytes()
+
+    timings = []
+    rows_out = 0
+    for _ in range(options["REPEAT"]):
+        start = time.perf_counter()
+        rows_out = run(batch)
+        timings.append(time.perf_counter() - start)
+    rss_peak = _peak_rss_bytes()
+
+    tracemalloc.start()
+    run(batch)
+    alloc_current, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        "case": case,
+        "size": size,
+        "input_bytes": input_bytes,
+        "rows_out": rows_out,
+        "seconds_best": round(best, 6),
+        "seconds_all": [round(t, 6) for t in timings],
+        "resources_per_s": round(size / best, 1) if best else None,
+        "rows_per_s": round(rows_out / best, 1) if best else None,
+        "peak_rss_bytes": rss_peak,
+        "peak_rss_delta_bytes": rss_peak - rss_before,
+        "alloc_peak_bytes": alloc_peak,
+        "alloc_retained_bytes": alloc_current,
+    }
+
+
+# --------------------
+# Driver
+# --------------------
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(cases=CASES, sizes=None, **overrides):
+    options = {**BENCH_CONFIG, **overrides}
+    sizes = sizes or options["SIZES"]
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size in sizes:
+        for case in cases:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_case, (case, size, options))
+            logging.info(
+                f"{case} size={size}: {result['resources_per_s']} resources/s, "
+                f"{result['rows_per_s']} rows/s, peak RSS {result['peak_rss_bytes'] / 2**20:.1f} MiB"
+            )
+            results.append(result)
+
+    return {
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {k: v for k, v in options.items() if k not in ("SIZES", "OUTPUT")},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default=",".join(map(str, BENCH_CONFIG["SIZES"])))
+    parser.add_argument("--cases", default=",".join(CASES))
+    parser.add_argument("--repeat", type=int, default=BENCH_CONFIG["REPEAT"])
+    parser.add_argument("--seed", type=int, default=BENCH_CONFIG["SEED"])
+    parser.add_argument("--shape", choices=["dict", "list", "mixed"], default=BENCH_CONFIG["SHAPE"])
+    parser.add_argument("--malformed-rate", type=float, default=BENCH_CONFIG["MALFORMED_RATE"])
+    parser.add_argument("--out", default=BENCH_CONFIG["OUTPUT"])
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(
+        cases=args.cases.split(","),
+        sizes=[int(s) for s in args.sizes.split(",")],
+        REPEAT=args.repeat,
+        SEED=args.seed,
+        SHAPE=args.shape,
+        MALFORMED_RATE=args.malformed_rate,
+    )
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Wrote {len(report['results'])} results to {args.out}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    main()
@@ -0,0 +1,136 @@
+"""Lazy, shared BigQuery clients with cached dataset/table metadata.
+
+Importing an ETL module does no I/O: the ``google`` libraries are imported,
+credentials are read and the client is built on first use of
+``BigQuerySession.client``, and then reused by every pipeline in the
+process. Table lists and table metadata (schemas) are fetched once and
+kept for ``METADATA_TTL`` seconds instead of being requested per batch.
+"""
+import logging
+import os
+import threading
+import time
+import weakref
+
+SESSION_CONFIG = {
+    "METADATA_TTL": 600,  # seconds table lists / table metadata are reused before refetching
+}
+
+
+def _is_not_found(error):
+    # google.api_core.exceptions.NotFound (and the local stand-in's equivalent) carry code 404
+    return getattr(error, "code", None) == 404
+
+
+class BigQuerySession:
+    """One BigQuery client plus a metadata cache.
+
+    ``key_path`` is a service account key file; when it is None or missing, the client falls back to
+    application default credentials. An existing ``client`` can be wrapped instead.
+    """
+
+    def __init__(self, project=None, key_path=None, client=None, metadata_ttl=None):
+        self.project = project
+        self.key_path = key_path
+        self.metadata_ttl = SESSION_CONFIG["METADATA_TTL"] if metadata_ttl is None else metadata_ttl
+        self._client = client
+        self._owns_client = client is None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._tables = {}    # dataset -> (fetched_at, [table_id, ...])
+        self._metadata = {}  # table_id -> (fetched_at, Table)
+
+    # --------------------
+    # Client
+    # --------------------
+    def _create_client(self):
+        from google.cloud import bigquery
+
+        credentials = None
+        if self.key_path and os.path.exists(self.key_path):
+            from google.oauth2 import service_account
+            credentials = service_account.Credentials.from_service_account_file(self.key_path)
+        elif self.key_path:
+            logging.warning(f"Key file {self.key_path} not found; using application default credentials")
+        logging.info(f"Creating BigQuery client for project {self.project}")
+        return bigquery.Client(credentials=credentials, project=self.project)
+
+    @property
+    def client(self):
+        # A client built before a fork is not reused in the child: its HTTP connections are shared
+        if self._owns_client and self._pid != os.getpid():
+            self._client, self._pid = None, os.getpid()
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    # --------------------
+    # Metadata cache
+    # --------------------
+    def _fresh(self, entry):
+        return entry is not None and time.monotonic() - entry[0] < self.metadata_ttl
+
+    def list_table_ids(self, dataset):
+        """Table ids in ``dataset`` (cached)."""
+        entry = self._tables.get(dataset)
+        if not self._fresh(entry):
+            entry = (time.monotonic(), [t.table_id for t in self.client.list_tables(dataset)])
+            self._tables[dataset] = entry
+        return entry[1]
+
+    def get_table(self, table_id):
+        """Table metadata for a fully qualified ``table_id`` (cached), or None if it does not exist.
+
+        A missing table is not cached: the first load usually creates it.
+        """
+        entry = self._metadata.get(table_id)
+        if not self._fresh(entry):
+            try:
+                table = self.client.get_table(table_id)
+            except Exception as e:
+                if not _is_not_found(e):
+                    raise
+                return None
+            entry = (time.monotonic(), table)
+            self._metadata[table_id] = entry
+        return entry[1]
+
+    def table_schema(self, table_id):
+        """The table's schema (list of SchemaField), or None if the table does not exist yet."""
+        table = self.get_table(table_id)
+        return table.schema if table is not None else None
+
+    def invalidate(self, table_id=None):
+        """Drop cached metadata for one table (e.g. after a schema change), or everything."""
+        if table_id is None:
+            self._tables.clear()
+            self._metadata.clear()
+        else:
+            self._metadata.pop(table_id, None)
+            self._tables.pop(table_id.rsplit(".", 1)[0], None)
+            self._tables.pop(table_id.split(".")[-2], None)
+
+
+_sessions = {}
+_wrapped = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def get_session(project, key_path=None):
+    """The process-wide session for ``(project, key_path)``; nothing is created until the client is used."""
+    with _sessions_lock:
+        session = _sessions.get((project, key_path))
+        if session is None:
+            session = _sessions[(project, key_path)] = BigQuerySession(project, key_path)
+        return session
+
+
+def session_for(client):
+    """A session (and metadata cache) for an explicitly passed client."""
+    with _sessions_lock:
+        session = _wrapped.get(client)
+        if session is None:
+            session = _wrapped[client] = BigQuerySession(getattr(client, "project", None), client=client)
+        return session
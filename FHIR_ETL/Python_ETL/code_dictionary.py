@@ -0,0 +1,224 @@
+"""Persistent code dictionaries and incremental code dimensions.
+
+The warehouse rebuilt its code dimensions with ``SELECT DISTINCT`` over the
+whole curated tables on every refresh, although the transforms already see
+every coding. Here:
+
+* every (system, code) gets a stable surrogate key, ``code_key``: a 63-bit
+  BLAKE2b hash of the pair. Transform workers compute it without any
+  coordination and it never changes between runs, so curated rows carry it
+  in ``*_key`` columns,
+* ``CodeDictionary`` (a local SQLite file) remembers, per domain (item
+  product, item category, coverage type, ...), which codings it has seen
+  and which have already been written to the dimension table,
+* ``track_codes`` hooks into ``etl_pipeline.run_pipelined``: as each batch
+  is transformed, its distinct codings are read from the Arrow output
+  (``CodeDomain`` names the columns) and new ones are recorded,
+* ``emit_new_codes`` appends only the entries not emitted yet to
+  ``fhir_warehouse.dim_code`` and marks them emitted.
+
+An entry recorded by a run that failed before emitting goes out with the
+next run. If the dimension table is rebuilt, ``reset`` the dictionary (or
+delete the file).
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from parquet_sink import TABLE_SCHEMAS, columns_to_record_batch, submit_record_batch_load, write_record_batch_local
+
+CODE_CONFIG = {
+    "PATH": "etl_code_dictionary.db",
+    "BQ_PROJECT": "fhir-synthea-data",
+    "BQ_DATASET": "fhir_warehouse",
+    "BQ_TABLE": "dim_code",
+}
+
+_CODING_COLUMNS = ["code_key", "system", "code", "display"]
+
+
+@lru_cache(maxsize=65536)
+def _code_key(system, code):
+    digest = hashlib.blake2b(f"{system or ''}|{code}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1  # fits a signed INT64
+
+
+def code_key(system, code):
+    """Stable surrogate key of a (system, code) coding, or None without a code."""
+    if code is None:
+        return None
+    try:
+        return _code_key(system, code)
+    except TypeError:  # unhashable, i.e. malformed, values
+        return None
+
+
+class CodeDomain:
+    """Where one domain's codings sit in a transform's record batch.
+
+    ``key``, ``system``, ``code`` and ``display`` are column names or, with ``within`` set, field
+    names inside the list<struct> column ``within``.
+    """
+
+    __slots__ = ("key", "system", "code", "display", "within")
+
+    def __init__(self, key, system, code, display, within=None):
+        self.key = key
+        self.system = system
+        self.code = code
+        self.display = display
+        self.within = within
+
+
+def domain_columns(record_batch, domain, fields):
+    """Arrays of ``domain``'s ``fields`` (attribute names such as "key") in a record batch, or None if absent."""
+    names = record_batch.schema.names
+    if domain.within is not None:
+        if domain.within not in names:
+            return None
+        values = pc.list_flatten(record_batch.column(domain.within))
+        return [values.field(getattr(domain, field)) for field in fields]
+    if domain.key not in names:
+        return None
+    return [record_batch.column(getattr(domain, field)) for field in fields]
+
+
+def distinct_codings(record_batch, domain):
+    """One ``{"code_key", "system", "code", "display"}`` dict per distinct key of ``domain`` in a record batch.
+
+    A key seen with several displays (e.g. a display falling back to free text) gets the least one,
+    so the choice does not depend on row order.
+    """
+    columns = domain_columns(record_batch, domain, ("key", "system", "code", "display"))
+    if columns is None:
+        return []
+    table = pa.table(columns, names=_CODING_COLUMNS)
+    table = table.filter(pc.is_valid(table.column("code_key")))
+    grouped = table.group_by("code_key").aggregate([("system", "min"), ("code", "min"), ("display", "min")])
+    return grouped.select(["code_key", "system_min", "code_min", "display_min"]).rename_columns(_CODING_COLUMNS).to_pylist()
+
+
+class CodeDictionary:
+    def __init__(self, path=None):
+        self.path = CODE_CONFIG["PATH"] if path is None else path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS codes (
+                domain TEXT NOT NULL,
+                code_key INTEGER NOT NULL,
+                system TEXT,
+                code TEXT,
+                display TEXT,
+                first_seen TEXT NOT NULL,
+                emitted INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (domain, code_key)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+        self._known = set(self._conn.execute("SELECT domain, code_key FROM codes"))
+        self.stats = {"new": 0, "emitted": 0}
+
+    def add(self, domain, codings):
+        """Record ``codings`` (from ``distinct_codings``) under ``domain``; return how many were new."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            fresh = []
+            for coding in codings:
+                entry = (domain, coding["code_key"])
+                if entry in self._known:
+                    continue
+                self._known.add(entry)
+                fresh.append((*entry, coding["system"], coding["code"], coding["display"], now))
+            if fresh:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO codes (domain, code_key, system, code, display, first_seen) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        fresh,
+                    )
+                self.stats["new"] += len(fresh)
+        return len(fresh)
+
+    def pending(self):
+        """Entries not yet emitted: ``(domain, code_key, system, code, display, first_seen)`` tuples."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT domain, code_key, system, code, display, first_seen FROM codes "
+                "WHERE emitted = 0 ORDER BY first_seen, domain, code_key"
+            ).fetchall()
+
+    def mark_emitted(self, entries):
+        """Mark ``(domain, code_key, ...)`` entries as written to the dimension table."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE codes SET emitted = 1 WHERE domain = ? AND code_key = ?",
+                [(entry[0], entry[1]) for entry in entries],
+            )
+            self.stats["emitted"] += len(entries)
+
+    def reset(self, domain=None):
+        """Forget one domain, or everything, e.g. after the dimension table was rebuilt."""
+        with self._lock, self._conn:
+            if domain is None:
+                self._conn.execute("DELETE FROM codes")
+                self._known.clear()
+            else:
+                self._conn.execute("DELETE FROM codes WHERE domain = ?", (domain,))
+                self._known = {entry for entry in self._known if entry[0] != domain}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# --------------------
+# Pipeline wiring
+# --------------------
+def track_codes(pipeline_options, domains, path=None):
+    """A ``CodeDictionary`` fed from ``run_pipelined``'s ``on_transformed`` hook.
+
+    ``domains`` maps a domain name to its ``CodeDomain``. A transform result may be one record
+    batch or a dict of them (the fan-out); a domain whose columns a batch lacks is skipped. An
+    ``on_transformed`` already in the options is still called.
+    """
+    dictionary = CodeDictionary(path)
+    previous = pipeline_options.get("on_transformed")
+
+    def on_transformed(batch, result):
+        for record_batch in (result.values() if isinstance(result, dict) else [result]):
+            for name, domain in domains.items():
+                dictionary.add(name, distinct_codings(record_batch, domain))
+        if previous is not None:
+            previous(batch, result)
+
+    pipeline_options["on_transformed"] = on_transformed
+    return dictionary
+
+
+def emit_new_codes(dictionary, client=None, local_dir=None, table_id=None):
+    """Append the entries not emitted yet to the code dimension; return how many were written.
+
+    With ``local_dir`` they are written as Parquet under ``local_dir/dim_code/``, otherwise loaded
+    into ``table_id`` (default ``CODE_CONFIG``'s table) with ``client``.
+    """
+    entries = dictionary.pending()
+    if not entries:
+        return 0
+    schema = TABLE_SCHEMAS["dim_code"]
+    record_batch = columns_to_record_batch(list(zip(*entries)), schema)
+    if local_dir is not None:
+        write_record_batch_local(record_batch, local_dir, CODE_CONFIG["BQ_TABLE"], partition_column="first_seen")
+    else:
+        table_id = table_id or f"{CODE_CONFIG['BQ_PROJECT']}.{CODE_CONFIG['BQ_DATASET']}.{CODE_CONFIG['BQ_TABLE']}"
+        submit_record_batch_load(client, record_batch, table_id).result()
+    dictionary.mark_emitted(entries)
+    logging.info(f"Emitted {len(entries)} new code dimension entries")
+    return len(entries)
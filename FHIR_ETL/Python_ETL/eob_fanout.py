@@ -0,0 +1,200 @@
+"""Single-scan fan-out over the ExplanationOfBenefit staging table.
+
+Each staging row is fetched and ``json``-parsed once, then handed to every
+registered curated transform (items, coverage, ...). Each transform has its
+own sink and its own load batching, so adding another curated table does
+not add another scan of the staging table.
+
+Usage::
+
+    python eob_fanout.py            # all registered sinks
+    python eob_fanout.py eob_items  # a subset
+"""
+import logging
+import sys
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+import EOBS_etl
+import etl_eob_items_coverage
+import staging_source
+from etl_checkpoint import covers, to_watermark
+from etl_metrics import current_metrics
+from etl_run import run_curated
+from fhir_fields import load_resource
+from load_manager import LoadGroup, LoadManager
+from warehouse_materializer import materialize_facts
+
+FANOUT_CONFIG = {
+    "BATCH_SIZE": EOBS_etl.ETL_CONFIG["BATCH_SIZE"],
+    "INCREMENTAL": True,  # see EOBS_etl.ETL_CONFIG for the size limit of a first run
+    "CHECKPOINT_PATH": EOBS_etl.ETL_CONFIG["CHECKPOINT_PATH"],
+    "SHARDS": EOBS_etl.ETL_CONFIG["SHARDS"],
+    "ADAPTIVE_BATCHES": EOBS_etl.ETL_CONFIG["ADAPTIVE_BATCHES"],
+    "PROFILE": EOBS_etl.ETL_CONFIG["PROFILE"],
+    "COALESCE_LOADS": True,
+    "SKIP_UNCHANGED": EOBS_etl.ETL_CONFIG["SKIP_UNCHANGED"],
+    "FINGERPRINT_PATH": EOBS_etl.ETL_CONFIG["FINGERPRINT_PATH"],
+    "CODE_DICTIONARY": EOBS_etl.ETL_CONFIG["CODE_DICTIONARY"],
+    "MATERIALIZE": EOBS_etl.ETL_CONFIG["MATERIALIZE"],
+}
+
+
+class Sink:
+    """A curated table fed by the fan-out.
+
+    ``transform(eob_id, resource, columns)`` appends one parsed EOB's rows to ``columns``, a
+    ``new_columns(load_timestamp)`` buffer (a ``parquet_sink.ColumnBuffer``); both must be
+    module-level (they run in worker processes). ``load(record_batch, client=...)`` appends a
+    batch to the table; ``max_rows`` caps the rows sent in a single load call. ``paths`` lists the
+    top-level resource keys the transform reads (None for the whole resource). ``submit(rows,
+    job_id=..., client=...)``, when given, starts a load job without waiting, which lets the
+    fan-out coalesce batches per sink through a LoadManager. ``code_domains`` maps code dimension
+    domains to the ``code_dictionary.CodeDomain`` columns of the sink's record batches.
+    """
+
+    def __init__(self, name, transform, new_columns, load, paths=None, max_rows=100000, submit=None,
+                 code_domains=None):
+        self.name = name
+        self.transform = transform
+        self.new_columns = new_columns
+        self.load = load
+        self.paths = paths
+        self.max_rows = max_rows
+        self.submit = submit
+        self.code_domains = code_domains or {}
+
+
+SINKS = {}
+
+
+def register_sink(sink):
+    SINKS[sink.name] = sink
+    return sink
+
+
+register_sink(Sink(
+    "eob_items", EOBS_etl.transform_resource, EOBS_etl.ItemColumns, EOBS_etl.load_batch_to_bq,
+    paths=EOBS_etl.RESOURCE_PATHS, submit=EOBS_etl.submit_load_job, code_domains=EOBS_etl.ITEM_CODE_DOMAINS,
+))
+register_sink(Sink(
+    "eob_coverage", etl_eob_items_coverage.transform_resource, etl_eob_items_coverage.CoverageColumns,
+    etl_eob_items_coverage.load_batch_to_bq,
+    paths=etl_eob_items_coverage.RESOURCE_PATHS, submit=etl_eob_items_coverage.submit_load_job,
+    code_domains=etl_eob_items_coverage.COVERAGE_CODE_DOMAINS,
+))
+
+
+# --------------------
+# Transform stage (runs in worker processes)
+# --------------------
+class FanOutTransform:
+    """Parse each staging row once and run every sink's transform on it.
+
+    ``since`` maps sink name -> ``(load_timestamp, eob_id)`` position, or ``{shard: position}`` for
+    a sharded scan; a sink skips rows at or before its own position, so sinks that were run
+    separately and are further ahead never see rows twice. Likewise a sink skips rows whose
+    resource it already loaded unchanged (``row["unchanged"]``, see ``fingerprints.ChangeTracker``).
+    """
+
+    def __init__(self, transforms, since):
+        self.transforms = transforms  # [(name, transform, new_columns)]
+        self.since = since
+
+    def __call__(self, batch):
+        load_timestamp = datetime.now(timezone.utc)
+        outputs = {name: new_columns(load_timestamp) for name, _, new_columns in self.transforms}
+        shard = getattr(batch, "shard", None)
+        since = {
+            name: mark.get(shard) if isinstance(mark, dict) else mark for name, mark in self.since.items()
+        }
+        check_marks = any(mark is not None for mark in since.values())
+        marks = {}
+        parse_seconds = 0.0
+
+        for row in batch:
+            start = time.perf_counter()
+            resource = load_resource(row["resource"])
+            parse_seconds += time.perf_counter() - start
+            if not isinstance(resource, dict):
+                continue
+            if check_marks:
+                ts = row["load_timestamp"]
+                if ts not in marks:
+                    marks[ts] = to_watermark(ts)
+                row_mark = marks[ts]
+            for name, transform, _ in self.transforms:
+                if check_marks and covers(since[name], row_mark, row["eob_id"]):
+                    continue
+                if name in row.get("unchanged", ()):
+                    continue
+                transform(row["eob_id"], resource, outputs[name])
+
+        current_metrics().observe("parse", parse_seconds)
+        logging.info("Fan-out transformed " + ", ".join(f"{n}={c.rows}" for n, c in outputs.items()))
+        return {name: columns.to_record_batch() for name, columns in outputs.items()}
+
+
+def count_rows(outputs):
+    return sum(len(rows) for rows in outputs.values())
+
+
+# --------------------
+# Load stage
+# --------------------
+def load_outputs(outputs, sinks, client=None):
+    """Load every sink's record batch, split into slices of at most ``sink.max_rows``."""
+    for name, rows in outputs.items():
+        sink = sinks[name]
+        for start in range(0, len(rows), sink.max_rows):
+            sink.load(rows[start:start + sink.max_rows], client=client)
+
+
+def make_load_group(sinks, client):
+    """One LoadManager per sink, each coalescing up to ``sink.max_rows`` rows per job."""
+    return LoadGroup({
+        name: LoadManager(
+            partial(sink.submit, client=client), name=name, target_rows=sink.max_rows,
+            lookup_job=getattr(client, "get_job", None),
+        )
+        for name, sink in sinks.items()
+    })
+
+
+# --------------------
+# Run fan-out
+# --------------------
+def run_fanout(sink_names=None, client=None, incremental=None, checkpoints=None, **pipeline_options):
+    """One staging scan feeding every selected sink; see etl_run.run_curated for the options.
+
+    Each sink keeps its own checkpoint, so sinks can also be run separately by their modules. The
+    fan-out otherwise follows FANOUT_CONFIG like a single table's run (shards, adaptive batches,
+    profile, ...), with the staging table and sink settings of ``EOBS_etl.ETL_CONFIG``.
+    """
+    sinks = {name: SINKS[name] for name in (sink_names or SINKS)}
+    client = client or EOBS_etl.bq_session.client
+    config = {**EOBS_etl.ETL_CONFIG, **FANOUT_CONFIG}
+    make_load_manager = None
+    if all(sink.submit is not None for sink in sinks.values()):
+        make_load_manager = partial(make_load_group, sinks)
+    transforms = [(name, sink.transform, sink.new_columns) for name, sink in sinks.items()]
+    logging.info(f"Fan-out to {list(sinks)}")
+    return run_curated(
+        config, "fanout_" + "_".join(sinks), partial(load_outputs, sinks=sinks, client=client),
+        client=client, incremental=incremental, checkpoints=checkpoints,
+        paths=staging_source.merge_paths(*(sink.paths for sink in sinks.values())),
+        make_load_manager=make_load_manager,
+        # Each domain's columns exist only in its own sink's record batches
+        code_domains={domain: spec for sink in sinks.values() for domain, spec in sink.code_domains.items()},
+        checkpoint_names=list(sinks), checkpoint_paths={name: sink.paths for name, sink in sinks.items()},
+        make_transform=partial(FanOutTransform, transforms),
+        row_count=count_rows, **pipeline_options,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_fanout(sys.argv[1:] or None)
+    if FANOUT_CONFIG["MATERIALIZE"] and EOBS_etl.ETL_CONFIG["SINK"] != "local":
+        materialize_facts()
@@ -0,0 +1,209 @@
+"""Durable per-pipeline checkpoints for the curated ETL runs.
+
+Each pipeline (one per curated table) keeps a high-water mark of the
+staging rows it has fully loaded. The mark lives in a small local SQLite
+file so it survives restarts, and it only ever moves forward.
+
+A mark is a ``load_timestamp``, optionally with the EOB id of the last row
+loaded at that timestamp: a position ``(high_water, key)`` in the
+``(load_timestamp, eob_id)`` order of an ordered staging scan. A COPY stamps
+all its rows with one timestamp, so the key lets a batch end in the middle
+of a timestamp. Without a key, every row at ``high_water`` is loaded.
+
+Sharded scans (see ``sharded_source.py``) additionally keep one position per
+shard, plus the shard's key range when shards are id ranges, so each shard
+resumes where it stopped.
+"""
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                pipeline TEXT PRIMARY KEY,
+                high_water TEXT NOT NULL,
+                high_water_key TEXT,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard_positions (
+                pipeline TEXT NOT NULL,
+                shards INTEGER NOT NULL,
+                shard INTEGER NOT NULL,
+                lower_bound INTEGER,
+                upper_bound INTEGER,
+                position TEXT,
+                position_key TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (pipeline, shards, shard)
+            )
+        """)
+        # Stores written before marks carried a key
+        for table, column in (("watermarks", "high_water_key"), ("shard_positions", "position_key")):
+            if column not in {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+        self._conn.commit()
+
+    def get_watermark(self, pipeline):
+        """Return the stored high-water mark (ISO string) for ``pipeline``, or None on first run."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT high_water FROM watermarks WHERE pipeline = ?", (pipeline,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_position(self, pipeline):
+        """Return the stored ``(high_water, key)`` position for ``pipeline``, or None on first run."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT high_water, high_water_key FROM watermarks WHERE pipeline = ?", (pipeline,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def advance_watermark(self, pipeline, value, key=None):
+        """Move the mark forward to ``value`` (and ``key``); a position at or below the current one is ignored."""
+        if value is None:
+            return self.get_watermark(pipeline)
+        value = to_watermark(value)
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.execute(f"""
+                INSERT INTO watermarks (pipeline, high_water, high_water_key, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (pipeline) DO UPDATE
+                    SET high_water = excluded.high_water, high_water_key = excluded.high_water_key,
+                        updated_at = excluded.updated_at
+                    WHERE {_position_after("excluded.high_water", "excluded.high_water_key",
+                                           "watermarks.high_water", "watermarks.high_water_key")}
+            """, (pipeline, value, key, now))
+            self._conn.commit()
+        return self.get_watermark(pipeline)
+
+    def reset(self, pipeline):
+        """Forget the mark (and any shard positions) so the next incremental run re-reads the whole staging table."""
+        with self._lock:
+            self._conn.execute("DELETE FROM watermarks WHERE pipeline = ?", (pipeline,))
+            self._conn.execute("DELETE FROM shard_positions WHERE pipeline = ?", (pipeline,))
+            self._conn.commit()
+
+    # --------------------
+    # Per-shard positions
+    # --------------------
+    def get_shards(self, pipeline, shards):
+        """``{shard: (lower_bound, upper_bound, position)}`` saved for a ``shards``-way split of ``pipeline``."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT shard, lower_bound, upper_bound, position FROM shard_positions "
+                "WHERE pipeline = ? AND shards = ?", (pipeline, shards)
+            ).fetchall()
+        return {shard: (lower, upper, position) for shard, lower, upper, position in rows}
+
+    def get_shard_positions(self, pipeline, shards):
+        """``{shard: (position, key)}`` of the shards of ``pipeline`` that have a saved position."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT shard, position, position_key FROM shard_positions "
+                "WHERE pipeline = ? AND shards = ? AND position IS NOT NULL", (pipeline, shards)
+            ).fetchall()
+        return {shard: (position, key) for shard, position, key in rows}
+
+    def save_shard_bounds(self, pipeline, bounds):
+        """Record the key range of each shard (a list of ``(lower, upper)``); existing shards keep theirs."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.executemany("""
+                INSERT INTO shard_positions (pipeline, shards, shard, lower_bound, upper_bound, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pipeline, shards, shard) DO NOTHING
+            """, [(pipeline, len(bounds), i, lower, upper, now) for i, (lower, upper) in enumerate(bounds)])
+            self._conn.commit()
+
+    def advance_shard(self, pipeline, shards, shard, position, key=None):
+        """Move one shard's position (and ``key``) forward; positions compare as strings, like watermarks."""
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.execute(f"""
+                INSERT INTO shard_positions (pipeline, shards, shard, position, position_key, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pipeline, shards, shard) DO UPDATE
+                    SET position = excluded.position, position_key = excluded.position_key,
+                        updated_at = excluded.updated_at
+                    WHERE shard_positions.position IS NULL OR {_position_after(
+                        "excluded.position", "excluded.position_key",
+                        "shard_positions.position", "shard_positions.position_key")}
+            """, (pipeline, shards, shard, position, key, now))
+            self._conn.commit()
+
+    def reset_shards(self, pipeline):
+        with self._lock:
+            self._conn.execute("DELETE FROM shard_positions WHERE pipeline = ?", (pipeline,))
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _position_after(mark, key, old_mark, old_key):
+    """SQL condition: position ``(mark, key)`` is past ``(old_mark, old_key)``; a NULL key covers its whole mark."""
+    return (
+        f"({mark} > {old_mark} OR ({mark} = {old_mark} AND {old_key} IS NOT NULL "
+        f"AND ({key} IS NULL OR {key} > {old_key})))"
+    )
+
+
+def position_order(position):
+    """Sort key of a ``(mark, key)`` position: at one mark, a position without key comes after any key."""
+    mark, key = position
+    return mark, key is None, key or ""
+
+
+def earliest_position(positions):
+    """The lowest of several positions, or None (start from scratch) if any of them is None."""
+    positions = list(positions)
+    if not positions or any(position is None for position in positions):
+        return None
+    return min(positions, key=position_order)
+
+
+def covers(position, mark, key):
+    """True if the row at ``(mark, key)`` (a normalized load_timestamp and an EOB id) is at or before ``position``."""
+    if position is None:
+        return False
+    high_water, high_key = position
+    return mark < high_water or (mark == high_water and (high_key is None or key <= high_key))
+
+
+def to_watermark(value):
+    """Normalize a load_timestamp (datetime or string) to a sortable ISO-8601 string."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(sep=" ")
+    return str(value).replace("T", " ")
+
+
+def batch_position(batch):
+    """``(load_timestamp, eob_id)`` of the last row of an ordered staging batch, or None."""
+    return (batch[-1]["load_timestamp"], batch[-1]["eob_id"]) if batch else None
+
+
+def watermark_hooks(store, pipeline):
+    """Return ``(since, batch_token, on_commit)`` wiring a store into ``etl_pipeline.run_pipelined``.
+
+    Batches must come from an ordered staging scan and be committed in order: the token of a
+    batch is the ``(load_timestamp, eob_id)`` of its last row, and the mark advances to it only
+    once the batch has loaded. ``since`` is the stored ``(high_water, key)`` position, or None.
+    """
+    since = store.get_position(pipeline)
+
+    def on_commit(seq, position, rows_out):
+        if position is not None:
+            store.advance_watermark(pipeline, *position)
+
+    return since, batch_position, on_commit
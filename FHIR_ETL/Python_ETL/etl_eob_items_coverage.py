@@ -1,11 +1,21 @@
 import logging
 import os
-from google.cloud import bigquery
-from google.oauth2 import service_account
 from datetime import datetime, timezone
-import json
+import time
 import traceback
 from collections import Counter
+from functools import lru_cache, partial
+import staging_source
+from code_dictionary import CodeDomain, code_key
+from bq_session import get_session, session_for
+from etl_metrics import current_metrics
+from etl_run import run_curated
+from sharded_source import fetch_sharded_batches
+from fhir_fields import Derived, Field, Repeated, compile_columns, compile_path, interned, load_resource, text
+from load_manager import CompletedJob, LoadManager
+from parquet_sink import (
+    TABLE_SCHEMAS, ColumnBuffer, record_batch_to_json_rows, submit_record_batch_load, write_record_batch_local,
+)
 
 # --------------------
 # Configuration
@@ -17,14 +27,27 @@ ETL_CONFIG = {
     "BQ_DATASET_CURATED": "fhir_curated_sample",
     "BQ_TABLE_CURATED": "eob_coverage",
     "BATCH_SIZE": 5000,
+    "ADAPTIVE_BATCHES": True,  # resize batches from observed fan-out, starting at BATCH_SIZE (see adaptive_batcher.py)
+    # Resume from CHECKPOINT_PATH. The scan is sorted by (load_timestamp, id) in one query, so a first
+    # run (no checkpoint yet) over a large table can fail with "resources exceeded": run it with
+    # SHARDS > 1, so each shard sorts only its own rows.
+    "INCREMENTAL": True,
+    "CHECKPOINT_PATH": "etl_checkpoints.db",
+    "SINK": "parquet",  # "parquet" (load job), "json" (load_table_from_json) or "local" (Parquet files on disk)
+    "LOCAL_SINK_DIR": "curated_parquet",
+    "COALESCE_LOADS": True,  # buffer batches into fewer, larger load jobs (see load_manager.LOAD_CONFIG)
+    "SKIP_UNCHANGED": True,  # skip EOBs whose fingerprint matches the last loaded version (see fingerprints.py)
+    "FINGERPRINT_PATH": "etl_fingerprints.db",
+    "SHARDS": 1,  # > 1 reads the staging table as that many hash shards, concurrently (see sharded_source.py)
+    "CODE_DICTIONARY": True,  # record new codings and append them to the code dimension (see code_dictionary.py)
+    "PROFILE": True,  # plan workers/batches from a pushdown count and the last profile, and profile the run (see etl_profile.py)
     "KEY_PATH": "/keys/bq_key.json"
 }
 
 # --------------------
-# Setup BigQuery client
+# BigQuery session (client and credentials are created on first use)
 # --------------------
-credentials = service_account.Credentials.from_service_account_file(ETL_CONFIG["KEY_PATH"])
-bq_client = bigquery.Client(credentials=credentials, project=ETL_CONFIG["BQ_PROJECT"])
+bq_session = get_session(ETL_CONFIG["BQ_PROJECT"], ETL_CONFIG["KEY_PATH"])
 
 # --------------------
 # Helpers
@@ -37,198 +60,188 @@ def parse_fhir_datetime(dt_str):
     except Exception:
         return None
 
-def safe_bq_timestamp(dt_obj):
-    return dt_obj.isoformat() if dt_obj else None
-
 # --------------------
 # Fetch batches from staging
 # --------------------
-def fetch_staging_batches(batch_size=5000):
-    query = f"""
-        SELECT explanationofbenefit_id AS eob_id, resource, load_timestamp
-        FROM `{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_RAW']}.{ETL_CONFIG['BQ_TABLE_RAW']}`
-    """
-    query_job = bq_client.query(query)
-    iterator = query_job.result(page_size=batch_size)
-
-    batch = []
-    for row in iterator:
-        batch.append({
-            "eob_id": row["eob_id"],
-            "resource": row["resource"]
-        })
-        if len(batch) >= batch_size:
-            yield batch
-            batch = []
-
-    if batch:
-        yield batch
+# Top-level resource keys transform_batch reads; the staging scan projects only these
+RESOURCE_PATHS = ["resourceType", "contained", "insurance"]
+
+def fetch_staging_batches(batch_size=5000, client=None, since=None, ordered=False, paths=RESOURCE_PATHS, shards=1,
+                          batcher=None):
+    client = client or bq_session.client
+    table_id = staging_source.staging_table_id(ETL_CONFIG)
+    if shards > 1:
+        return fetch_sharded_batches(
+            client, table_id, batch_size, shards, since=since, ordered=ordered, paths=paths, batcher=batcher
+        )
+    return staging_source.fetch_staging_batches(
+        client, table_id, batch_size, since=since, ordered=ordered, paths=paths, batcher=batcher
+    )
 
 # --------------------
 # Transform function
 # --------------------
+@lru_cache(maxsize=65536)
+def fhir_datetime(dt_str):
+    return parse_fhir_datetime(dt_str)
+
+# Declarative spec for one curated eob_coverage row (coverage_id and focal are added per
+# Coverage below), compiled once at import. Code/system/display strings are interned and other
+# strings pass through ``text``, so a value of the wrong type is logged with its EOB instead of
+# failing the batch. type_key is a stable surrogate key into the code dimension
+# (code_dictionary.code_key).
+COVERAGE_FIELDS = {
+    "status": Field("status", interned),
+    "type_code": Field("type.coding[0].code", interned),
+    "type_system": Field("type.coding[0].system", interned),
+    "type_display": Field(("type.coding[0].display", "type.text"), interned),
+    "type_codings": Repeated("type.coding", {
+        "system": Field("system", interned),
+        "code": Field("code", interned),
+        "display": Field("display", interned),
+    }),
+    "identifier_value": Field("identifier[0].value", text),
+    "identifier_system": Field("identifier[0].system", interned),
+    "identifiers": Repeated("identifier", {"system": Field("system", interned), "value": Field("value", text)}),
+    "beneficiary_ref": Field("beneficiary.reference", text),
+    "payor": Field("payor[0].display", interned),
+    "subscriber_id": Field("subscriber.reference", text),
+    "period_start": Field("period.start", fhir_datetime),
+    "period_end": Field("period.end", fhir_datetime),
+    "type_key": Derived(("type.coding[0].system", "type.coding[0].code"), code_key),
+}
+extract_coverage = compile_columns(COVERAGE_FIELDS)
+extract_coverage_id = compile_path("id", text)
+extract_coverage_ref = compile_path("coverage.reference")
+
+# Code dimension domains found in the eob_coverage record batches
+COVERAGE_CODE_DOMAINS = {
+    "coverage_type": CodeDomain("type_key", "type_system", "type_code", "type_display"),
+}
+
+class CoverageColumns(ColumnBuffer):
+    """Column lists for a batch of curated eob_coverage rows."""
+
+    def __init__(self, load_timestamp=None):
+        super().__init__(TABLE_SCHEMAS["eob_coverage"], load_timestamp)
+        self.coverage_appenders = self.appenders(COVERAGE_FIELDS)
+        self.append_coverage_id = self.columns["coverage_id"].append
+        self.append_focal = self.columns["focal"].append
+
+def as_list(value):
+    """The dicts in a FHIR element that may be a list, a single dict or missing."""
+    if isinstance(value, list):
+        return [v for v in value if isinstance(v, dict)]
+    return [value] if isinstance(value, dict) else []
+
+def transform_resource(eob_id, resource, columns):
+    """Append a curated eob_coverage row per contained Coverage of one parsed EOB to ``columns``; return how many."""
+    if resource.get("resourceType") != "ExplanationOfBenefit":
+        return 0
+
+    # Map insurance coverage references -> focal
+    coverage_focal_map = {}
+    for ins in as_list(resource.get("insurance")):
+        cov_ref = extract_coverage_ref(ins)
+        if isinstance(cov_ref, str):
+            coverage_focal_map[cov_ref.lstrip("#")] = ins.get("focal")
+
+    # A Coverage that fails is logged and skipped; its EOB's other coverages are still appended
+    appended = 0
+    for contained in as_list(resource.get("contained")):
+        if contained.get("resourceType") != "Coverage":
+            continue
+        try:
+            cov_id = extract_coverage_id(contained)
+            extract_coverage(contained, columns.coverage_appenders)
+        except Exception as e:
+            logging.error(f"Failed to transform a Coverage of record {eob_id}: {type(e).__name__} - {e}")
+            logging.error(traceback.format_exc())
+            continue
+        columns.append_coverage_id(cov_id or f"{eob_id}-coverage")
+        columns.append_focal(coverage_focal_map.get(cov_id))
+        appended += 1
+    return appended
+
 def transform_batch(batch):
-    curated_records = []
+    """Arrow record batch of curated eob_coverage rows for a batch of staging rows."""
+    columns = CoverageColumns()
+    fanout = Counter()  # coverages per EOB
+    parse_seconds = 0.0
 
     for row in batch:
-        eob_id = row["eob_id"]
-        resource = row["resource"]
-
         # Parse JSON if needed
-        resource = json.loads(resource) if isinstance(resource, str) else resource
-        if resource.get("resourceType") != "ExplanationOfBenefit":
-            continue
+        start = time.perf_counter()
+        resource = load_resource(row["resource"])
+        parse_seconds += time.perf_counter() - start
+        if isinstance(resource, dict):
+            fanout[transform_resource(row["eob_id"], resource, columns)] += 1
 
-        contained_resources = resource.get("contained", [])
-        insurance_list = resource.get("insurance", [])
-
-        # Map insurance coverage references -> focal
-        coverage_focal_map = {
-            ins.get("coverage", {}).get("reference", "").lstrip("#"): ins.get("focal")
-            for ins in insurance_list if ins.get("coverage")
-        }
-
-        for contained in contained_resources:
-            if contained.get("resourceType") != "Coverage":
-                continue
-
-            cov_id = contained.get("id")
-            type_info = contained.get("type", {})
-            type_codings = type_info.get("coding", [])
-            main_type = type_codings[0] if type_codings else {}
-
-            identifiers = contained.get("identifier", [])
-            main_identifier = identifiers[0] if identifiers else {}
-
-            period = contained.get("period", {})
-
-            curated_records.append({
-                "coverage_id": cov_id or f"{eob_id}-coverage",
-                "status": contained.get("status"),
-                "type_code": main_type.get("code"),
-                "type_system": main_type.get("system"),
-                "type_display": main_type.get("display") or type_info.get("text"),
-                "type_codings": [
-                    {"system": c.get("system"), "code": c.get("code"), "display": c.get("display")}
-                    for c in type_codings
-                ] if type_codings else [],
-                "identifier_value": main_identifier.get("value"),
-                "identifier_system": main_identifier.get("system"),
-                "identifiers": [
-                    {"system": i.get("system"), "value": i.get("value")}
-                    for i in identifiers
-                ] if identifiers else [],
-                "beneficiary_ref": contained.get("beneficiary", {}).get("reference"),
-                "payor": (contained.get("payor", [{}])[0].get("display") if contained.get("payor") else None),
-                "subscriber_id": contained.get("subscriber", {}).get("reference"),
-                "period_start": safe_bq_timestamp(parse_fhir_datetime(period.get("start"))),
-                "period_end": safe_bq_timestamp(parse_fhir_datetime(period.get("end"))),
-                "focal": coverage_focal_map.get(cov_id),
-                "load_timestamp": safe_bq_timestamp(datetime.utcnow())
-            })
-
-    logging.info(f"Transformed {len(curated_records)} Coverage records in this batch")
-    return curated_records
+    current_metrics().observe("parse", parse_seconds)
+    current_metrics().count_values("coverage_per_eob", fanout)
+    logging.info(f"Transformed {columns.rows} Coverage records in this batch")
+    return columns.to_record_batch()
 
 # --------------------
 # Load batch into curated table
 # --------------------
-def load_batch_to_bq(batch):
-    table_id = f"{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_CURATED']}.{ETL_CONFIG['BQ_TABLE_CURATED']}"
-    tables = list(bq_client.list_tables(ETL_CONFIG['BQ_DATASET_RAW']))
-    print("Tables in staging dataset:", [t.table_id for t in tables])
-
-    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
-    job = bq_client.load_table_from_json(batch, table_id, job_config=job_config)
-    job.result()
-    logging.info(f"Loaded {len(batch)} records into {table_id}")
-
-def estimate_coverage_count(all_rows):
-    coverage_count = 0
-
-    for row in all_rows:
-        # Access by index because row is a list/tuple
-        eob_id = row[0]
-        resource = row[1]
-
-        # Parse JSON if it's a string
-        resource = json.loads(resource) if isinstance(resource, str) else resource
-        if resource.get("resourceType") != "ExplanationOfBenefit":
-            continue
-
-        contained_resources = resource.get("contained", [])
-        insurance_list = resource.get("insurance", [])
-
-        # Map insurance coverage references -> focal
-        coverage_focal_map = {}
-        for ins in insurance_list:
-            cov_ref = ins.get("coverage", {}).get("reference")
-            if cov_ref:
-                coverage_focal_map[cov_ref.lstrip("#")] = ins.get("focal", None)
-
-        # Count Coverage records in contained resources
-        for contained in contained_resources:
-            if contained.get("resourceType") == "Coverage":
-                coverage_count += 1
-
-    return coverage_count
+def submit_load_job(batch, job_id=None, client=None):
+    """Start appending ``batch`` (a record batch from transform_batch) with the configured sink; returns the job."""
+    table = ETL_CONFIG["BQ_TABLE_CURATED"]
+    if ETL_CONFIG["SINK"] == "local":
+        write_record_batch_local(batch, ETL_CONFIG["LOCAL_SINK_DIR"], table)
+        return CompletedJob()
+
+    session = bq_session if client is None else session_for(client)
+    table_id = f"{ETL_CONFIG['BQ_PROJECT']}.{ETL_CONFIG['BQ_DATASET_CURATED']}.{table}"
+    if ETL_CONFIG["SINK"] == "parquet":
+        return submit_record_batch_load(session.client, batch, table_id, job_id=job_id)
+
+    from google.cloud import bigquery
+
+    # Reuse the target's cached schema so the load job does not autodetect types on every batch;
+    # columns the table does not have yet (e.g. code keys) are dropped until it is migrated
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_APPEND", schema=session.table_schema(table_id), ignore_unknown_values=True,
+    )
+    rows = record_batch_to_json_rows(batch)
+    return session.client.load_table_from_json(rows, table_id, job_config=job_config, job_id=job_id)
+
+def load_batch_to_bq(batch, client=None):
+    submit_load_job(batch, client=client).result()
+    logging.info(f"Loaded {len(batch)} records into {ETL_CONFIG['BQ_TABLE_CURATED']}")
+
+def make_load_manager(client=None):
+    """A LoadManager coalescing transformed batches into fewer load jobs on the curated table."""
+    client = client or bq_session.client
+    return LoadManager(
+        partial(submit_load_job, client=client),
+        name=ETL_CONFIG["BQ_TABLE_CURATED"],
+        lookup_job=getattr(client, "get_job", None),
+    )
 
 # --------------------
 # Run pipeline
 # --------------------
-def run_pipeline():
-    for batch_num, batch in enumerate(fetch_staging_batches(ETL_CONFIG["BATCH_SIZE"]), start=1):
-        transformed = transform_batch(batch)
-        if transformed:
-            load_batch_to_bq(transformed)
-        logging.info(f"Batch {batch_num} processed successfully")
+def run_pipeline(client=None, incremental=None, checkpoints=None, **pipeline_options):
+    """Fetch, transform and load overlapped; see etl_run.run_curated and etl_pipeline.run_pipelined.
+
+    In incremental mode only staging rows past the stored load_timestamp watermark are read,
+    and the watermark advances as each batch commits. With SKIP_UNCHANGED, EOBs whose projected
+    resource is unchanged since they last loaded are dropped before the transform. With
+    ADAPTIVE_BATCHES, batch sizes follow the coverage rows each EOB turns into. With CODE_DICTIONARY,
+    coverage types not seen by earlier runs are appended to the code dimension after the load.
+    With PROFILE, the run is sized from a server-side row count and the last run's profile, and
+    profiled as it goes (coverages per EOB, null rates, distinct coverage types).
+    """
+    client = client or bq_session.client
+    return run_curated(
+        ETL_CONFIG, ETL_CONFIG["BQ_TABLE_CURATED"], partial(load_batch_to_bq, client=client), transform_batch,
+        client=client, incremental=incremental, checkpoints=checkpoints, paths=RESOURCE_PATHS,
+        make_load_manager=make_load_manager, code_domains=COVERAGE_CODE_DOMAINS, fanout="coverage_per_eob",
+        **pipeline_options,
+    )
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    #all_eobs = fetch_all_records_from_source()  # however you load your raw EOBs
-    all_eobs = fetch_staging_batches()
-    total_coverage = estimate_coverage_count(all_eobs)
-    print(f"Estimated number of Coverage records: {total_coverage}")
-
-    '''coverage_counts = []
-    for row in all_eobs:
-        resource = row["resource"]
-        resource = json.loads(resource) if isinstance(resource, str) else resource
-        if resource.get("resourceType") != "ExplanationOfBenefit":
-            continue
-        contained_resources = resource.get("contained", [])
-        coverage_per_eob = sum(1 for r in contained_resources if r.get("resourceType") == "Coverage")
-        coverage_counts.append(coverage_per_eob)
-
-    total_coverage = sum(coverage_counts)
-    min_coverage = min(coverage_counts) if coverage_counts else 0
-    max_coverage = max(coverage_counts) if coverage_counts else 0
-    avg_coverage = total_coverage / len(coverage_counts) if coverage_counts else 0
-
-    print(f"Total Coverage records: {total_coverage}")
-    print(f"Min per EOB: {min_coverage}, Max per EOB: {max_coverage}, Avg per EOB: {avg_coverage:.2f}")'''
     run_pipeline()
-
-'''if __name__ == "__main__":
-    print("Script started")
-    print(f"BQ_PROJECT={ETL_CONFIG['BQ_PROJECT']}, KEY_PATH={ETL_CONFIG['KEY_PATH']}")
-    logging.basicConfig(level=logging.INFO)
-
-    # Fetch only the first batch of 5–10 records
-    test_batches = fetch_staging_batches(batch_size=5)
-    test_batch = next(test_batches, [])
-
-    if not test_batch:
-        print("No records found in staging.")
-    else:
-        print(f"Fetched {len(test_batch)} records for testing.")
-
-        # Transform
-        transformed = transform_batch(test_batch)
-        print(f"Transformed {len(transformed)} records.")
-        print("Sample transformed record:")
-        print(transformed[0])
-
-        # Optionally load to BQ
-        load_batch_to_bq(transformed)
-        print("Test batch loaded successfully.")'''
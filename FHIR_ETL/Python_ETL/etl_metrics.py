@@ -0,0 +1,301 @@
+"""Per-stage timing and throughput instrumentation for the ETL runners.
+
+A ``StageMetrics`` collects two kinds of measurement:
+
+* stages: call count, total and max seconds (``fetch``, ``query``, ``parse``,
+  ``transform``, ``load``, ``backpressure_wait``, ...)
+* counters: plain sums (``rows_in``, ``rows_out``, ``bytes_uploaded``, ...)
+* histograms: occurrences per value (``items_per_eob``, ...)
+
+Code that does not know which run it belongs to (the staging scan, the
+transforms, the sinks) records into ``current_metrics()``. ``instrumented_run``
+activates the run's collector for the process. Transforms running in
+worker processes record into a per-batch collector, which is shipped back
+with the result and merged. Recording takes a lock once per batch or job,
+never per row, so it can stay on in production.
+
+``instrumented_run`` wraps a run. On exit it writes a JSON run report and,
+if configured, a Prometheus textfile for node_exporter's textfile
+collector. It can also run a sampling profiler that writes collapsed
+stacks (flamegraph input).
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+METRICS_CONFIG = {
+    "REPORT_DIR": os.environ.get("ETL_REPORT_DIR", "etl_reports"),  # relative to the working directory; gitignored
+    "PROMETHEUS_TEXTFILE_DIR": os.environ.get("ETL_PROMETHEUS_TEXTFILE_DIR"),  # None disables the textfile
+    "PROFILE_INTERVAL": float(os.environ.get("ETL_PROFILE_INTERVAL", "0")),  # seconds; 0 disables the profiler
+}
+
+
+class StageMetrics:
+    def __init__(self, pipeline=None):
+        self.pipeline = pipeline
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = Counter()
+        self._histograms = {}
+
+    def observe(self, stage, seconds, count=1):
+        """Record ``count`` calls of ``stage`` taking ``seconds`` in total."""
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                self._stages[stage] = [count, seconds, seconds]
+            else:
+                entry[0] += count
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def count_values(self, histogram, counts):
+        """Add ``counts`` (value -> occurrences, e.g. a batch's Counter) to ``histogram``."""
+        with self._lock:
+            self._histograms.setdefault(histogram, Counter()).update(counts)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """A plain, picklable copy of everything recorded so far."""
+        with self._lock:
+            return {
+                "stages": {name: list(entry) for name, entry in self._stages.items()},
+                "counters": dict(self._counters),
+                "histograms": {name: dict(counts) for name, counts in self._histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        """Fold in a snapshot taken elsewhere (typically in a transform worker process)."""
+        for stage, (count, total, peak) in snapshot["stages"].items():
+            with self._lock:
+                entry = self._stages.get(stage)
+                if entry is None:
+                    self._stages[stage] = [count, total, peak]
+                else:
+                    entry[0] += count
+                    entry[1] += total
+                    entry[2] = max(entry[2], peak)
+        for counter, value in snapshot["counters"].items():
+            self.add(counter, value)
+        for histogram, counts in snapshot["histograms"].items():
+            self.count_values(histogram, counts)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def histogram(self, name):
+        """``{value: occurrences}`` recorded for ``histogram`` so far."""
+        with self._lock:
+            return dict(self._histograms.get(name, {}))
+
+    def stage_summary(self):
+        with self._lock:
+            return {
+                name: {
+                    "count": count,
+                    "total_seconds": round(total, 6),
+                    "mean_seconds": round(total / count, 6) if count else 0.0,
+                    "max_seconds": round(peak, 6),
+                }
+                for name, (count, total, peak) in self._stages.items()
+            }
+
+
+_current = StageMetrics()
+
+
+def current_metrics():
+    """The collector for this process: the active run's, or a process-wide default."""
+    return _current
+
+
+@contextmanager
+def activate(metrics):
+    """Make ``metrics`` the process-wide ``current_metrics()`` for the duration of the block."""
+    global _current
+    previous, _current = _current, metrics
+    try:
+        yield metrics
+    finally:
+        _current = previous
+
+
+def measured_call(stage, fn, *args):
+    """Run ``fn(*args)`` under a fresh collector; return ``(result, snapshot)``.
+
+    Module-level so it can be sent to a worker process, where the caller's collector is not visible.
+    """
+    metrics = StageMetrics()
+    with activate(metrics):
+        with metrics.time(stage):
+            result = fn(*args)
+    return result, metrics.snapshot()
+
+
+# --------------------
+# Sampling profiler
+# --------------------
+class SamplingProfiler:
+    """Samples every thread's Python stack at a fixed interval and counts collapsed stacks.
+
+    Only threads of this process are visible: to profile transforms, run the pipeline with
+    ``workers=0``.
+    """
+
+    def __init__(self, interval=0.01, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="etl-profiler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# --------------------
+# Run report
+# --------------------
+def build_report(metrics, started_at, wall_seconds, status, error=None):
+    rows_in = metrics.counter("rows_in")
+    rows_out = metrics.counter("rows_out")
+    return {
+        "pipeline": metrics.pipeline,
+        "status": status,
+        "error": error,
+        "started_at": started_at.isoformat(),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput": {
+            "rows_in_per_s": round(rows_in / wall_seconds, 1) if wall_seconds else None,
+            "rows_out_per_s": round(rows_out / wall_seconds, 1) if wall_seconds else None,
+        },
+        "stages": metrics.stage_summary(),
+        "counters": metrics.snapshot()["counters"],
+        "histograms": metrics.snapshot()["histograms"],
+    }
+
+
+def _prom_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(report):
+    """Render a run report in the Prometheus text exposition format."""
+    pipeline = _prom_label(report["pipeline"])
+    lines = [
+        "# HELP etl_stage_seconds Time spent in each ETL stage during the last run.",
+        "# TYPE etl_stage_seconds gauge",
+    ]
+    stages = report["stages"]
+    lines += [f'etl_stage_seconds{{pipeline="{pipeline}",stage="{_prom_label(s)}"}} {v["total_seconds"]}' for s, v in stages.items()]
+    lines += ["# HELP etl_stage_calls Calls of each ETL stage during the last run.", "# TYPE etl_stage_calls gauge"]
+    lines += [f'etl_stage_calls{{pipeline="{pipeline}",stage="{_prom_label(s)}"}} {v["count"]}' for s, v in stages.items()]
+    lines += ["# HELP etl_stage_max_seconds Slowest single call of each ETL stage during the last run.", "# TYPE etl_stage_max_seconds gauge"]
+    lines += [f'etl_stage_max_seconds{{pipeline="{pipeline}",stage="{_prom_label(s)}"}} {v["max_seconds"]}' for s, v in stages.items()]
+    lines += ["# HELP etl_counter Counters from the last run (rows, bytes, batches, ...).", "# TYPE etl_counter gauge"]
+    lines += [f'etl_counter{{pipeline="{pipeline}",name="{_prom_label(k)}"}} {v}' for k, v in report["counters"].items()]
+    lines += [
+        "# HELP etl_run_duration_seconds Wall time of the last run.",
+        "# TYPE etl_run_duration_seconds gauge",
+        f'etl_run_duration_seconds{{pipeline="{pipeline}"}} {report["wall_seconds"]}',
+        "# HELP etl_run_success Whether the last run finished without error.",
+        "# TYPE etl_run_success gauge",
+        f'etl_run_success{{pipeline="{pipeline}"}} {int(report["status"] == "success")}',
+        "# HELP etl_run_finished_timestamp_seconds Unix time the last run finished.",
+        "# TYPE etl_run_finished_timestamp_seconds gauge",
+        f'etl_run_finished_timestamp_seconds{{pipeline="{pipeline}"}} {time.time():.0f}',
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, text):
+    # The textfile collector may read at any time; never let it see a half-written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def instrumented_run(pipeline, report_dir=None, prometheus_dir=None, profile_interval=None):
+    """Collect metrics for one run and write its report (and textfile/profile) on exit, even on failure."""
+    report_dir = METRICS_CONFIG["REPORT_DIR"] if report_dir is None else report_dir
+    prometheus_dir = METRICS_CONFIG["PROMETHEUS_TEXTFILE_DIR"] if prometheus_dir is None else prometheus_dir
+    profile_interval = METRICS_CONFIG["PROFILE_INTERVAL"] if profile_interval is None else profile_interval
+
+    metrics = StageMetrics(pipeline)
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    profiler = SamplingProfiler(profile_interval).start() if profile_interval else None
+    status, error = "success", None
+    try:
+        with activate(metrics):
+            yield metrics
+    except BaseException as e:
+        status, error = "failed", f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        report = build_report(metrics, started_at, time.perf_counter() - start, status, error)
+        stamp = started_at.strftime("%Y%m%dT%H%M%S")
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+            report_path = os.path.join(report_dir, f"{pipeline}-{stamp}.json")
+            _write_atomic(report_path, json.dumps(report, indent=2))
+            logging.info(f"Run report written to {report_path}")
+            if profiler is not None:
+                profiler.write_collapsed(os.path.join(report_dir, f"{pipeline}-{stamp}.folded"))
+        if prometheus_dir:
+            os.makedirs(prometheus_dir, exist_ok=True)
+            _write_atomic(os.path.join(prometheus_dir, f"etl_{pipeline}.prom"), prometheus_text(report))
+        logging.info(
+            f"{pipeline} {status} in {report['wall_seconds']}s: "
+            + ", ".join(f"{name}={v['total_seconds']}s" for name, v in report["stages"].items())
+        )
@@ -0,0 +1,358 @@
+"""Observations: Postgres ``fhir_staging`` -> BigQuery ``observations``.
+
+Importable, streaming version of ``etl_observations.ipynb``. The notebook's
+unnamed cursor made psycopg2 pull the whole ``observations_fhir_raw`` result
+into client memory before the first ``fetchmany``, and every batch became a
+list of row dicts and then a pandas DataFrame. Here:
+
+* rows come from a named (server-side) cursor, ``ITERSIZE`` rows per round
+  trip, in ``id`` order past the last committed id; with ``SHARDS`` > 1 the
+  ``id`` space is cut into ranges read concurrently instead
+  (``sharded_source.fetch_id_range_batches``), each resuming on its own,
+* only the top-level keys the transform reads (``RESOURCE_PATHS``) are
+  sent, projected server-side (``staging_source.postgres_resource_projection``),
+* ``transform_observations`` appends each resource straight into typed
+  per-column lists (``ObservationColumns``) and returns an Arrow record
+  batch, which is loaded as Parquet,
+* fetch, transform and load overlap through ``etl_run.run_curated``, so the
+  run gets the same load manager, profile, adaptive batches and unchanged
+  skipping as the EOB pipelines (``ObservationScan`` is its source),
+* each observation carries ``obs_code_key``, a stable key into the code
+  dimension; codes not seen before are appended to it after the run
+  (``code_dictionary``).
+
+Memory is bounded by ``ITERSIZE`` plus the in-flight batches, whatever the
+table size. The incremental position is the staging ``id``: rows re-staged
+in place (``ON_CONFLICT="overwrite"``) keep their id, so reset the
+checkpoint to pick them up.
+"""
+import json
+import logging
+from functools import partial
+
+from code_dictionary import CodeDomain, code_key
+from bq_session import get_session, session_for
+from etl_metrics import current_metrics
+from etl_run import run_curated
+from fhir_fields import interned, load_resource, text
+from fhir_staging_loader import get_connection
+from load_manager import CompletedJob, LoadManager
+from parquet_sink import TABLE_SCHEMAS, ColumnBuffer, submit_record_batch_load, write_record_batch_local
+from sharded_source import fetch_id_range_batches, id_range_hooks, plan_id_ranges
+from staging_source import postgres_resource_projection
+
+# --------------------
+# Configuration
+# --------------------
+OBS_CONFIG = {
+    "PG_SCHEMA": "fhir_staging_sample",
+    "PG_TABLE": "observations_fhir_raw",
+    "BQ_PROJECT": "fhir-synthea-data",
+    "BQ_DATASET_CURATED": "fhir_curated_sample",
+    "BQ_TABLE_CURATED": "observations",
+    "BATCH_SIZE": 10000,
+    "ADAPTIVE_BATCHES": True,  # resize batches from measured Arrow bytes, starting at BATCH_SIZE (see adaptive_batcher.py)
+    "ITERSIZE": 5000,  # rows per server-side cursor round trip
+    "SHARDS": 1,  # > 1 reads that many id ranges concurrently, BATCH_SIZE rows per query (see sharded_source.py)
+    "CODE_DICTIONARY": True,  # record new codes and append them to the code dimension (see code_dictionary.py)
+    "INCREMENTAL": True,
+    "CHECKPOINT_PATH": "etl_checkpoints.db",
+    "COALESCE_LOADS": True,  # buffer batches into fewer, larger load jobs (see load_manager.LOAD_CONFIG)
+    "SKIP_UNCHANGED": True,  # skip observations whose fingerprint matches the last loaded version (see fingerprints.py)
+    "FINGERPRINT_PATH": "etl_fingerprints.db",
+    "PROFILE": True,  # plan workers/batches from a row count and the last profile, and profile the run (see etl_profile.py)
+    "SINK": "parquet",  # "parquet" (load job) or "local" (Parquet files on disk)
+    "LOCAL_SINK_DIR": "curated_parquet",
+    "KEY_PATH": "/keys/bq_key.json",
+}
+
+bq_session = get_session(OBS_CONFIG["BQ_PROJECT"], OBS_CONFIG["KEY_PATH"])
+
+# --------------------
+# Fetch from Postgres staging
+# --------------------
+# Top-level resource keys ObservationColumns.append reads; the scan projects only these
+RESOURCE_PATHS = [
+    "status", "code", "subject", "encounter", "effectiveDateTime",
+    "valueQuantity", "valueString", "valueCodeableConcept", "valueDateTime", "valuePeriod",
+]
+
+
+def stream_staged_observations(conn, after_id=None, itersize=None, paths=RESOURCE_PATHS):
+    """Yield ``(id, observation_id, resource_json)`` from a named server-side cursor, in ``id`` order."""
+    with conn.cursor(name="etl_observations_scan") as cur:
+        cur.itersize = itersize or OBS_CONFIG["ITERSIZE"]
+        cur.execute(
+            f"SELECT id, observation_id, {postgres_resource_projection(paths)} "
+            f"FROM {OBS_CONFIG['PG_SCHEMA']}.{OBS_CONFIG['PG_TABLE']} "
+            f"WHERE id > %s ORDER BY id",
+            (after_id or 0,),
+        )
+        yield from cur
+
+
+def fetch_observation_batches(batch_size=None, conn=None, after_id=None, itersize=None, batcher=None,
+                              paths=RESOURCE_PATHS):
+    """Lists of ``batch_size`` ``{"id", "resource_id", "resource"}`` staging rows, in ``id`` order.
+
+    A connection is opened (and closed) when none is given. With an
+    ``adaptive_batcher.AdaptiveBatcher`` as ``batcher``, it decides where each batch is cut.
+    """
+    batch_size = batch_size or OBS_CONFIG["BATCH_SIZE"]
+    close_conn = conn is None
+    conn = conn or get_connection()
+    try:
+        batch = []
+        resource_bytes = 0
+        for row_id, observation_id, resource in stream_staged_observations(conn, after_id, itersize, paths):
+            batch.append({"id": row_id, "resource_id": observation_id, "resource": resource})
+            resource_bytes += len(resource or "")
+            full = len(batch) >= batch_size if batcher is None else batcher.full(len(batch), resource_bytes)
+            if full:
+                yield batch
+                batch = []
+                resource_bytes = 0
+        if batch:
+            yield batch
+    finally:
+        if close_conn:
+            conn.close()
+
+
+class ObservationScan:
+    """The Postgres observations staging table as an ``etl_run.run_curated`` source.
+
+    Positions are staging ``id`` values (see ``etl_run.StagingScan`` for the interface). With
+    ``shards`` > 1 the id space is read as that many ranges, each on its own ``connect()``
+    connection and checkpointed on its own (``sharded_source.id_range_hooks``); the adaptive
+    batcher does not cut those batches, which are ``batch_size`` rows per keyset query.
+    """
+
+    id_key = "resource_id"
+
+    def __init__(self, conn=None, connect=None, batch_size=None, shards=None, paths=RESOURCE_PATHS):
+        self.conn = conn
+        self.connect = connect or get_connection
+        self.batch_size = batch_size or OBS_CONFIG["BATCH_SIZE"]
+        self.shards = shards or OBS_CONFIG["SHARDS"]
+        self.paths = paths
+        self.schema = OBS_CONFIG["PG_SCHEMA"]
+        self.table = OBS_CONFIG["PG_TABLE"]
+
+    def hooks(self, store, names):
+        """``(positions, since, batch_token, on_commit)`` for the one checkpoint in ``names``."""
+        if len(names) != 1:
+            raise ValueError(f"An observations run advances one checkpoint, got {names}")
+        pipeline = names[0]
+        if self.shards > 1:
+            since, batch_token, on_commit = id_range_hooks(
+                store, pipeline, self.connect, self.schema, self.table, self.shards
+            )
+            return {pipeline: since}, since, batch_token, on_commit
+        mark = store.get_watermark(pipeline)
+        since = int(mark) if mark else None
+
+        def on_commit(seq, last_id, rows_out):
+            # Zero-padded so the stored position compares correctly as a string
+            store.advance_watermark(pipeline, f"{last_id:020d}")
+
+        return {pipeline: since}, since, lambda batch: batch[-1]["id"], on_commit
+
+    def _with_conn(self, fn):
+        conn = self.conn or self.connect()
+        try:
+            return fn(conn)
+        finally:
+            if self.conn is None:
+                conn.close()
+
+    def count(self, since=None):
+        """Rows a scan from ``since`` (an id, or ``{shard: (after, upto)}`` ranges) reads."""
+        ranges = since.values() if isinstance(since, dict) else [(since or 0, None)]
+
+        def count(conn):
+            total = 0
+            with conn.cursor() as cur:
+                for after, upto in ranges:
+                    upper = " AND id <= %s" if upto is not None else ""
+                    cur.execute(
+                        f"SELECT count(*) FROM {self.schema}.{self.table} WHERE id > %s{upper}",
+                        (after, upto) if upto is not None else (after,),
+                    )
+                    total += cur.fetchone()[0]
+            return total
+
+        return self._with_conn(count)
+
+    def batches(self, since=None, ordered=False, batcher=None):
+        if self.shards > 1:
+            ranges = since
+            if not isinstance(ranges, dict):
+                # Not resuming: ranges planned for this scan only
+                ranges = dict(enumerate(self._with_conn(
+                    lambda conn: plan_id_ranges(conn, self.schema, self.table, self.shards)
+                )))
+            return fetch_id_range_batches(
+                self.connect, self.schema, self.table, "observation_id", ranges, self.batch_size, self.paths
+            )
+        return self._scan(since, batcher)
+
+    def _scan(self, since, batcher):
+        conn = self.conn or self.connect()
+        try:
+            yield from fetch_observation_batches(self.batch_size, conn, since, batcher=batcher, paths=self.paths)
+        finally:
+            if self.conn is None:
+                conn.close()
+
+# --------------------
+# Transform into typed columns
+# --------------------
+def _reference_id(reference):
+    """``urn:uuid:<id>`` -> ``<id>``: the text after the last ":", as the notebook stored it.
+
+    Relative references such as ``Patient/<id>`` are kept whole.
+    """
+    if not reference:
+        return None
+    return text(reference).split(":")[-1]
+
+
+def _codings(concept):
+    """``(system, code, display)`` tuples, interned: the same few codes repeat across a batch."""
+    return [
+        (interned(c.get("system")), interned(c.get("code")), interned(c.get("display")))
+        for c in (concept.get("coding") or []) if isinstance(c, dict)
+    ]
+
+
+class ObservationColumns(ColumnBuffer):
+    """Column lists for a batch of curated observation rows, in ``TABLE_SCHEMAS["observations"]`` order."""
+
+    def __init__(self, load_timestamp=None):
+        super().__init__(TABLE_SCHEMAS["observations"], load_timestamp)
+
+    def append(self, observation_id, resource):
+        c = self.columns
+        code = resource.get("code") or {}
+        codings = _codings(code)
+
+        value_numeric = unit = value_text = None
+        value_codings = []
+        if "valueQuantity" in resource:
+            quantity = resource["valueQuantity"]
+            value_numeric = quantity.get("value")
+            value_numeric = float(value_numeric) if value_numeric is not None else None
+            unit = interned(quantity.get("unit"))
+        elif "valueString" in resource:
+            value_text = text(resource["valueString"])
+        elif "valueCodeableConcept" in resource:
+            concept = resource["valueCodeableConcept"]
+            value_text = text(concept.get("text"))
+            value_codings = _codings(concept)
+        elif "valueDateTime" in resource:
+            value_text = text(resource["valueDateTime"])
+        elif "valuePeriod" in resource:
+            value_text = json.dumps(resource["valuePeriod"])
+
+        status = interned(resource.get("status"))
+        code_text = text(code.get("text"))
+        patient_id = _reference_id((resource.get("subject") or {}).get("reference"))
+        encounter_id = _reference_id((resource.get("encounter") or {}).get("reference"))
+        effective = text(resource.get("effectiveDateTime"))
+        obs_code_key = code_key(codings[0][0], codings[0][1]) if codings else None
+
+        # Everything that can raise (including a value of the wrong type for its column) is computed
+        # above, so a bad resource is dropped whole and never leaves a partial row
+        c["observation_id"].append(observation_id)
+        c["status"].append(status)
+        c["obs_code"].append(codings[0][1] if codings else None)
+        c["system"].append(codings[0][0] if codings else None)
+        c["obs_code_text"].append(code_text)
+        c["codings"].append(codings)
+        c["value_numeric"].append(value_numeric)
+        c["value_text"].append(value_text)
+        c["unit"].append(unit)
+        c["value_codings"].append(value_codings)
+        c["patient_id"].append(patient_id)
+        c["encounter_id"].append(encounter_id)
+        c["effective_datetime"].append(effective)
+        c["obs_code_key"].append(obs_code_key)
+
+
+# Code dimension domains found in the observations record batches
+OBSERVATION_CODE_DOMAINS = {
+    "observation_code": CodeDomain("obs_code_key", "system", "obs_code", "obs_code_text"),
+}
+
+
+def transform_observations(rows):
+    """Arrow record batch of curated observations for a batch of staging rows."""
+    columns = ObservationColumns()
+    failed = 0
+    for row in rows:
+        observation_id, resource = row["resource_id"], row["resource"]
+        try:
+            resource = load_resource(resource)
+            if isinstance(resource, dict):
+                columns.append(observation_id, resource)
+        except Exception as e:
+            failed += 1
+            logging.error(f"Failed to transform observation {observation_id}: {type(e).__name__} - {e}")
+    if failed:
+        current_metrics().add("transform_errors", failed)
+    logging.info(f"Transformed {columns.rows} observations in this batch")
+    return columns.to_record_batch()
+
+# --------------------
+# Load into BigQuery
+# --------------------
+def submit_observations_load(record_batch, job_id=None, client=None):
+    table = OBS_CONFIG["BQ_TABLE_CURATED"]
+    if OBS_CONFIG["SINK"] == "local":
+        write_record_batch_local(record_batch, OBS_CONFIG["LOCAL_SINK_DIR"], table)
+        return CompletedJob()
+    session = bq_session if client is None else session_for(client)
+    table_id = f"{OBS_CONFIG['BQ_PROJECT']}.{OBS_CONFIG['BQ_DATASET_CURATED']}.{table}"
+    return submit_record_batch_load(session.client, record_batch, table_id, job_id=job_id)
+
+
+def load_observations(record_batch, client=None):
+    submit_observations_load(record_batch, client=client).result()
+    logging.info(f"Loaded {record_batch.num_rows} records into {OBS_CONFIG['BQ_TABLE_CURATED']}")
+
+
+def make_load_manager(client=None):
+    """A LoadManager coalescing transformed batches into fewer load jobs on the observations table."""
+    client = client or bq_session.client
+    return LoadManager(
+        partial(submit_observations_load, client=client),
+        name=OBS_CONFIG["BQ_TABLE_CURATED"],
+        lookup_job=getattr(client, "get_job", None),
+    )
+
+# --------------------
+# Run pipeline
+# --------------------
+def run_pipeline(client=None, conn=None, incremental=None, checkpoints=None, connect=None, **pipeline_options):
+    """Stream, transform and load the staged observations; see etl_run.run_curated for the options.
+
+    In incremental mode only rows past the last committed staging ``id`` (per id range with
+    ``SHARDS`` > 1) are read, and the position advances as each batch commits. ``conn`` is used
+    for an unsharded scan; otherwise connections come from ``connect`` (default
+    ``fhir_staging_loader.get_connection``).
+    """
+    if OBS_CONFIG["SINK"] != "local":
+        client = client or bq_session.client
+    source = ObservationScan(conn=conn, connect=connect)
+    return run_curated(
+        OBS_CONFIG, OBS_CONFIG["BQ_TABLE_CURATED"], partial(load_observations, client=client),
+        transform_observations, client=client, incremental=incremental, checkpoints=checkpoints,
+        paths=RESOURCE_PATHS, make_load_manager=make_load_manager, code_domains=OBSERVATION_CODE_DOMAINS,
+        source=source, **pipeline_options,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_pipeline()
@@ -0,0 +1,268 @@
+"""Pipelined fetch -> transform -> load executor shared by the EOB ETL scripts.
+
+Three stages overlap instead of running in strict sequence:
+
+* a fetch thread pulls source batches and hands them over as they arrive,
+* a process pool runs ``transform`` on several batches at once,
+* a loader thread pool keeps several load jobs in flight.
+
+Backpressure comes from a single budget of in-flight batches: the fetch
+thread blocks once ``prefetch + workers + max_inflight_loads`` batches are
+somewhere in the pipeline, and a slot is only freed when a batch commits.
+
+In ordered mode loads are submitted and commits reported in source order,
+which is what a watermark/checkpoint needs. Unordered mode submits and
+commits in completion order for maximum throughput.
+
+With a ``load_manager`` (see ``load_manager.py``) the load stage is handed
+over to it: transformed batches are buffered and coalesced into fewer,
+larger load jobs, and the manager reports back which source batches have
+landed.
+
+Every stage is timed into an ``etl_metrics.StageMetrics`` (by default the
+active run's collector): ``fetch`` (waiting on the source iterator),
+``backpressure_wait`` (fetch blocked on a full pipeline), ``transform``,
+``load``, plus ``rows_in``/``rows_out``/``batches``/``loads`` counters.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from etl_metrics import current_metrics, measured_call
+
+PIPELINE_CONFIG = {
+    "PREFETCH_BATCHES": 2,
+    "TRANSFORM_WORKERS": os.cpu_count() or 1,
+    "MAX_INFLIGHT_LOADS": 4,
+    "ORDERED_COMMIT": True,
+}
+
+_FETCHED = "fetched"
+_FETCH_DONE = "fetch_done"
+_TRANSFORMED = "transformed"
+_LOADED = "loaded"
+_FAILED = "failed"
+
+
+class PipelineError(RuntimeError):
+    """Raised when a stage fails; ``seq`` is the 1-based source batch number, if known."""
+
+    def __init__(self, stage, seq, cause):
+        super().__init__(f"{stage} failed for batch {seq}: {type(cause).__name__} - {cause}")
+        self.stage = stage
+        self.seq = seq
+        self.cause = cause
+
+
+def _fetch_worker(batches, events, slots, stop, batch_token, metrics):
+    seq = 0
+    try:
+        batches = iter(batches)
+        while True:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            if batch is None:
+                break
+            metrics.observe("fetch", time.perf_counter() - start)
+            metrics.add("rows_in", len(batch))
+
+            start = time.perf_counter()
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            metrics.observe("backpressure_wait", time.perf_counter() - start)
+            if stop.is_set():
+                return
+            seq += 1
+            events.put((_FETCHED, seq, (batch, batch_token(batch))))
+        events.put((_FETCH_DONE, seq, None))
+    except Exception as e:
+        events.put((_FAILED, seq + 1, PipelineError("fetch", seq + 1, e)))
+
+
+def _relay(events, stage, seq, done_kind, value):
+    """Future callback that turns a stage result (or failure) into a coordinator event."""
+    def callback(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            events.put((_FAILED, seq, PipelineError(stage, seq, error)))
+        else:
+            events.put((done_kind, seq, value(future.result())))
+    return callback
+
+
+def _merge_into(metrics):
+    def unwrap(result):
+        rows, snapshot = result
+        metrics.merge(snapshot)
+        return rows
+    return unwrap
+
+
+def _timed_load(load, rows, metrics):
+    with metrics.time("load"):
+        return load(rows)
+
+
+def run_pipelined(batches, transform, load, prefetch=None, workers=None, max_inflight_loads=None,
+                  ordered=None, on_commit=None, batch_token=len, row_count=len, metrics=None,
+                  load_manager=None, on_transformed=None):
+    """Run ``load(transform(batch))`` for every batch of ``batches`` with the three stages overlapped.
+
+    ``transform`` must be picklable (a module-level function) when ``workers`` > 0; ``workers=0``
+    runs transforms inline in the coordinating thread. Empty transform output is committed without
+    calling ``load``. ``on_commit(seq, token, rows_out)`` is called from the coordinating thread once
+    a batch has loaded, where ``token = batch_token(batch)`` is computed at fetch time so the
+    source batch itself does not need to be kept around. ``row_count`` measures a transform result
+    (for outputs that are not a flat list of rows). ``on_transformed(batch, result)`` is called
+    from the coordinating thread as each transform finishes, e.g. to feed an
+    ``adaptive_batcher.AdaptiveBatcher``; the batch is then held until its transform is done.
+    Timings go to ``metrics``, or to ``etl_metrics.current_metrics()`` when it is None.
+
+    With ``load_manager`` set, ``load`` is not used: transformed batches go to ``load_manager.add``,
+    the manager is flushed once the source is exhausted, and a batch commits when the manager
+    reports it loaded. A batch's fetch slot is freed at hand-over, since the manager bounds its
+    own buffer.
+
+    Returns a dict of counters: ``batches``, ``rows_out`` and ``loads``.
+    """
+    prefetch = PIPELINE_CONFIG["PREFETCH_BATCHES"] if prefetch is None else prefetch
+    workers = PIPELINE_CONFIG["TRANSFORM_WORKERS"] if workers is None else workers
+    max_inflight_loads = PIPELINE_CONFIG["MAX_INFLIGHT_LOADS"] if max_inflight_loads is None else max_inflight_loads
+    ordered = PIPELINE_CONFIG["ORDERED_COMMIT"] if ordered is None else ordered
+    metrics = current_metrics() if metrics is None else metrics
+
+    events = queue.Queue()
+    slots = threading.Semaphore(max(1, prefetch + workers + max_inflight_loads))
+    stop = threading.Event()
+    fetcher = threading.Thread(
+        target=_fetch_worker, args=(batches, events, slots, stop, batch_token, metrics),
+        name="etl-fetch", daemon=True,
+    )
+
+    transform_pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    load_pool = None
+    if load_manager is None:
+        load_pool = ThreadPoolExecutor(max_workers=max(1, max_inflight_loads), thread_name_prefix="etl-load")
+    else:
+        load_manager.bind(
+            on_loaded=lambda seq, n: events.put((_LOADED, seq, n)),
+            on_failed=lambda seq, e: events.put((_FAILED, seq, PipelineError("load", seq, e))),
+        )
+
+    tokens = {}
+    pending = {}      # seq -> source batch awaiting its transform, kept for on_transformed
+    ready = {}        # seq -> transformed rows waiting for their turn to load (ordered mode)
+    loaded = {}       # seq -> rows_out waiting for their turn to commit (ordered mode)
+    next_load = 1
+    next_commit = 1
+    fetched = 0
+    fetch_done = False
+    committed = 0
+    submitted = 0     # batches whose transform output has gone to the load stage
+    flushed = False
+    released = set()  # seqs whose fetch slot was already freed at hand-over to the load manager
+    stats = {"batches": 0, "rows_out": 0, "loads": 0}
+
+    def submit_load(seq, rows):
+        nonlocal submitted
+        submitted += 1
+        n = row_count(rows)
+        if not n:
+            events.put((_LOADED, seq, 0))
+            return
+        if load_manager is not None:
+            load_manager.add(seq, rows)
+            released.add(seq)
+            slots.release()
+            return
+        stats["loads"] += 1
+        future = load_pool.submit(_timed_load, load, rows, metrics)
+        future.add_done_callback(_relay(events, "load", seq, _LOADED, lambda _: n))
+
+    def commit(seq, rows_out):
+        nonlocal committed
+        committed += 1
+        stats["batches"] += 1
+        stats["rows_out"] += rows_out
+        token = tokens.pop(seq)
+        if seq in released:
+            released.discard(seq)
+        else:
+            slots.release()
+        metrics.add("batches")
+        metrics.add("rows_out", rows_out)
+        if on_commit is not None:
+            on_commit(seq, token, rows_out)
+        logging.info(f"Batch {seq} processed successfully ({rows_out} rows)")
+
+    fetcher.start()
+    try:
+        while not (fetch_done and committed == fetched):
+            if load_manager is not None and not flushed and fetch_done and submitted == fetched:
+                # Everything fetched has been transformed and handed over: push out the partial buffer
+                load_manager.flush()
+                flushed = True
+            kind, seq, payload = events.get()
+
+            if kind == _FAILED:
+                raise payload
+
+            if kind == _FETCH_DONE:
+                fetch_done = True
+
+            elif kind == _FETCHED:
+                batch, tokens[seq] = payload
+                fetched += 1
+                if on_transformed is not None:
+                    pending[seq] = batch
+                if transform_pool is None:
+                    try:
+                        with metrics.time("transform"):
+                            rows = transform(batch)
+                    except Exception as e:
+                        raise PipelineError("transform", seq, e) from e
+                    events.put((_TRANSFORMED, seq, rows))
+                else:
+                    # Worker processes cannot see this collector; their measurements ride back with the rows
+                    future = transform_pool.submit(measured_call, "transform", transform, batch)
+                    future.add_done_callback(_relay(events, "transform", seq, _TRANSFORMED, _merge_into(metrics)))
+
+            elif kind == _TRANSFORMED:
+                if on_transformed is not None:
+                    on_transformed(pending.pop(seq), payload)
+                if not ordered:
+                    submit_load(seq, payload)
+                    continue
+                ready[seq] = payload
+                while next_load in ready:
+                    submit_load(next_load, ready.pop(next_load))
+                    next_load += 1
+
+            elif kind == _LOADED:
+                if not ordered:
+                    commit(seq, payload)
+                    continue
+                loaded[seq] = payload
+                while next_commit in loaded:
+                    commit(next_commit, loaded.pop(next_commit))
+                    next_commit += 1
+    finally:
+        stop.set()
+        if transform_pool is not None:
+            transform_pool.shutdown(wait=True, cancel_futures=True)
+        if load_pool is not None:
+            load_pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            # On success every job has already finished; on failure queued jobs are dropped
+            load_manager.close(wait=False)
+        fetcher.join(timeout=5)
+
+    if load_manager is not None:
+        stats["loads"] = load_manager.stats["jobs"]
+    return stats
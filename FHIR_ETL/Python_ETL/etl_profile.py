@@ -0,0 +1,257 @@
+"""Streaming data profiles of the curated EOB runs, and run planning from them.
+
+``estimate_coverage_count`` used to parse every staged EOB in Python before
+the real run, only to print a count. Profiling now happens inside the run:
+
+* before the scan, the run's source counts the rows to read server-side
+  (``staging_source.count_staging_rows`` references only ``load_timestamp``,
+  so this is not a second scan of the resources),
+* during the run, ``StreamProfile`` sees each transformed batch through
+  ``run_pipelined``'s ``on_transformed`` hook: source rows and bytes, output
+  rows and bytes, null counts per output column, and a HyperLogLog sketch of
+  the distinct codes of each ``code_dictionary.CodeDomain``. Fan-out per EOB
+  (items or coverages per EOB) is counted by the transforms into an
+  ``etl_metrics`` histogram, which also works from worker processes,
+* after the run, the profile is logged and saved as
+  ``PROFILE_CONFIG["DIR"]/<pipeline>.json``.
+
+``plan_run`` turns the row count and the last saved profile into the next
+run's sizing: no worker processes when the expected source bytes are small,
+otherwise one per ``BYTES_PER_WORKER`` up to the configured maximum. The
+profile's output-per-byte ratios also seed the ``AdaptiveBatcher``, so the
+first batches are already the right size.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import Counter
+
+import pyarrow.compute as pc
+
+from adaptive_batcher import output_size, source_size
+from code_dictionary import domain_columns
+from etl_metrics import current_metrics
+from etl_pipeline import PIPELINE_CONFIG
+
+PROFILE_CONFIG = {
+    "DIR": "etl_profiles",
+    "HLL_PRECISION": 12,                # 2**12 registers: about 1.6% error on distinct counts
+    "SMALL_RUN_BYTES": 16 * 2**20,      # expected source bytes below which transforms run inline
+    "BYTES_PER_WORKER": 64 * 2**20,     # expected source bytes per transform worker process
+}
+
+
+# --------------------
+# Distinct counts
+# --------------------
+class HyperLogLog:
+    """Approximate distinct count of 63-bit hashes (e.g. ``code_dictionary.code_key`` values)."""
+
+    _BITS = 63
+
+    def __init__(self, precision=None):
+        self.precision = PROFILE_CONFIG["HLL_PRECISION"] if precision is None else precision
+        self.registers = bytearray(1 << self.precision)
+
+    def add_hash(self, value):
+        rest_bits = self._BITS - self.precision
+        index = value >> rest_bits
+        rank = rest_bits - (value & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, value):
+        """Add any value by the hash of its text."""
+        digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+        self.add_hash(int.from_bytes(digest, "big") >> 1)
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+
+def histogram_summary(histogram):
+    """Mean, percentiles and max of a ``{value: occurrences}`` histogram."""
+    counts = sorted((int(value), n) for value, n in histogram.items())
+    total = sum(n for _, n in counts)
+    if not total:
+        return {"count": 0}
+    summary = {"count": total, "mean": round(sum(v * n for v, n in counts) / total, 3), "max": counts[-1][0]}
+    for label, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        seen = 0
+        for value, n in counts:
+            seen += n
+            if seen >= q * total:
+                summary[label] = value
+                break
+    summary["histogram"] = {str(value): n for value, n in counts}
+    return summary
+
+
+# --------------------
+# Streaming profile
+# --------------------
+class StreamProfile:
+    """Statistics of one run, accumulated from its transformed batches.
+
+    ``domains`` maps names to ``CodeDomain`` columns whose distinct keys are sketched; ``fanout``
+    names the ``etl_metrics`` histogram the transform records output rows per EOB into. A result
+    may be one record batch or a dict of them (the fan-out); null counts are then kept per
+    ``"<name>.<column>"``.
+    """
+
+    def __init__(self, pipeline, domains=None, fanout=None, precision=None):
+        self.pipeline = pipeline
+        self.domains = domains or {}
+        self.fanout = fanout
+        self.sketches = {name: HyperLogLog(precision) for name in self.domains}
+        self.eobs = 0
+        self.source_bytes = 0
+        self.rows = 0
+        self.output_bytes = 0
+        self.nulls = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, batch, result):
+        source_bytes = source_size(batch)
+        results = result.items() if isinstance(result, dict) else [(None, result)]
+        nulls = {}
+        keys = {}
+        for prefix, record_batch in results:
+            for name, column in zip(record_batch.schema.names, record_batch.columns):
+                nulls[name if prefix is None else f"{prefix}.{name}"] = column.null_count
+            for name, domain in self.domains.items():
+                columns = domain_columns(record_batch, domain, ("key",))
+                if columns is not None:
+                    keys.setdefault(name, []).extend(pc.unique(columns[0]).drop_null().to_pylist())
+        rows, output_bytes = output_size(result)
+        with self._lock:
+            self.eobs += len(batch)
+            self.source_bytes += source_bytes
+            self.rows += rows
+            self.output_bytes += output_bytes
+            self.nulls.update(nulls)
+            for name, values in keys.items():
+                sketch = self.sketches[name]
+                for value in values:
+                    sketch.add_hash(value)
+
+    def summary(self, metrics=None):
+        """The profile as a plain dict; the fan-out histogram is read from ``metrics`` (default: current)."""
+        metrics = current_metrics() if metrics is None else metrics
+        with self._lock:
+            summary = {
+                "pipeline": self.pipeline,
+                "eobs": self.eobs,
+                "source_bytes": self.source_bytes,
+                "rows": self.rows,
+                "output_bytes": self.output_bytes,
+                "null_rates": {
+                    name: round(n / self.rows, 4) if self.rows else None for name, n in self.nulls.items()
+                },
+                "distinct_codes": {name: sketch.count() for name, sketch in self.sketches.items()},
+            }
+        if self.fanout:
+            summary["fanout"] = histogram_summary(metrics.histogram(self.fanout))
+        return summary
+
+
+def profile_path(pipeline, profile_dir=None):
+    return os.path.join(PROFILE_CONFIG["DIR"] if profile_dir is None else profile_dir, f"{pipeline}.json")
+
+
+def load_profile(pipeline, profile_dir=None):
+    """The last saved profile of ``pipeline``, or None."""
+    try:
+        with open(profile_path(pipeline, profile_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_profile(summary, profile_dir=None):
+    path = profile_path(summary["pipeline"], profile_dir)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+# --------------------
+# Planning
+# --------------------
+def plan_run(eobs, previous=None, max_workers=None, batch_size=None):
+    """Worker count and batch seeding for a run over ``eobs`` staging rows.
+
+    ``previous`` is the last saved profile. Without one, only a run that fits in a single batch of
+    ``batch_size`` is kept inline; otherwise the configured worker count is left alone.
+    """
+    max_workers = PIPELINE_CONFIG["TRANSFORM_WORKERS"] if max_workers is None else max_workers
+    plan = {"eobs": eobs}
+    if not previous or not previous.get("eobs") or not previous.get("source_bytes"):
+        if batch_size is not None and eobs <= batch_size:
+            plan["workers"] = 0
+        return plan
+    expected = eobs * previous["source_bytes"] / previous["eobs"]
+    plan["expected_source_bytes"] = int(expected)
+    plan["expected_rows"] = int(eobs * previous["rows"] / previous["eobs"])
+    if expected < PROFILE_CONFIG["SMALL_RUN_BYTES"]:
+        plan["workers"] = 0
+    else:
+        plan["workers"] = max(1, min(max_workers, math.ceil(expected / PROFILE_CONFIG["BYTES_PER_WORKER"])))
+    plan["rows_per_byte"] = previous["rows"] / previous["source_bytes"]
+    plan["bytes_per_byte"] = previous["output_bytes"] / previous["source_bytes"]
+    return plan
+
+
+def profile_run(pipeline_options, pipeline, eobs, domains=None, fanout=None, batcher=None, batch_size=None):
+    """Plan a run over ``eobs`` staging rows from the last profile, and attach a ``StreamProfile``.
+
+    ``eobs`` is the source's pushdown row count (e.g. ``etl_run.StagingScan.count``). ``workers``
+    is only set when the caller did not choose it. ``batcher`` (an ``AdaptiveBatcher``) is seeded
+    from the last profile. An ``on_transformed`` already in the options is still called.
+    """
+    plan = plan_run(eobs, load_profile(pipeline), pipeline_options.get("workers"), batch_size)
+    if "workers" in plan and pipeline_options.get("workers") is None:
+        pipeline_options["workers"] = plan["workers"]
+    if batcher is not None and "rows_per_byte" in plan:
+        batcher.seed(plan["rows_per_byte"], plan["bytes_per_byte"])
+    logging.info(f"Run plan for {pipeline}: {plan}")
+
+    profile = StreamProfile(pipeline, domains, fanout)
+    previous = pipeline_options.get("on_transformed")
+
+    def on_transformed(batch, result):
+        profile.observe(batch, result)
+        if previous is not None:
+            previous(batch, result)
+
+    pipeline_options["on_transformed"] = on_transformed
+    return profile
+
+
+def finish_profile(profile, metrics=None):
+    """Log and save ``profile`` once its run has finished; returns the summary."""
+    summary = profile.summary(metrics)
+    if summary["eobs"]:
+        path = save_profile(summary)
+        logging.info(f"Profile of {profile.pipeline} written to {path}")
+    fanout = {k: v for k, v in summary.get("fanout", {}).items() if k != "histogram"}
+    logging.info(
+        f"{profile.pipeline} profile: {summary['eobs']} EOBs -> {summary['rows']} rows, "
+        f"fan-out {fanout}, distinct codes {summary['distinct_codes']}"
+    )
+    return summary
@@ -0,0 +1,167 @@
+"""The wiring of a curated run, shared by every pipeline over a staging table.
+
+``EOBS_etl``, ``etl_eob_items_coverage`` and ``eob_fanout`` differ in their
+transform, their load and the tables they feed; ``etl_observations`` reads
+a Postgres staging table instead (its own ``source``, see ``StagingScan``).
+``run_curated`` builds the rest of the run around
+``etl_pipeline.run_pipelined`` from the caller's config dict:
+
+* ``INCREMENTAL``: resume from the checkpoint positions in
+  ``CHECKPOINT_PATH``, per shard when ``SHARDS`` > 1 (see
+  ``incremental_hooks``),
+* ``COALESCE_LOADS``: hand transformed batches to a ``LoadManager``,
+* ``ADAPTIVE_BATCHES``: size batches from the observed output, starting at
+  ``BATCH_SIZE``,
+* ``CODE_DICTIONARY``: append codings not seen before to the code dimension
+  after the load,
+* ``PROFILE``: plan the run from a pushdown row count and the last profile,
+  and profile it as it goes,
+* ``SKIP_UNCHANGED``: drop resources whose fingerprint in ``FINGERPRINT_PATH``
+  matches the version last loaded into the table(s).
+
+Materializing the warehouse facts stays with each module's ``__main__``.
+"""
+import logging
+
+import staging_source
+from adaptive_batcher import pipeline_batcher
+from code_dictionary import emit_new_codes, track_codes
+from etl_checkpoint import CheckpointStore, earliest_position, watermark_hooks
+from etl_metrics import instrumented_run
+from etl_pipeline import run_pipelined
+from etl_profile import finish_profile, profile_run
+from fingerprints import skip_unchanged
+from sharded_source import fetch_sharded_batches, shard_watermark_hooks
+
+
+def incremental_hooks(store, names, shards=1, until=None):
+    """Return ``(positions, since, batch_token, on_commit)`` for an ordered scan feeding several checkpoints.
+
+    ``positions`` maps each of ``names`` to its stored position (``{shard: position}`` when
+    ``shards`` > 1). The scan starts from the earliest of them, per shard, and every checkpoint
+    advances as a batch commits, so one scan can feed tables that were last run separately.
+    ``until`` is passed on to ``sharded_source.shard_watermark_hooks``.
+    """
+    if shards > 1:
+        hooks = {name: shard_watermark_hooks(store, name, shards, until=until) for name in names}
+    else:
+        hooks = {name: watermark_hooks(store, name) for name in names}
+    positions = {name: since for name, (since, _, _) in hooks.items()}
+    if shards > 1:
+        since = {
+            shard: earliest_position(marks[shard] for marks in positions.values()) for shard in range(shards)
+        }
+    else:
+        since = earliest_position(positions.values())
+    commits = [commit for _, _, commit in hooks.values()]
+
+    def on_commit(seq, token, rows_out):
+        for commit in commits:
+            commit(seq, token, rows_out)
+
+    _, batch_token, _ = next(iter(hooks.values()))
+    return positions, since, batch_token, on_commit
+
+
+class StagingScan:
+    """The BigQuery EOB staging table as a run's source, read from ``(load_timestamp, eob_id)`` positions.
+
+    A source gives ``run_curated`` the checkpoint hooks of its positions (``hooks``), a pushdown
+    count of the rows a scan from a position reads (``count``), the scan itself (``batches``) and
+    the row key holding the resource id (``id_key``), used by the fingerprints.
+    """
+
+    id_key = "eob_id"
+
+    def __init__(self, config, client=None, paths=None):
+        self.client = client
+        self.table_id = staging_source.staging_table_id(config)
+        self.batch_size = config["BATCH_SIZE"]
+        self.shards = config["SHARDS"]
+        self.paths = paths
+
+    def hooks(self, store, names):
+        """``incremental_hooks`` for ``names``; returns ``(positions, since, batch_token, on_commit)``."""
+        # Shards that run out of rows catch up to the staging high-water mark read before the scan
+        until = staging_source.staging_high_water(self.client, self.table_id) if self.shards > 1 else None
+        return incremental_hooks(store, names, self.shards, until=until)
+
+    def count(self, since=None):
+        """Rows a scan from ``since`` reads; each shard is counted from its own position."""
+        if isinstance(since, dict):
+            return sum(
+                staging_source.count_staging_rows(self.client, self.table_id, since=mark, shard=(shard, len(since)))
+                for shard, mark in since.items()
+            )
+        return staging_source.count_staging_rows(self.client, self.table_id, since=since)
+
+    def batches(self, since=None, ordered=False, batcher=None):
+        if self.shards > 1:
+            return fetch_sharded_batches(
+                self.client, self.table_id, self.batch_size, self.shards, since=since, ordered=ordered,
+                paths=self.paths, batcher=batcher,
+            )
+        return staging_source.fetch_staging_batches(
+            self.client, self.table_id, self.batch_size, since=since, ordered=ordered, paths=self.paths,
+            batcher=batcher,
+        )
+
+
+def run_curated(config, pipeline, load, transform=None, client=None, incremental=None, checkpoints=None,
+                paths=None, make_load_manager=None, code_domains=None, fanout=None, checkpoint_names=None,
+                make_transform=None, checkpoint_paths=None, source=None, **pipeline_options):
+    """Run ``load(transform(batch))`` over a staging table with the features enabled in ``config``.
+
+    ``pipeline`` names the run's report and profile; ``checkpoint_names`` (default
+    ``[pipeline]``) are the checkpoints it resumes from and advances, and its fingerprint scopes.
+    ``paths`` are the resource keys the transform reads; ``checkpoint_paths`` maps each checkpoint
+    to the keys its own table is built from, when they differ (the fan-out's sinks).
+    ``make_load_manager(client)`` builds the LoadManager used with ``COALESCE_LOADS``; without it
+    batches are loaded one by one. ``code_domains`` and ``fanout`` go to the code dictionary and
+    the profile. A transform that needs each
+    checkpoint's position is built by ``make_transform(positions)`` instead (see
+    ``incremental_hooks``). ``source`` defaults to the ``StagingScan`` of ``config`` and
+    ``paths``. Other options go to ``etl_pipeline.run_pipelined``.
+    """
+    incremental = config["INCREMENTAL"] if incremental is None else incremental
+    source = source or StagingScan(config, client, paths)
+    names = checkpoint_names or [pipeline]
+    positions = {name: None for name in names}
+    since = None
+    if incremental:
+        checkpoints = checkpoints or CheckpointStore(config["CHECKPOINT_PATH"])
+        positions, since, batch_token, on_commit = source.hooks(checkpoints, names)
+        pipeline_options.update(ordered=True, batch_token=batch_token, on_commit=on_commit)
+        logging.info(f"{pipeline}: incremental run from position > {since}")
+    if config["COALESCE_LOADS"] and make_load_manager is not None:
+        pipeline_options.setdefault("load_manager", make_load_manager(client))
+    batcher = pipeline_batcher(pipeline_options, config["BATCH_SIZE"]) if config["ADAPTIVE_BATCHES"] else None
+    codes = track_codes(pipeline_options, code_domains or {}) if config["CODE_DICTIONARY"] else None
+    profile = None
+    if config["PROFILE"]:
+        profile = profile_run(
+            pipeline_options, pipeline, source.count(since), domains=code_domains, fanout=fanout,
+            batcher=batcher, batch_size=config["BATCH_SIZE"],
+        )
+    batches = source.batches(since, ordered=incremental, batcher=batcher)
+    if config["SKIP_UNCHANGED"]:
+        # Fingerprints are kept per checkpoint, over that table's keys, so every run feeding it shares them
+        scopes = {name: (checkpoint_paths or {}).get(name, paths) for name in names}
+        batches = skip_unchanged(batches, config["FINGERPRINT_PATH"], scopes, pipeline_options, source.id_key)
+    if make_transform is not None:
+        transform = make_transform(positions)
+
+    with instrumented_run(pipeline):
+        stats = run_pipelined(batches, transform, load, **pipeline_options)
+        if profile is not None:
+            finish_profile(profile)
+    if batcher is not None:
+        logging.info(f"Adaptive batches: {batcher.stats()}")
+    if codes is not None:
+        local_dir = config["LOCAL_SINK_DIR"] if config["SINK"] == "local" else None
+        try:
+            emit_new_codes(codes, client, local_dir=local_dir)
+        finally:
+            codes.close()
+    logging.info(f"{pipeline} finished: {stats}")
+    return stats
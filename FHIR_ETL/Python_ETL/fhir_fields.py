@@ -0,0 +1,268 @@
+"""Declarative FHIR field extraction.
+
+Field specs are dotted paths such as ``"productOrService.coding[0].code"``.
+A spec dict is compiled once into a plain Python function, so per-row cost
+is a handful of dict lookups instead of hand-written ``.get()`` chains.
+
+FHIR exports are loose about cardinality (``category`` may be a dict or a
+list of dicts, ``sequence`` may be a scalar or a one-element list), so the
+compiled code treats a list as its first element when a key is looked up,
+and a dict as a one-element list when an index is taken.
+
+They are loose about scalar types too (``"sequence": "1"``, numeric codes).
+The converters ``integer``, ``text`` and ``interned`` coerce what has an
+obvious reading and raise ``TypeError``/``ValueError`` for the rest, so a
+bad element fails in its own transform instead of in the typed Arrow batch.
+"""
+import json
+import re
+import sys
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional; stdlib json gives the same result, just slower
+    _json_loads = json.loads
+
+_TOKEN_RE = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+class Field:
+    """A scalar field: one or more paths (first non-null wins) plus an optional converter."""
+
+    __slots__ = ("paths", "convert")
+
+    def __init__(self, paths, convert=None):
+        self.paths = (paths,) if isinstance(paths, str) else tuple(paths)
+        self.convert = convert
+
+
+class Derived:
+    """A field computed from several specs: ``func(value_1, ..., value_n)``, each value ``None`` when missing.
+
+    Each spec is a path or a tuple of fallback paths, as for :class:`Field`.
+    """
+
+    __slots__ = ("specs", "func")
+
+    def __init__(self, specs, func):
+        self.specs = tuple((spec,) if isinstance(spec, str) else tuple(spec) for spec in specs)
+        self.func = func
+
+
+class Repeated:
+    """A list-of-struct field: every element under ``path`` is extracted with ``fields``."""
+
+    __slots__ = ("path", "fields")
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+
+
+def integer(value):
+    """An INT64 field: ints, integral floats and digit strings become ``int``; anything else raises."""
+    if value.__class__ is int or value is None:
+        return value
+    if isinstance(value, str):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    raise TypeError(f"Expected an integer, got {type(value).__name__}: {value!r}")
+
+
+def text(value):
+    """A STRING field: strings pass, numbers become their text; anything else raises."""
+    if value.__class__ is str or value is None:
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise TypeError(f"Expected a string, got {type(value).__name__}: {value!r}")
+
+
+def interned(value):
+    """``text``, then ``sys.intern``: a converter for low-cardinality string fields."""
+    if value.__class__ is str:
+        return sys.intern(value)
+    value = text(value)
+    return sys.intern(value) if value is not None else None
+
+
+def load_resource(resource):
+    """Parse a staged ``resource`` column (JSON text) into a dict; dicts pass through unchanged."""
+    if isinstance(resource, (str, bytes)):
+        return _json_loads(resource)
+    return resource
+
+
+# --------------------
+# Path parsing
+# --------------------
+def parse_path(spec):
+    """Split ``"a.b[0].c"`` into ``[("key", "a"), ("key", "b"), ("idx", 0), ("key", "c")]``."""
+    steps = []
+    pos = 0
+    for match in _TOKEN_RE.finditer(spec):
+        between = spec[pos:match.start()]
+        if between not in ("", "."):
+            raise ValueError(f"Invalid field spec: {spec!r}")
+        key, idx = match.groups()
+        steps.append(("key", key) if key is not None else ("idx", int(idx)))
+        pos = match.end()
+    if pos != len(spec) or not steps:
+        raise ValueError(f"Invalid field spec: {spec!r}")
+    return steps
+
+
+def _normalize(value):
+    if isinstance(value, (Field, Derived, Repeated)):
+        return value
+    return Field(value)
+
+
+# --------------------
+# Code generation
+# --------------------
+class _Node:
+    __slots__ = ("keys", "idx", "leaves")
+
+    def __init__(self):
+        self.keys = {}
+        self.idx = {}
+        self.leaves = []
+
+
+class _Compiler:
+    def __init__(self):
+        self.namespace = {}
+        self.lines = []
+        self.leaf_vars = []
+        self.post = []
+        self._counter = 0
+
+    def name(self, prefix):
+        self._counter += 1
+        return f"{prefix}{self._counter}"
+
+    def bind(self, obj, prefix):
+        name = self.name(prefix)
+        self.namespace[name] = obj
+        return name
+
+    def add_path(self, root, spec, leaf):
+        node = root
+        for kind, value in parse_path(spec):
+            if kind == "idx" and value == 0:
+                # Key lookups and scalar leaves already take the first element of a list
+                continue
+            table = node.keys if kind == "key" else node.idx
+            node = table.setdefault(value, _Node())
+        node.leaves.append(leaf)
+
+    def emit(self, node, var, depth):
+        pad = "    " * depth
+        for leaf_var, sub in node.leaves:
+            if sub is None:
+                self.lines.append(f"{pad}{leaf_var} = ({var}[0] if {var} else None) if {var}.__class__ is list else {var}")
+            else:
+                self.lines.append(
+                    f"{pad}{leaf_var} = [{sub}(x) for x in {var} if x.__class__ is dict] if {var}.__class__ is list "
+                    f"else ([{sub}({var})] if {var}.__class__ is dict else [])"
+                )
+        if node.keys:
+            obj = self.name("d")
+            self.lines.append(f"{pad}{obj} = ({var}[0] if {var} else None) if {var}.__class__ is list else {var}")
+            self.lines.append(f"{pad}if {obj}.__class__ is dict:")
+            for key, child in node.keys.items():
+                child_var = self.name("n")
+                self.lines.append(f"{pad}    {child_var} = {obj}.get({key!r})")
+                self.lines.append(f"{pad}    if {child_var} is not None:")
+                self.emit(child, child_var, depth + 2)
+        for index, child in node.idx.items():
+            child_var = self.name("n")
+            self.lines.append(f"{pad}if {var}.__class__ is list:")
+            self.lines.append(f"{pad}    {child_var} = {var}[{index}] if len({var}) > {index} else None")
+            self.lines.append(f"{pad}else:")
+            self.lines.append(f"{pad}    {child_var} = {var if index == 0 else None}")
+            self.lines.append(f"{pad}if {child_var} is not None:")
+            self.emit(child, child_var, depth + 1)
+
+    def first_of(self, root, paths):
+        """Expression for the first non-null of ``paths``."""
+        alternatives = []
+        for path in paths:
+            leaf_var = self.name("v")
+            self.add_path(root, path, (leaf_var, None))
+            self.leaf_vars.append(leaf_var)
+            alternatives.append(leaf_var)
+        expr = alternatives[-1]
+        for alt in reversed(alternatives[:-1]):
+            expr = f"({alt} if {alt} is not None else {expr})"
+        return expr
+
+    def build(self, fields, single=False, shape="tuple"):
+        root = _Node()
+        outputs = []
+        for out_name, value in fields.items():
+            value = _normalize(value)
+            if isinstance(value, Repeated):
+                leaf_var = self.name("v")
+                sub = self.bind(_Compiler().build(value.fields), "_sub")
+                self.add_path(root, value.path, (leaf_var, sub))
+                self.leaf_vars.append(leaf_var)
+                outputs.append((out_name, f"{leaf_var} if {leaf_var} is not None else []"))
+                continue
+
+            if isinstance(value, Derived):
+                func = self.bind(value.func, "_func")
+                args = ", ".join(self.first_of(root, paths) for paths in value.specs)
+                outputs.append((out_name, f"{func}({args})"))
+                continue
+
+            expr = self.first_of(root, value.paths)
+            if value.convert is not None:
+                conv = self.bind(value.convert, "_conv")
+                result = self.name("r")
+                self.post.append(f"    {result} = {expr}")
+                expr = f"({conv}({result}) if {result} is not None else None)"
+            outputs.append((out_name, expr))
+
+        body = []
+        for leaf_var in self.leaf_vars:
+            body.append(f"    {leaf_var} = None")
+        self.emit(root, "obj", 1)
+        body.extend(self.lines)
+        body.extend(self.post)
+        signature = "obj"
+        if single:
+            body.append(f"    return {outputs[0][1]}")
+        elif shape == "columns":
+            # Every value is computed before the first append, so a failing converter leaves no partial row
+            signature = "obj, append"
+            body.extend(f"    c{i} = {expr}" for i, (_, expr) in enumerate(outputs))
+            body.extend(f"    append[{i}](c{i})" for i in range(len(outputs)))
+        else:
+            body.append(f"    return ({''.join(f'{expr}, ' for _, expr in outputs)})")
+
+        source = f"def extract({signature}):\n" + "\n".join(body) + "\n"
+        exec(compile(source, "<fhir_fields>", "exec"), self.namespace)
+        extract = self.namespace["extract"]
+        extract.__source__ = source
+        return extract
+
+
+def compile_columns(fields):
+    """Compile ``{output_name: spec}`` into ``extract(obj, append)``, which appends one row's values.
+
+    Each spec is a path string, a :class:`Field`, a :class:`Derived` or a :class:`Repeated`. Paths
+    sharing a prefix are walked once, and missing or mistyped nodes yield ``None`` (``[]`` for
+    repeated fields). ``append`` is a sequence of callables (e.g. ``list.append`` of per-column
+    lists) in ``fields`` order; each receives that field's value. Repeated fields yield lists of
+    tuples in their sub-field order, which Arrow accepts for struct values.
+    """
+    return _Compiler().build(fields, shape="columns")
+
+
+def compile_path(spec, convert=None):
+    """Compile a single path (or tuple of fallback paths) into a function returning its value."""
+    return _Compiler().build({"value": Field(spec, convert)}, single=True)
@@ -0,0 +1,469 @@
+"""Load Synthea FHIR bundles into the Postgres ``fhir_staging`` tables.
+
+Importable version of the loader in ``FHIR_Staging_to_postgres.ipynb``.
+Instead of ``json.load``-ing a whole bundle and building every row before
+the first COPY, bundles are read incrementally: ``iter_bundle_entries``
+decodes ``entry[]`` one element at a time from fixed-size text chunks,
+resources are routed through ``FHIR_STAGING_MAP`` into per-table buffers,
+and a buffer is COPYed as soon as it reaches ``FLUSH_ROWS`` rows or
+``FLUSH_BYTES`` bytes. Peak memory is bounded by the buffer thresholds
+plus the largest single entry, whatever the bundle size.
+
+Each file is committed once, after its last flush, so the processed-files
+checkpoint only ever lists files that landed completely.
+
+Rows are COPYed into a temp table and merged into the staging table with
+``ON CONFLICT``, so re-loading an overlapping export neither fails nor
+duplicates. ``ON_CONFLICT`` decides what happens to an id that is already
+staged: ``skip`` it, ``overwrite`` it, or ``overwrite_if_changed`` (only
+when the resource differs, so unchanged rows keep their load_timestamp).
+``error`` restores the plain COPY, which fails on the first duplicate.
+
+    python fhir_staging_loader.py <folder>
+"""
+import csv
+import glob
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional, json is the fallback
+    orjson = None
+
+logger = logging.getLogger("fhir_staging_loader")
+
+# -----------------------------
+# Configuration
+# -----------------------------
+DB_CONFIG = {
+    "host": os.environ.get("FHIR_STAGING_HOST", "localhost"),
+    "port": int(os.environ.get("FHIR_STAGING_PORT", 5432)),
+    "database": os.environ.get("FHIR_STAGING_DB", "FHIR_staging"),
+    "user": os.environ.get("FHIR_STAGING_USER", "postgres"),
+    "password": os.environ.get("FHIR_STAGING_PASSWORD", "new_password"),
+}
+
+LOADER_CONFIG = {
+    "SCHEMA": "fhir_staging_sample",
+    "READ_CHUNK_CHARS": 1 << 20,      # text read from a bundle per refill
+    "MAX_VALUE_CHARS": 1 << 28,       # largest single entry (JSON value) a bundle may hold
+    "FLUSH_ROWS": 5000,               # per-table buffer size that triggers a COPY
+    "FLUSH_BYTES": 32 * 2**20,        # ... or serialized resource bytes, whichever comes first
+    "MAX_WORKERS": 8,
+    "FILES_PER_WORKER": 50,
+    "CHECKPOINT_FILE": "processed_files.json",
+    "ON_CONFLICT": "skip",            # duplicate ids: "skip", "overwrite", "overwrite_if_changed" or "error"
+}
+
+# FHIR resource → staging table mapping
+FHIR_STAGING_MAP = {
+    "Practitioner": ("practitioners_fhir_raw", "practitioner_id"),
+    "PractitionerRole": ("practitioner_roles_fhir_raw", "practitioner_role_id"),
+    "Patient": ("patients_fhir_raw", "patients_id"),
+    "Encounter": ("encounters_fhir_raw", "encounter_id"),
+    "Observation": ("observations_fhir_raw", "observation_id"),
+    "Condition": ("conditions_fhir_raw", "condition_id"),
+    "Claim": ("claims_fhir_raw", "claim_id"),
+    "DiagnosticReport": ("diagnostics_fhir_raw", "diagnostic_id"),
+    "DocumentReference": ("document_references_fhir_raw", "document_reference_id"),
+    "ExplanationOfBenefit": ("explanationofbenefits_fhir_raw", "explanationofbenefit_id"),
+    "CarePlan": ("careplans_fhir_raw", "careplan_id"),
+    "Immunization": ("immunizations_fhir_raw", "immunization_id"),
+    "Device": ("devices_fhir_raw", "device_id"),
+    "SupplyDelivery": ("supplydeliveries_fhir_raw", "supplydelivery_id"),
+    "Medication": ("medications_fhir_raw", "medication_id"),
+    "MedicationRequest": ("medicationrequests_fhir_raw", "medicationrequest_id"),
+    "MedicationAdministration": ("medicationadministrations_fhir_raw", "medicationadministration_id"),
+    "ImagingStudy": ("imagingstudies_fhir_raw", "imagingstudy_id"),
+    "Procedure": ("procedures_fhir_raw", "procedure_id"),
+    "Organization": ("organizations_fhir_raw", "organization_id"),
+    "Provenance": ("provenances_fhir_raw", "provenance_id"),
+    "CareTeam": ("careteams_fhir_raw", "careteam_id"),
+    "AllergyIntolerance": ("allergyintolerances_fhir_raw", "allergyintolerance_id"),
+}
+TABLE_TO_TYPE = {table: rtype for rtype, (table, _) in FHIR_STAGING_MAP.items()}
+
+
+def get_connection():
+    import psycopg2
+
+    return psycopg2.connect(**DB_CONFIG)
+
+
+def dump_resource(resource):
+    if orjson is not None:
+        return orjson.dumps(resource).decode()
+    return json.dumps(resource, separators=(",", ":"), ensure_ascii=False)
+
+
+# -----------------------------
+# Streaming bundle parser
+# -----------------------------
+_WHITESPACE = " \t\n\r"
+_TOKEN_TAIL = 8  # a decode error this close to the window's end may be a token cut by the chunk edge
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class _ChunkedText:
+    """A sliding window over a text file, refilled on demand."""
+
+    def __init__(self, fp, chunk_chars, max_value_chars=None):
+        self.fp = fp
+        self.chunk_chars = chunk_chars
+        self.max_value_chars = LOADER_CONFIG["MAX_VALUE_CHARS"] if max_value_chars is None else max_value_chars
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, at_least=0):
+        """Read one more chunk (or ``at_least`` chars); returns False at end of file."""
+        if self.eof:
+            return False
+        if self.pos > len(self.buf) // 2:
+            # Drop the consumed prefix so the window stays bounded
+            self.buf, self.pos = self.buf[self.pos:], 0
+        data = self.fp.read(max(self.chunk_chars, at_least))
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self):
+        """Next non-whitespace character (without consuming it), or '' at end of file."""
+        while True:
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Malformed bundle: expected {char!r}, found {found!r} at offset {self.pos}")
+        self.pos += 1
+
+    def value(self, decoder=json.JSONDecoder()):
+        """Decode the next complete JSON value, reading more text until it is complete.
+
+        Raises the decode error once more text cannot help: the error is not at the window's end
+        (malformed JSON), the file has ended, or the value exceeds ``max_value_chars``.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                cut = e.msg.startswith("Unterminated string") or e.pos >= len(self.buf) - _TOKEN_TAIL
+                if not cut:
+                    raise
+                if len(self.buf) - self.pos > self.max_value_chars:
+                    raise ValueError(
+                        f"Malformed bundle: value at offset {self.pos} exceeds {self.max_value_chars} chars"
+                    ) from e
+                # Incomplete value: grow the window geometrically so re-decoding stays linear overall
+                if not self.fill(at_least=len(self.buf) - self.pos):
+                    raise
+                continue
+            if (
+                isinstance(value, (int, float)) and not self.buf[end:].lstrip(_NUMBER_CHARS)
+                and not self.eof and self.fill()
+            ):
+                # A bare number may have been cut at the chunk boundary (``2`` of ``2.5e3``); decode again
+                continue
+            self.pos = end
+            return value
+
+
+def iter_bundle_entries(fp, chunk_chars=None):
+    """Yield the elements of a bundle's top-level ``entry`` array one at a time.
+
+    Other top-level members (``resourceType``, ``type``, ...) are decoded and discarded. Only one
+    entry is held in memory at a time, plus the read window.
+    """
+    reader = _ChunkedText(fp, chunk_chars or LOADER_CONFIG["READ_CHUNK_CHARS"])
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "entry" and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == "]":
+                        reader.pos += 1
+                        break
+                    reader.expect(",")
+        else:
+            reader.value()
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
+
+
+def iter_staging_rows(fp, skipped=None, chunk_chars=None):
+    """Yield ``(table, id_field, resource_id, resource)`` for every routable resource in a bundle.
+
+    Entries without a resource, type or id are dropped; unmapped resource types are counted in
+    ``skipped`` (a Counter) when given.
+    """
+    for entry in iter_bundle_entries(fp, chunk_chars):
+        resource = entry.get("resource") if isinstance(entry, dict) else None
+        if not resource:
+            continue
+        rtype = resource.get("resourceType")
+        rid = resource.get("id")
+        if not rtype or not rid:
+            continue
+        target = FHIR_STAGING_MAP.get(rtype)
+        if target is None:
+            if skipped is not None:
+                skipped[rtype] += 1
+            continue
+        yield target[0], target[1], rid, resource
+
+
+# -----------------------------
+# Per-table buffers
+# -----------------------------
+class TableBuffers:
+    """Serialized rows per staging table, flushed through ``flush(table, id_field, rows)``."""
+
+    def __init__(self, flush, flush_rows=None, flush_bytes=None):
+        self.flush = flush
+        self.flush_rows = LOADER_CONFIG["FLUSH_ROWS"] if flush_rows is None else flush_rows
+        self.flush_bytes = LOADER_CONFIG["FLUSH_BYTES"] if flush_bytes is None else flush_bytes
+        self.rows = {}
+        self.sizes = Counter()
+        self.flushed = Counter()   # table -> rows flushed so far
+
+    def add(self, table, id_field, rid, resource_json):
+        rows = self.rows.setdefault((table, id_field), [])
+        rows.append((rid, resource_json))
+        self.sizes[table] += len(resource_json)
+        if len(rows) >= self.flush_rows or self.sizes[table] >= self.flush_bytes:
+            self.flush_table(table, id_field)
+
+    def flush_table(self, table, id_field):
+        rows = self.rows.pop((table, id_field), None)
+        self.sizes.pop(table, None)
+        if rows:
+            self.flush(table, id_field, rows)
+            self.flushed[table] += len(rows)
+
+    def flush_all(self):
+        for table, id_field in list(self.rows):
+            self.flush_table(table, id_field)
+
+
+# -----------------------------
+# COPY and merge
+# -----------------------------
+# Rows are COPYed into a session temp table and merged from there, so one duplicate id does not
+# abort the whole COPY. Within a batch the last occurrence of an id wins.
+LOAD_TABLE = "_staging_load"
+CONFLICT_ACTIONS = {
+    "skip": "DO NOTHING",
+    "overwrite": "DO UPDATE SET resource = EXCLUDED.resource, load_timestamp = now()",
+    "overwrite_if_changed": (
+        "DO UPDATE SET resource = EXCLUDED.resource, load_timestamp = now() "
+        "WHERE {table}.resource IS DISTINCT FROM EXCLUDED.resource"
+    ),
+}
+
+
+def merge_sql(schema, table, id_field, on_conflict):
+    if on_conflict not in CONFLICT_ACTIONS:
+        raise ValueError(f"Unknown ON_CONFLICT mode {on_conflict!r}; expected one of {sorted(CONFLICT_ACTIONS)} or 'error'")
+    return (
+        f"INSERT INTO {schema}.{table} ({id_field}, resource) "
+        f"SELECT id_value, resource FROM {LOAD_TABLE} "
+        f"WHERE seq IN (SELECT max(seq) FROM {LOAD_TABLE} GROUP BY id_value) "
+        f"ON CONFLICT ({id_field}) {CONFLICT_ACTIONS[on_conflict].format(table=table)}"
+    )
+
+
+def copy_payload(conn, table, id_field, payload, copy_format="csv", schema=None, on_conflict=None,
+                 written_ids=None):
+    """COPY an encoded ``(id, resource)`` payload (file-like) into ``schema.table``; the caller commits.
+
+    With ``on_conflict="error"`` the rows are COPYed straight into the table and a duplicate id fails
+    the COPY. Returns the number of rows inserted or updated. ``written_ids`` (a set), when given, is
+    updated with the ids the merge wrote; under ``"error"`` every row is written and none are listed.
+    """
+    schema = schema or LOADER_CONFIG["SCHEMA"]
+    on_conflict = on_conflict or LOADER_CONFIG["ON_CONFLICT"]
+    with conn.cursor() as cur:
+        if on_conflict == "error":
+            cur.copy_expert(f"COPY {schema}.{table} ({id_field}, resource) FROM STDIN WITH (FORMAT {copy_format})", payload)
+            return cur.rowcount
+        sql = merge_sql(schema, table, id_field, on_conflict)
+        cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {LOAD_TABLE} "
+            f"(seq BIGSERIAL PRIMARY KEY, id_value TEXT, resource JSONB) ON COMMIT DELETE ROWS"
+        )
+        cur.copy_expert(f"COPY {LOAD_TABLE} (id_value, resource) FROM STDIN WITH (FORMAT {copy_format})", payload)
+        if written_ids is None:
+            cur.execute(sql)
+            merged = cur.rowcount
+        else:
+            cur.execute(f"{sql} RETURNING {id_field}")
+            written = [row[0] for row in cur.fetchall()]
+            written_ids.update(written)
+            merged = len(written)
+        cur.execute(f"TRUNCATE {LOAD_TABLE}")
+    return merged
+
+
+def copy_rows(conn, table, id_field, rows, schema=None, on_conflict=None):
+    """COPY ``(id, resource_json)`` rows into ``schema.table`` as CSV; the caller commits."""
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_MINIMAL).writerows(rows)
+    buffer.seek(0)
+    merged = copy_payload(conn, table, id_field, buffer, "csv", schema, on_conflict)
+    if merged < len(rows):
+        logger.info(f"{len(rows) - merged} of {len(rows)} {table} rows already staged, left unchanged")
+    return len(rows)
+
+
+# -----------------------------
+# Process one bundle file
+# -----------------------------
+def process_file(file_path, conn=None):
+    """Stream one bundle into the staging tables; returns counts per resourceType, or None on failure."""
+    close_conn = conn is None
+    conn = conn or get_connection()
+    skipped = Counter()
+    buffers = TableBuffers(lambda table, id_field, rows: copy_rows(conn, table, id_field, rows))
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            for table, id_field, rid, resource in iter_staging_rows(f, skipped):
+                buffers.add(table, id_field, rid, dump_resource(resource))
+        buffers.flush_all()
+        conn.commit()  # commit once per file
+
+        inserted_summary = {TABLE_TO_TYPE[table]: n for table, n in buffers.flushed.items()}
+        if skipped:
+            logger.warning(f"Skipped unsupported resourceTypes in {os.path.basename(file_path)}: {dict(skipped)}")
+        logger.info(f"Processed {os.path.basename(file_path)}: {inserted_summary}")
+        return inserted_summary
+
+    except Exception as e:
+        logger.error(f"Failed to process {file_path}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if close_conn:
+            conn.close()
+
+
+def process_file_chunk(file_chunk):
+    """Process a chunk of files on one connection; returns (counts, files that committed)."""
+    chunk_counters = Counter()
+    done = []
+    conn = get_connection()
+    try:
+        for file_path in file_chunk:
+            result = process_file(file_path, conn=conn)
+            if result is not None:
+                chunk_counters.update(result)
+                done.append(file_path)
+    finally:
+        conn.close()
+    return chunk_counters, done
+
+
+# -----------------------------
+# Checkpoint of processed files
+# -----------------------------
+def load_checkpoint(path=None):
+    """Load the set of processed files safely."""
+    path = path or LOADER_CONFIG["CHECKPOINT_FILE"]
+    if not os.path.exists(path):
+        return set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        logger.warning(f"{path} is corrupted. Starting fresh.")
+        return set()
+    if not isinstance(data, list):
+        logger.warning(f"{path} is not a list. Starting fresh.")
+        return set()
+    return set(data)
+
+
+def save_checkpoint(processed_files, path=None):
+    """Save the set of processed files, replacing the old checkpoint atomically."""
+    path = path or LOADER_CONFIG["CHECKPOINT_FILE"]
+    temp_file = tempfile.NamedTemporaryFile(
+        delete=False, mode="w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(path))
+    )
+    try:
+        json.dump(sorted(processed_files), temp_file, indent=2)
+        temp_file.close()
+        shutil.move(temp_file.name, path)
+    except Exception as e:
+        logger.error(f"Failed to save checkpoint: {e}")
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+
+# -----------------------------
+# Folder processing with threads
+# -----------------------------
+def chunk_files(file_list, chunk_size):
+    """Split list of files into chunks of given size."""
+    for i in range(0, len(file_list), chunk_size):
+        yield file_list[i:i + chunk_size]
+
+
+def process_folder(folder_path, max_workers=None, files_per_worker=None):
+    max_workers = max_workers or LOADER_CONFIG["MAX_WORKERS"]
+    files_per_worker = files_per_worker or LOADER_CONFIG["FILES_PER_WORKER"]
+    files = [os.path.abspath(f) for f in glob.glob(os.path.join(folder_path, "*.json"))]
+    if not files:
+        logger.info("No files found.")
+        return Counter()
+
+    processed_files = load_checkpoint()
+    remaining_files = [f for f in files if f not in processed_files]
+    logger.info(f"Starting processing {len(remaining_files)} files...")
+
+    totals = Counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_file_chunk, chunk) for chunk in chunk_files(remaining_files, files_per_worker)]
+        for future in as_completed(futures):
+            try:
+                counts, done = future.result()
+            except Exception as e:
+                logger.error(f"Error processing chunk: {e}")
+                continue
+            totals.update(counts)
+            processed_files.update(done)
+            save_checkpoint(processed_files)
+
+    logger.info(f"All files processed. Totals by resourceType: {dict(totals)}")
+    return totals
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    process_folder(sys.argv[1])
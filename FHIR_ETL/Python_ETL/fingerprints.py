@@ -0,0 +1,197 @@
+"""Content fingerprints for skipping resources that have not changed.
+
+A resource's fingerprint is a 128-bit BLAKE2b digest of its canonical JSON
+(``orjson`` with sorted keys), so it does not depend on key order or
+whitespace in the source. ``FingerprintIndex`` keeps the fingerprint of the
+last version that was successfully loaded, per scope (a staging table or a
+curated pipeline) and resource id, in a local SQLite file.
+
+Fingerprints are recorded only after the rows they cover have committed,
+so a failed load is retried on the next run rather than skipped. If the
+target is truncated or rebuilt, ``reset`` its scope (or delete the file).
+"""
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from etl_metrics import current_metrics
+from fhir_fields import load_resource
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional, json is the fallback
+    orjson = None
+
+DIGEST_SIZE = 16
+_LOOKUP_CHUNK = 500  # ids per IN (...) lookup, below SQLite's host parameter limit
+
+
+def canonical_json(resource):
+    """Canonical JSON bytes of a parsed resource: sorted keys, no whitespace."""
+    if orjson is not None:
+        return orjson.dumps(resource, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(resource, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def fingerprint(canonical):
+    return hashlib.blake2b(canonical, digest_size=DIGEST_SIZE).digest()
+
+
+def resource_fingerprint(resource, paths=None):
+    """Fingerprint of a resource given as a dict or as JSON text, or of its top-level ``paths`` only."""
+    resource = load_resource(resource)
+    if paths is not None and isinstance(resource, dict):
+        resource = {key: resource[key] for key in paths if key in resource}
+    return fingerprint(canonical_json(resource))
+
+
+class FingerprintIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                scope TEXT NOT NULL,
+                resource_id TEXT NOT NULL,
+                digest BLOB NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (scope, resource_id)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def unchanged(self, scope, items):
+        """Ids among ``items`` (``(resource_id, digest)`` pairs) whose digest matches the recorded one."""
+        digests = dict(items)
+        ids = list(digests)
+        found = set()
+        with self._lock:
+            for i in range(0, len(ids), _LOOKUP_CHUNK):
+                chunk = ids[i:i + _LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT resource_id, digest FROM fingerprints WHERE scope = ? "
+                    f"AND resource_id IN ({', '.join('?' * len(chunk))})",
+                    (scope, *chunk),
+                ).fetchall()
+                found.update(rid for rid, digest in rows if digests[rid] == digest)
+        return found
+
+    def record(self, scope, items):
+        """Store ``(resource_id, digest)`` pairs as the last loaded versions."""
+        if not items:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.executemany("""
+                INSERT INTO fingerprints (scope, resource_id, digest, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (scope, resource_id) DO UPDATE
+                    SET digest = excluded.digest, updated_at = excluded.updated_at
+            """, [(scope, rid, digest, now) for rid, digest in items])
+            self._conn.commit()
+
+    def reset(self, scope=None):
+        """Forget one scope (or everything) so the next run reloads it in full."""
+        with self._lock:
+            if scope is None:
+                self._conn.execute("DELETE FROM fingerprints")
+            else:
+                self._conn.execute("DELETE FROM fingerprints WHERE scope = ?", (scope,))
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class ChangeTracker:
+    """Drops staging rows whose resource is unchanged from a source of batches for ``run_pipelined``.
+
+    ``hooks`` wraps the batch iterator and the pipeline's ``batch_token``/``on_commit``: the inner
+    token is still computed on the full batch (so a watermark moves past skipped rows too), and a
+    batch's fingerprints are recorded when it commits.
+
+    ``scope`` may also map several scopes to the top-level resource keys each one's table is built
+    from (None for the whole resource), one per table a run feeds (the fan-out's sinks). Each scope
+    fingerprints only its own keys, so the fan-out and a table's own run, which project different
+    keys, agree on what is unchanged. A row is dropped only if it is unchanged in every scope; a
+    kept row lists the scopes it is unchanged in under ``row["unchanged"]``, so the transform can
+    skip those tables.
+    """
+
+    def __init__(self, index, scope, id_key="eob_id"):
+        self.index = index
+        self.scopes = {scope: None} if isinstance(scope, str) else dict(scope)
+        self.id_key = id_key
+        self._last = None
+
+    def _digests(self, batch):
+        """``{scope: [(resource_id, digest)]}``; each distinct set of keys is fingerprinted once."""
+        if len(self.scopes) == 1:
+            (scope, paths), = self.scopes.items()
+            return {scope: [(row[self.id_key], resource_fingerprint(row["resource"], paths)) for row in batch]}
+        resources = [load_resource(row["resource"]) for row in batch]
+        by_paths = {}
+        for paths in self.scopes.values():
+            key = None if paths is None else tuple(paths)
+            if key not in by_paths:
+                by_paths[key] = [
+                    (row[self.id_key], resource_fingerprint(resource, paths))
+                    for row, resource in zip(batch, resources)
+                ]
+        return {
+            scope: by_paths[None if paths is None else tuple(paths)] for scope, paths in self.scopes.items()
+        }
+
+    def filter(self, batches, batch_token=len):
+        metrics = current_metrics()
+        for batch in batches:
+            with metrics.time("fingerprint"):
+                digests = self._digests(batch)
+                unchanged = {scope: self.index.unchanged(scope, digests[scope]) for scope in self.scopes}
+                # A copy keeps the batch's type and attributes, e.g. a ShardBatch's shard
+                kept = copy.copy(batch)
+                kept[:] = []
+                for row in batch:
+                    skipped = frozenset(scope for scope in self.scopes if row[self.id_key] in unchanged[scope])
+                    if len(skipped) == len(self.scopes):
+                        continue
+                    if skipped:
+                        row = {**row, "unchanged": skipped}
+                    kept.append(row)
+            metrics.add("rows_unchanged", len(batch) - len(kept))
+            changed = {scope: [d for d in digests[scope] if d[0] not in ids] for scope, ids in unchanged.items()}
+            self._last = (batch_token(batch), changed)
+            yield kept
+
+    def hooks(self, batches, batch_token=None, on_commit=None):
+        """Return ``(batches, batch_token, on_commit)`` to pass to ``run_pipelined``."""
+        def tracked_token(batch):
+            # run_pipelined computes the token right after fetching, i.e. for the batch just yielded
+            return self._last
+
+        def tracked_commit(seq, token, rows_out):
+            token, changed = token
+            for scope, digests in changed.items():
+                self.index.record(scope, digests)
+            if on_commit is not None:
+                on_commit(seq, token, rows_out)
+
+        return self.filter(batches, batch_token or len), tracked_token, tracked_commit
+
+
+def skip_unchanged(batches, path, scope, pipeline_options, id_key="eob_id"):
+    """Filter a ``run_pipelined`` source through a ChangeTracker on the index at ``path``.
+
+    ``scope`` is one scope or a ``{scope: paths}`` dict (see ``ChangeTracker``).
+
+    ``pipeline_options``' ``batch_token``/``on_commit`` are wrapped in place; returns the filtered batches.
+    """
+    tracker = ChangeTracker(FingerprintIndex(path), scope, id_key)
+    batches, pipeline_options["batch_token"], pipeline_options["on_commit"] = tracker.hooks(
+        batches, pipeline_options.get("batch_token"), pipeline_options.get("on_commit")
+    )
+    return batches
@@ -0,0 +1,303 @@
+"""Asynchronous, coalescing load-job manager for the curated tables.
+
+Transform output arrives one source batch at a time, and its size varies
+widely. Instead of one blocking load job per source batch, the manager:
+
+* buffers rows from consecutive source batches until ``target_rows`` or
+  ``target_bytes`` (estimated serialized size) is reached, never splitting a
+  source batch across jobs,
+* submits the buffer as one load job on a worker thread, with at most
+  ``max_inflight`` jobs running (``add`` blocks when the limit is reached),
+* retries retryable failures (rate limits, 5xx, connection errors) with
+  exponential backoff and jitter. Each attempt gets its own job id, and
+  before resubmitting, the previous attempt is looked up by id and waited
+  for: it may have succeeded after all (only its response was lost) or
+  still be running. A chunk is resubmitted only once its last attempt is
+  known to have failed as a job, so it is never appended twice,
+* reports each source batch through ``on_loaded(seq, rows_out)`` exactly
+  once, after the job holding its rows has succeeded. ``flush``/``close``
+  push out whatever is still buffered.
+
+``submit(rows, job_id=...)`` must start a load job and return a handle
+with ``result()`` (a ``google.cloud.bigquery`` job, or anything alike).
+Transform output may be a list of row dicts or an Arrow record batch; the
+batches buffered for one job are combined into one of the same kind.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from etl_metrics import current_metrics
+
+LOAD_CONFIG = {
+    "TARGET_ROWS": 100000,
+    "TARGET_BYTES": 64 * 2**20,  # estimated size of the buffered rows (JSON text, or Arrow buffers)
+    "MAX_INFLIGHT": 4,
+    "MAX_RETRIES": 5,
+    "BACKOFF_BASE": 1.0,   # seconds; doubled per attempt, with full jitter
+    "BACKOFF_MAX": 60.0,
+}
+
+# HTTP status codes of errors worth retrying: rate limits and server-side failures
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    code = getattr(error, "code", None)
+    if code is None:
+        # No status: a connection or timeout error rather than a rejected request
+        return isinstance(error, (ConnectionError, TimeoutError, OSError))
+    return code in RETRYABLE_CODES
+
+
+def estimate_json_bytes(rows, sample=16):
+    """Cheap size estimate: serialize a few rows evenly spread over the batch and extrapolate."""
+    if not rows:
+        return 0
+    step = max(1, len(rows) // sample)
+    picked = rows[::step][:sample]
+    return len(json.dumps(picked, default=str)) * len(rows) // len(picked)
+
+
+def estimate_batch_bytes(rows):
+    """``nbytes`` of an Arrow record batch, ``estimate_json_bytes`` of a list of rows."""
+    nbytes = getattr(rows, "nbytes", None)
+    return estimate_json_bytes(rows) if nbytes is None else nbytes
+
+
+def combine_batches(parts):
+    """One batch from several: row lists are concatenated, Arrow record batches combined."""
+    if len(parts) == 1:
+        return parts[0]
+    if isinstance(parts[0], list):
+        return [row for part in parts for row in part]
+    import pyarrow as pa
+
+    combined = pa.Table.from_batches(parts).combine_chunks().to_batches()
+    return combined[0] if combined else parts[0]
+
+
+class CompletedJob:
+    """Job handle for sinks that write synchronously (e.g. local Parquet files)."""
+
+    state = "DONE"
+    error_result = None
+
+    def result(self, timeout=None):
+        return None
+
+
+class _Chunk:
+    def __init__(self, index):
+        self.index = index
+        self.parts = []     # transform outputs, combined into one batch at submit time
+        self.rows = 0
+        self.bytes = 0
+        self.batches = []   # [(seq, rows_out)] in the order they were added
+
+
+class LoadManager:
+    def __init__(self, submit, name="load", target_rows=None, target_bytes=None, max_inflight=None,
+                 max_retries=None, backoff_base=None, backoff_max=None, lookup_job=None,
+                 estimate_bytes=estimate_batch_bytes, on_loaded=None, on_failed=None):
+        self.submit = submit
+        self.name = name
+        self.target_rows = LOAD_CONFIG["TARGET_ROWS"] if target_rows is None else target_rows
+        self.target_bytes = LOAD_CONFIG["TARGET_BYTES"] if target_bytes is None else target_bytes
+        self.max_inflight = LOAD_CONFIG["MAX_INFLIGHT"] if max_inflight is None else max_inflight
+        self.max_retries = LOAD_CONFIG["MAX_RETRIES"] if max_retries is None else max_retries
+        self.backoff_base = LOAD_CONFIG["BACKOFF_BASE"] if backoff_base is None else backoff_base
+        self.backoff_max = LOAD_CONFIG["BACKOFF_MAX"] if backoff_max is None else backoff_max
+        self.lookup_job = lookup_job
+        self.estimate_bytes = estimate_bytes
+        self.on_loaded = on_loaded
+        self.on_failed = on_failed
+
+        self._run_id = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max(1, self.max_inflight))
+        self._pool = None
+        self._chunk = _Chunk(0)
+        self.stats = {"jobs": 0, "retries": 0, "rows": 0, "batches": 0}
+
+    def bind(self, on_loaded, on_failed):
+        """Set the callbacks; ``on_failed(seq, error)`` gets the first source batch of a failed job."""
+        self.on_loaded = on_loaded
+        self.on_failed = on_failed
+        return self
+
+    # --------------------
+    # Buffering
+    # --------------------
+    def add(self, seq, rows):
+        """Buffer one source batch's rows; submits a job once the buffer reaches its target size."""
+        with self._lock:
+            chunk = self._chunk
+            chunk.parts.append(rows)
+            chunk.rows += len(rows)
+            chunk.bytes += self.estimate_bytes(rows)
+            chunk.batches.append((seq, len(rows)))
+            full = chunk.rows >= self.target_rows or chunk.bytes >= self.target_bytes
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Submit whatever is buffered as one job (blocking while ``max_inflight`` jobs are running)."""
+        with self._lock:
+            chunk = self._chunk
+            if not chunk.batches:
+                return
+            self._chunk = _Chunk(chunk.index + 1)
+        self._slots.acquire()
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=max(1, self.max_inflight), thread_name_prefix=f"{self.name}-load")
+        self._pool.submit(self._run_chunk, chunk)
+
+    def close(self, wait=True):
+        """Flush the buffer and wait for every job; with ``wait=False`` queued jobs are cancelled."""
+        if wait:
+            self.flush()
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=not wait)
+            self._pool = None
+
+    # --------------------
+    # Jobs
+    # --------------------
+    def _attempt_outcome(self, job_id):
+        """What became of an attempt whose ``result()`` raised: True (loaded), False (failed) or None (unknown).
+
+        The job is looked up by id and waited for. Only a job that ran and failed, or was never
+        created, may be resubmitted; while the lookup or the wait itself fails, the outcome is
+        unknown. Without ``lookup_job`` every such attempt counts as failed.
+        """
+        if self.lookup_job is None:
+            return False
+        try:
+            job = self.lookup_job(job_id)
+        except Exception as e:
+            return False if getattr(e, "code", None) == 404 else None
+        try:
+            job.result()
+        except Exception:
+            return False if getattr(job, "error_result", None) is not None else None
+        return True
+
+    def _load_with_retry(self, chunk):
+        metrics = current_metrics()
+        rows = combine_batches(chunk.parts)
+        chunk.parts = None
+        attempt = 0
+        while True:
+            job_id = f"{self.name}_{self._run_id}_{chunk.index}_{attempt}"
+            try:
+                with metrics.time("load"):
+                    self.submit(rows, job_id=job_id).result()
+                return
+            except Exception as e:
+                error = e
+            outcome = self._attempt_outcome(job_id)
+            while outcome is None and attempt < self.max_retries:
+                # The attempt may still append its rows: look again rather than resubmit
+                attempt += 1
+                time.sleep(self._backoff(attempt))
+                outcome = self._attempt_outcome(job_id)
+            if outcome:
+                logging.warning(f"Load job {job_id} reported {type(error).__name__} but completed; not retrying")
+                return
+            if outcome is None or attempt >= self.max_retries or not is_retryable(error):
+                raise error
+            delay = self._backoff(attempt)
+            logging.warning(
+                f"Load job {job_id} failed ({type(error).__name__}: {error}); retry {attempt + 1} in {delay:.1f}s"
+            )
+            metrics.add("load_retries")
+            with self._lock:
+                self.stats["retries"] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _run_chunk(self, chunk):
+        try:
+            self._load_with_retry(chunk)
+        except Exception as e:
+            logging.error(f"Load of {chunk.rows} rows for batches {[s for s, _ in chunk.batches]} failed: {e}")
+            if self.on_failed is not None:
+                self.on_failed(chunk.batches[0][0], e)
+            return
+        finally:
+            self._slots.release()
+
+        metrics = current_metrics()
+        metrics.add("load_jobs")
+        with self._lock:
+            self.stats["jobs"] += 1
+            self.stats["rows"] += chunk.rows
+            self.stats["batches"] += len(chunk.batches)
+        logging.info(f"Loaded {chunk.rows} rows for {len(chunk.batches)} source batch(es) in one {self.name} job")
+        # Source batches are never split across chunks, so each is reported exactly once, here
+        for seq, rows_out in chunk.batches:
+            if self.on_loaded is not None:
+                self.on_loaded(seq, rows_out)
+
+
+class LoadGroup:
+    """Several LoadManagers fed from one dict-shaped transform output (the fan-out).
+
+    A source batch counts as loaded once every manager has loaded its share of it.
+    """
+
+    def __init__(self, managers):
+        self.managers = managers
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._rows = {}
+        self.on_loaded = None
+        self.on_failed = None
+
+    @property
+    def stats(self):
+        return {key: sum(m.stats[key] for m in self.managers.values()) for key in ("jobs", "retries", "rows", "batches")}
+
+    def bind(self, on_loaded, on_failed):
+        self.on_loaded = on_loaded
+        self.on_failed = on_failed
+        for manager in self.managers.values():
+            manager.bind(self._part_loaded, on_failed)
+        return self
+
+    def _part_loaded(self, seq, rows_out):
+        with self._lock:
+            self._pending[seq] -= 1
+            self._rows[seq] += rows_out
+            if self._pending[seq]:
+                return
+            del self._pending[seq]
+            total = self._rows.pop(seq)
+        self.on_loaded(seq, total)
+
+    def add(self, seq, outputs):
+        parts = [(name, rows) for name, rows in outputs.items() if rows]
+        if not parts:
+            self.on_loaded(seq, 0)
+            return
+        with self._lock:
+            self._pending[seq] = len(parts)
+            self._rows[seq] = 0
+        for name, rows in parts:
+            self.managers[name].add(seq, rows)
+
+    def flush(self):
+        for manager in self.managers.values():
+            manager.flush()
+
+    def close(self, wait=True):
+        for manager in self.managers.values():
+            manager.close(wait=wait)
@@ -0,0 +1,327 @@
+"""Local stand-in for the parts of ``google.cloud.bigquery.Client`` the ETL uses.
+
+Tables live in an in-memory SQLite database. Fully qualified names such as
+``fhir-synthea-data.fhir_staging.explanationofbenefits`` are used verbatim as
+SQLite table names, so the ETL's own queries run after a light dialect
+translation (backticks become double quotes, ``JSON_QUERY`` becomes SQLite's
+``->``). Nested values (lists, dicts) are stored as JSON text. Load jobs can
+be given artificial latency and random failures, so pipelining, retries and
+commit accounting can be exercised without touching BigQuery:
+
+* ``load_failure_rate``: the job fails and writes nothing (a retryable 503)
+* ``lost_response_rate``: the job writes its rows, but ``result()`` still
+  raises, as when the response is lost on the way back
+* ``timeout_rate``: ``result()`` raises before the job has run, as when the
+  request times out; the job stays RUNNING and loads its rows when it is
+  waited for again (e.g. after ``get_job``)
+
+``page_latency`` adds a delay per result page of a query (``result(page_size=...)``
+returns an iterator), which is what makes one serial result stream slow.
+``FARM_FINGERPRINT`` and ``MOD`` are available to queries; the fingerprint is a
+stable 64-bit hash, not BigQuery's exact FarmHash values.
+
+Queries may also be scripts (statements ending in ``;`` at the end of a line,
+with ``BEGIN``/``COMMIT TRANSACTION``), use ``CREATE OR REPLACE TABLE`` (the
+``PARTITION BY`` / ``CLUSTER BY`` lines are dropped) and ``IN UNNEST(@array)``
+with an ``ArrayQueryParameter``; ``UNION DISTINCT`` becomes ``UNION``. A
+``dry_run`` job config runs nothing and reports ``total_bytes_processed`` as
+the stored size of the columns the query mentions in every table it names:
+like BigQuery's estimate, but without partition pruning. Timestamps are stored as UTC
+``YYYY-MM-DD HH:MM:SS[.ffffff]`` text, the form the checkpoints compare with.
+"""
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+_BACKTICK_RE = re.compile(r"`([^`]+)`")
+_JSON_QUERY_RE = re.compile(r"JSON_QUERY\((\w+),\s*('[^']*')\)")
+_UNNEST_RE = re.compile(r"IN UNNEST\(@(\w+)\)")
+_TABLE_OPTIONS_RE = re.compile(r"^[ \t]*(?:PARTITION|CLUSTER) BY .*(?:\n|$)", re.MULTILINE)
+_CREATE_OR_REPLACE_RE = re.compile(r'CREATE OR REPLACE TABLE ("[^"]+")')
+_TRANSACTION_RE = re.compile(r"\b(BEGIN|COMMIT|ROLLBACK) TRANSACTION\b")
+_UNION_DISTINCT_RE = re.compile(r"\bUNION\s+DISTINCT\b", re.IGNORECASE)
+_SELECT_STAR_RE = re.compile(r"(?<!\()\*")  # SELECT * / t.*, not COUNT(*)
+_STATEMENT_END_RE = re.compile(r";[ \t]*(?:\n|$)")
+_QUOTED_NAME_RE = re.compile(r'"([^"]+)"')
+
+
+class LocalServiceError(RuntimeError):
+    """A retryable server-side failure, like ``google.api_core.exceptions.ServiceUnavailable``."""
+
+    code = 503
+
+
+class LocalRow(dict):
+    """Row object supporting both ``row["col"]`` and ``row.col`` like ``bigquery.Row``."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class LocalJob:
+    """Minimal job handle: ``result()`` blocks for the simulated latency, then returns or raises."""
+
+    def __init__(self, run, latency=0.0, job_id=None, lose_response=False, page_latency=0.0, time_out=False):
+        self._run = run
+        self._latency = latency
+        self._page_latency = page_latency
+        self._lose_response = lose_response
+        self._time_out = time_out
+        self._lock = threading.Lock()
+        self._done = False
+        self._result = None
+        self.job_id = job_id or f"local_{id(self):x}"
+        self.state = "RUNNING"
+        self.error_result = None
+
+    def result(self, timeout=None, page_size=None):
+        with self._lock:
+            if self._time_out:
+                self._time_out = False
+                raise LocalServiceError(f"simulated timeout waiting for job {self.job_id}")
+            if not self._done:
+                if self._latency:
+                    time.sleep(self._latency)
+                try:
+                    self._result = self._run()
+                except Exception as e:
+                    self._result = e
+                    self.error_result = {"reason": type(e).__name__, "message": str(e)}
+                self._done = True
+                self.state = "DONE"
+                if self._lose_response and self.error_result is None:
+                    raise LocalServiceError(f"simulated lost response for job {self.job_id}")
+        if isinstance(self._result, Exception):
+            raise self._result
+        if page_size and self._page_latency:
+            return _paged(self._result, page_size, self._page_latency)
+        return self._result
+
+    def done(self):
+        return self._done
+
+
+class LocalNotFound(LookupError):
+    """Mirrors ``google.api_core.exceptions.NotFound`` closely enough for callers checking ``code``."""
+
+    code = 404
+
+
+class LocalConflict(RuntimeError):
+    """Mirrors ``google.api_core.exceptions.Conflict`` (e.g. a reused job id)."""
+
+    code = 409
+
+
+class LocalBigQueryClient:
+    def __init__(self, project="fhir-synthea-data", load_latency=0.0, query_latency=0.0,
+                 load_failure_rate=0.0, lost_response_rate=0.0, seed=None, page_latency=0.0, timeout_rate=0.0):
+        self.project = project
+        self.load_latency = load_latency
+        self.query_latency = query_latency
+        self.page_latency = page_latency
+        self.load_failure_rate = load_failure_rate
+        self.lost_response_rate = lost_response_rate
+        self.timeout_rate = timeout_rate
+        self.load_jobs = []
+        self.jobs = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.create_function("FARM_FINGERPRINT", 1, _fingerprint64, deterministic=True)
+        self._db.create_function("MOD", 2, _bq_mod, deterministic=True)
+
+    # --------------------
+    # Table helpers
+    # --------------------
+    def _columns(self, table_id):
+        cur = self._db.execute(f'PRAGMA table_info("{table_id}")')
+        return [r["name"] for r in cur.fetchall()]
+
+    def _ensure_columns(self, table_id, names):
+        existing = self._columns(table_id)
+        if not existing:
+            cols = ", ".join(f'"{n}"' for n in names)
+            self._db.execute(f'CREATE TABLE "{table_id}" ({cols})')
+            return
+        for name in names:
+            if name not in existing:
+                self._db.execute(f'ALTER TABLE "{table_id}" ADD COLUMN "{name}"')
+
+    def insert_rows(self, table_id, rows):
+        """Append rows (dicts) to a table, creating it and any new columns on the fly."""
+        rows = list(rows)
+        if not rows:
+            return 0
+        names = list(dict.fromkeys(k for row in rows for k in row))
+        with self._lock:
+            self._ensure_columns(table_id, names)
+            cols = ", ".join(f'"{n}"' for n in names)
+            marks = ", ".join("?" for _ in names)
+            values = [
+                tuple(_to_sql_value(row.get(n)) for n in names)
+                for row in rows
+            ]
+            self._db.executemany(f'INSERT INTO "{table_id}" ({cols}) VALUES ({marks})', values)
+            self._db.commit()
+        return len(rows)
+
+    def fetch_rows(self, table_id):
+        with self._lock:
+            if not self._columns(table_id):
+                return []
+            return [LocalRow(r) for r in self._db.execute(f'SELECT * FROM "{table_id}"').fetchall()]
+
+    def list_tables(self, dataset):
+        prefix = dataset if "." in dataset else f"{self.project}.{dataset}"
+        with self._lock:
+            names = [r[0] for r in self._db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return [
+            SimpleNamespace(table_id=name.rsplit(".", 1)[-1], full_table_id=name)
+            for name in names if name.startswith(prefix + ".")
+        ]
+
+    # --------------------
+    # Client API
+    # --------------------
+    def get_table(self, table_id):
+        table_id = str(table_id)
+        with self._lock:
+            columns = self._columns(table_id)
+            if not columns:
+                raise LocalNotFound(f"Not found: Table {table_id}")
+            num_rows = self._db.execute(f'SELECT COUNT(*) FROM "{table_id}"').fetchone()[0]
+        return SimpleNamespace(
+            table_id=table_id.rsplit(".", 1)[-1], full_table_id=table_id, num_rows=num_rows,
+            schema=[SimpleNamespace(name=name, field_type=None) for name in columns],
+        )
+
+    def query(self, sql, job_config=None):
+        params = {}
+        for param in getattr(job_config, "query_parameters", None) or []:
+            if hasattr(param, "values"):  # ArrayQueryParameter, read back with json_each
+                params[param.name] = json.dumps(list(param.values), default=str)
+            else:
+                params[param.name] = _to_sql_value(param.value)
+        local_sql = _BACKTICK_RE.sub(r'"\1"', sql)
+        local_sql = _UNNEST_RE.sub(r"IN (SELECT value FROM json_each(:\1))", local_sql)
+        local_sql = re.sub(r"@(\w+)", r":\1", local_sql)
+        local_sql = _JSON_QUERY_RE.sub(r"(\1 -> \2)", local_sql)
+        local_sql = _TABLE_OPTIONS_RE.sub("", local_sql)
+        local_sql = _CREATE_OR_REPLACE_RE.sub(r"DROP TABLE IF EXISTS \1;\nCREATE TABLE \1", local_sql)
+        local_sql = _TRANSACTION_RE.sub(r"\1", local_sql)
+        local_sql = _UNION_DISTINCT_RE.sub("UNION", local_sql)
+        statements = [s for s in _STATEMENT_END_RE.split(local_sql) if s.strip()]
+
+        if getattr(job_config, "dry_run", False):
+            job = LocalJob(lambda: [], job_id=None)
+            job.total_bytes_processed = self._stored_bytes(local_sql)
+            return job
+
+        def run():
+            with self._lock:
+                try:
+                    rows = []
+                    for statement in statements:
+                        rows = self._db.execute(statement, params).fetchall()
+                    if self._db.in_transaction:
+                        self._db.commit()
+                except Exception:
+                    if self._db.in_transaction:
+                        self._db.rollback()
+                    raise
+                return [LocalRow(r) for r in rows]
+
+        return LocalJob(run, self.query_latency, page_latency=self.page_latency)
+
+    def _stored_bytes(self, local_sql):
+        """Bytes stored in the columns a (translated) query mentions, in the tables it names."""
+        total = 0
+        words = set(re.findall(r"\w+", _QUOTED_NAME_RE.sub(" ", local_sql)))
+        with self._lock:
+            for name in set(_QUOTED_NAME_RE.findall(local_sql)):
+                columns = [c for c in self._columns(name) if c in words or _SELECT_STAR_RE.search(local_sql)]
+                if columns:
+                    sizes = " + ".join(f'COALESCE(SUM(LENGTH(CAST("{c}" AS BLOB))), 0)' for c in columns)
+                    total += self._db.execute(f'SELECT {sizes} FROM "{name}"').fetchone()[0]
+        return total
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise LocalNotFound(f"Not found: Job {job_id}")
+        return job
+
+    def _load_job(self, destination, rows, job_id):
+        with self._lock:
+            if job_id is not None and job_id in self.jobs:
+                raise LocalConflict(f"Already Exists: Job {job_id}")
+            roll = self._rng.random()
+        fail = roll < self.load_failure_rate
+        lose = not fail and roll < self.load_failure_rate + self.lost_response_rate
+        time_out = not fail and not lose and roll < self.load_failure_rate + self.lost_response_rate + self.timeout_rate
+
+        def run():
+            if fail:
+                raise LocalServiceError(f"simulated failure loading {len(rows)} rows into {destination}")
+            self.insert_rows(str(destination), rows)
+            with self._lock:
+                self.load_jobs.append((str(destination), len(rows)))
+
+        job = LocalJob(run, self.load_latency, job_id=job_id, lose_response=lose, time_out=time_out)
+        with self._lock:
+            self.jobs[job.job_id] = job
+        return job
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, job_id=None):
+        return self._load_job(destination, list(json_rows), job_id)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, job_id=None):
+        """Parquet loads only (the format ``parquet_sink`` produces)."""
+        import pyarrow.parquet as pq
+
+        return self._load_job(destination, pq.read_table(file_obj).to_pylist(), job_id)
+
+
+def _paged(rows, page_size, latency):
+    for i in range(0, len(rows), page_size):
+        time.sleep(latency)
+        yield from rows[i:i + page_size]
+
+
+def _fingerprint64(value):
+    if value is None:
+        return None
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _bq_mod(x, y):
+    # BigQuery's MOD keeps the sign of the dividend (like C), unlike Python's %
+    if x is None or y is None:
+        return None
+    remainder = abs(x) % abs(y)
+    return remainder if x >= 0 else -remainder
+
+
+def _to_sql_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(sep=" ")
+    if isinstance(value, bool):
+        return int(value)
+    return value
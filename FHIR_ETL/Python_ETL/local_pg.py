@@ -0,0 +1,290 @@
+"""Local stand-in for the parts of ``psycopg2`` the staging loaders use.
+
+A ``LocalPostgres`` is a set of SQLite files, one per Postgres schema, so
+``fhir_staging_sample.patients_fhir_raw`` resolves naturally via
+``ATTACH``. Connections support ``cursor().execute`` (after a light dialect
+translation), ``copy_expert`` for ``COPY ... FROM STDIN`` in CSV or binary
+format, ``commit``/``rollback``, and unique-constraint violations that look
+like psycopg2's (``pgcode`` 23505). ``copy_latency`` and ``commit_latency``
+add a fixed delay per COPY / commit to stand in for network round trips, so
+batching and commit-frequency settings show up in timings.
+"""
+import csv
+import io
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+from fhir_staging_loader import FHIR_STAGING_MAP
+
+_COPY_RE = re.compile(
+    r"COPY\s+([\w.]+)\s*\(([^)]*)\)\s+FROM\s+STDIN\s+(?:WITH\s*)?\(?\s*(?:FORMAT\s+)?(\w+)",
+    re.IGNORECASE,
+)
+_BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+JSONB_COLUMNS = {"resource"}
+
+
+class LocalPgError(Exception):
+    pgcode = None
+
+
+class LocalUniqueViolation(LocalPgError):
+    """Mirrors ``psycopg2.errors.UniqueViolation``."""
+
+    pgcode = "23505"
+
+
+def decode_binary_copy(payload, jsonb_columns):
+    """Rows (tuples of str/None) from a ``COPY ... (FORMAT binary)`` payload; jsonb fields lose their version byte."""
+    if not payload.startswith(_BINARY_SIGNATURE):
+        raise LocalPgError("COPY file signature not recognized")
+    pos = len(_BINARY_SIGNATURE) + 4
+    (ext_len,) = struct.unpack_from("!i", payload, pos)
+    pos += 4 + ext_len
+    rows = []
+    while True:
+        (n_fields,) = struct.unpack_from("!h", payload, pos)
+        pos += 2
+        if n_fields == -1:
+            return rows
+        row = []
+        for i in range(n_fields):
+            (length,) = struct.unpack_from("!i", payload, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            value = payload[pos:pos + length]
+            pos += length
+            if jsonb_columns[i]:
+                if value[:1] != b"\x01":
+                    raise LocalPgError("unsupported jsonb version")
+                value = value[1:]
+            row.append(value.decode("utf-8"))
+        rows.append(tuple(row))
+
+
+def translate_sql(sql):
+    """Postgres-isms the loaders use, rewritten for SQLite."""
+    sql = sql.replace("%s", "?")
+    sql = re.sub(r"IS\s+DISTINCT\s+FROM", "IS NOT", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"::\w+", "", sql)
+    sql = re.sub(r"\bCREATE\s+UNLOGGED\s+TABLE", "CREATE TABLE", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bON\s+COMMIT\s+(DROP|DELETE\s+ROWS|PRESERVE\s+ROWS)\b", "", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bBIGSERIAL\b|\bSERIAL\b", "INTEGER", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"^\s*TRUNCATE\s+(TABLE\s+)?", "DELETE FROM ", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bnow\(\)", "CURRENT_TIMESTAMP", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bjsonb_object_agg\(", "json_group_object(", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bjsonb_each\(", "json_each(", sql, flags=re.IGNORECASE)
+    return sql
+
+
+class LocalPgCursor:
+    """A cursor; a named one (psycopg2's server-side cursor) iterates in ``itersize`` chunks."""
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.itersize = 2000
+        self._cur = conn._db.cursor()
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._cur.close()
+
+    def _run(self, fn):
+        try:
+            return fn()
+        except sqlite3.IntegrityError as e:
+            if "UNIQUE" in str(e):
+                raise LocalUniqueViolation(str(e)) from e
+            raise LocalPgError(str(e)) from e
+        except sqlite3.Error as e:
+            raise LocalPgError(str(e)) from e
+
+    def execute(self, sql, params=None):
+        self._run(lambda: self._cur.execute(translate_sql(sql), params or ()))
+        self.rowcount = self._cur.rowcount
+
+    def executemany(self, sql, seq_of_params):
+        self._run(lambda: self._cur.executemany(translate_sql(sql), seq_of_params))
+        self.rowcount = self._cur.rowcount
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cur.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def __iter__(self):
+        while True:
+            rows = self._cur.fetchmany(self.itersize)
+            if not rows:
+                return
+            self.connection.owner._count(fetch_round_trips=1)
+            yield from rows
+
+    def copy_expert(self, sql, file, size=8192):
+        match = _COPY_RE.search(sql)
+        if not match:
+            raise LocalPgError(f"unsupported COPY statement: {sql}")
+        table, columns, fmt = match.group(1), [c.strip() for c in match.group(2).split(",")], match.group(3).lower()
+        payload = file.read()
+        if fmt == "binary":
+            rows = decode_binary_copy(payload, [c in JSONB_COLUMNS for c in columns])
+        elif fmt == "csv":
+            text = payload.decode("utf-8") if isinstance(payload, bytes) else payload
+            rows = [tuple(r) for r in csv.reader(io.StringIO(text))]
+        else:
+            raise LocalPgError(f"unsupported COPY format: {fmt}")
+
+        if self.connection.owner.copy_latency:
+            time.sleep(self.connection.owner.copy_latency)
+        cols = ", ".join(columns)
+        marks = ", ".join("?" for _ in columns)
+        self._run(lambda: self._cur.executemany(f"INSERT INTO {table} ({cols}) VALUES ({marks})", rows))
+        self.rowcount = len(rows)
+        self.connection.owner._count(copies=1, copied_rows=len(rows), copied_bytes=len(payload))
+
+
+class LocalPgConnection:
+    def __init__(self, owner):
+        self.owner = owner
+        self.closed = 0
+        self.autocommit = False
+        self._db = sqlite3.connect(owner.main_path, timeout=60, check_same_thread=False)
+        for schema, path in owner.schema_paths.items():
+            self._db.execute(f"ATTACH DATABASE '{path}' AS {schema}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Like psycopg2: the block is a transaction, the connection stays open
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def cursor(self, name=None):
+        return LocalPgCursor(self, name)
+
+    def commit(self):
+        if self.owner.commit_latency:
+            time.sleep(self.owner.commit_latency)
+        self._db.commit()
+        self.owner._count(commits=1)
+
+    def rollback(self):
+        self._db.rollback()
+        self.owner._count(rollbacks=1)
+
+    def close(self):
+        if not self.closed:
+            self._db.close()
+            self.closed = 1
+
+
+class LocalPostgres:
+    def __init__(self, schemas=("fhir_staging", "fhir_staging_sample"), directory=None,
+                 copy_latency=0.0, commit_latency=0.0):
+        self._owns_dir = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix="local_pg_")
+        self.main_path = os.path.join(self.directory, "main.db")
+        self.schema_paths = {schema: os.path.join(self.directory, f"{schema}.db") for schema in schemas}
+        self.copy_latency = copy_latency
+        self.commit_latency = commit_latency
+        self.stats = {"connections": 0, "copies": 0, "copied_rows": 0, "copied_bytes": 0, "commits": 0, "rollbacks": 0,
+                      "fetch_round_trips": 0}
+        self._lock = threading.Lock()
+        conn = LocalPgConnection(self)
+        conn._db.execute("PRAGMA journal_mode=WAL")
+        for schema in schemas:
+            conn._db.execute(f"PRAGMA {schema}.journal_mode=WAL")
+        conn.close()
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def connect(self, **_db_config):
+        self._count(connections=1)
+        return LocalPgConnection(self)
+
+    def create_staging_tables(self, schema="fhir_staging_sample"):
+        """The staging tables from ``SQL/FHIR_staging_Postgres.sql`` (JSONB stored as text)."""
+        conn = LocalPgConnection(self)
+        for table, id_field in FHIR_STAGING_MAP.values():
+            conn._db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {schema}.{table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    {id_field} TEXT UNIQUE,
+                    resource TEXT NOT NULL,
+                    load_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+        conn._db.commit()
+        conn.close()
+
+    def fetch(self, sql, params=()):
+        conn = LocalPgConnection(self)
+        try:
+            return conn._db.execute(translate_sql(sql), params).fetchall()
+        finally:
+            conn.close()
+
+    def cleanup(self):
+        if self._owns_dir:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class LocalConnectionPool:
+    """Same surface as ``psycopg2.pool.ThreadedConnectionPool``: getconn/putconn/closeall."""
+
+    def __init__(self, minconn, maxconn, local):
+        self.maxconn = maxconn
+        self.local = local
+        self._lock = threading.Lock()
+        self._idle = [local.connect() for _ in range(minconn)]
+        self._used = 0
+
+    def getconn(self):
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+            elif self._used + len(self._idle) < self.maxconn:
+                conn = self.local.connect()
+            else:
+                raise LocalPgError("connection pool exhausted")
+            self._used += 1
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            self._used -= 1
+            if close:
+                conn.close()
+            else:
+                self._idle.append(conn)
+
+    def closeall(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
@@ -0,0 +1,278 @@
+"""Columnar Arrow/Parquet sink for the curated tables.
+
+Transform output is turned column by column into a typed Arrow record
+batch: real timestamps, float64 amounts and nested list<struct> columns for
+adjudication/amount/codings. Transforms fill a ``ColumnBuffer`` (one
+value list per column, one load timestamp per batch). The batch is
+written as a single compressed Parquet file and either loaded into
+BigQuery with ``load_table_from_file`` or, in local mode, written to a
+date-partitioned directory tree on disk.
+
+Compared to ``load_table_from_json`` this avoids repeating every key name
+per record, avoids the newline-delimited JSON text, and uploads a
+compressed columnar file instead.
+
+Row contract: every value must already have its column's type (``int`` for
+INT64, ``str`` for STRING, a number for FLOAT64, a datetime or ISO-8601
+string for timestamps, lists of dicts/tuples for list<struct>). The
+transforms' field converters (see ``fhir_fields``) enforce it per row, so a
+bad element is dropped by its own transform. A value that
+still does not convert is set to NULL, logged and counted as
+``values_nulled`` rather than failing the whole batch.
+"""
+import io
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from etl_metrics import current_metrics
+
+PARQUET_COMPRESSION = "snappy"
+
+_TS = pa.timestamp("us", tz="UTC")
+_CODING = pa.struct([("system", pa.string()), ("code", pa.string()), ("display", pa.string())])
+
+# --------------------
+# Curated table schemas
+# --------------------
+TABLE_SCHEMAS = {
+    "eob_items": pa.schema([
+        ("eob_id", pa.string()),
+        ("sequence", pa.int64()),
+        ("diagnosis_sequence", pa.int64()),
+        ("category_system", pa.string()),
+        ("category_code", pa.string()),
+        ("category_display", pa.string()),
+        ("product_system", pa.string()),
+        ("product_code", pa.string()),
+        ("product_display", pa.string()),
+        ("product_text", pa.string()),
+        ("service_start", _TS),
+        ("service_end", _TS),
+        ("location_system", pa.string()),
+        ("location_code", pa.string()),
+        ("location_display", pa.string()),
+        ("encounter", pa.string()),
+        ("quantity", pa.float64()),
+        ("unit_price", pa.float64()),
+        ("net_value", pa.float64()),
+        ("net_currency", pa.string()),
+        ("adjudication", pa.list_(pa.struct([
+            ("code", pa.string()),
+            ("display", pa.string()),
+            ("value", pa.float64()),
+            ("currency", pa.string()),
+            ("system", pa.string()),
+            ("code_key", pa.int64()),
+        ]))),
+        ("amount", pa.list_(pa.struct([("value", pa.float64()), ("currency", pa.string())]))),
+        ("category_key", pa.int64()),
+        ("product_key", pa.int64()),
+        ("location_key", pa.int64()),
+        ("load_timestamp", _TS),
+    ]),
+    "eob_coverage": pa.schema([
+        ("coverage_id", pa.string()),
+        ("status", pa.string()),
+        ("type_code", pa.string()),
+        ("type_system", pa.string()),
+        ("type_display", pa.string()),
+        ("type_codings", pa.list_(_CODING)),
+        ("identifier_value", pa.string()),
+        ("identifier_system", pa.string()),
+        ("identifiers", pa.list_(pa.struct([("system", pa.string()), ("value", pa.string())]))),
+        ("beneficiary_ref", pa.string()),
+        ("payor", pa.string()),
+        ("subscriber_id", pa.string()),
+        ("period_start", _TS),
+        ("period_end", _TS),
+        ("focal", pa.bool_()),
+        ("type_key", pa.int64()),
+        ("load_timestamp", _TS),
+    ]),
+    "observations": pa.schema([
+        ("observation_id", pa.string()),
+        ("status", pa.string()),
+        ("obs_code", pa.string()),
+        ("system", pa.string()),
+        ("obs_code_text", pa.string()),
+        ("codings", pa.list_(_CODING)),
+        ("value_numeric", pa.float64()),
+        ("value_text", pa.string()),
+        ("unit", pa.string()),
+        ("value_codings", pa.list_(_CODING)),
+        ("patient_id", pa.string()),
+        ("encounter_id", pa.string()),
+        ("effective_datetime", _TS),
+        ("obs_code_key", pa.int64()),
+        ("load_timestamp", _TS),
+    ]),
+    # Appended incrementally from code_dictionary.CodeDictionary
+    "dim_code": pa.schema([
+        ("domain", pa.string()),
+        ("code_key", pa.int64()),
+        ("system", pa.string()),
+        ("code", pa.string()),
+        ("display", pa.string()),
+        ("first_seen", _TS),
+    ]),
+}
+
+
+@lru_cache(maxsize=65536)
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _timestamp_column(values):
+    return [
+        _parse_timestamp(v) if isinstance(v, str) else v
+        for v in values
+    ]
+
+
+_CONVERSION_ERRORS = (pa.ArrowException, TypeError, ValueError, OverflowError)
+
+
+def _typed_array(values, field):
+    """``pa.array`` of one column; values that do not convert to ``field.type`` become NULL."""
+    try:
+        return pa.array(values, type=field.type)
+    except _CONVERSION_ERRORS:
+        pass
+    converted = []
+    nulled = 0
+    for value in values:
+        try:
+            pa.scalar(value, type=field.type)
+        except _CONVERSION_ERRORS:
+            value = None
+            nulled += 1
+        converted.append(value)
+    if nulled:
+        current_metrics().add("values_nulled", nulled)
+        logging.warning(f"Set {nulled} value(s) of {field.name} to NULL: they do not convert to {field.type}")
+    return pa.array(converted, type=field.type)
+
+
+# --------------------
+# Arrow conversion
+# --------------------
+def columns_to_record_batch(columns, schema):
+    """Build a typed Arrow record batch from per-column value sequences, in ``schema`` order.
+
+    Timestamp columns may hold datetimes or ISO-8601 strings; Arrow arrays are used as they are.
+    Values breaking the row contract (see the module docstring) are set to NULL.
+    """
+    arrays = []
+    for field, values in zip(schema, columns):
+        if isinstance(values, pa.Array):
+            arrays.append(values)
+            continue
+        if pa.types.is_timestamp(field.type):
+            values = _timestamp_column(values)
+        arrays.append(_typed_array(values, field))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ColumnBuffer:
+    """Per-column value lists for one batch of a curated table, in ``schema`` order.
+
+    Transforms append to ``columns[name]`` (or through ``appenders(names)``) instead of building
+    a dict per row; ``load_timestamp`` is kept once for the batch and only expanded into a
+    column by ``to_record_batch``. Struct values may be dicts or tuples in field order.
+    """
+
+    def __init__(self, schema, load_timestamp=None):
+        self.schema = schema
+        self.load_timestamp = load_timestamp or datetime.now(timezone.utc)
+        self.columns = {name: [] for name in schema.names if name != "load_timestamp"}
+
+    def appenders(self, names):
+        """``list.append`` of each named column, e.g. for a ``fhir_fields.compile_columns`` extractor."""
+        return [self.columns[name].append for name in names]
+
+    @property
+    def rows(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    def to_record_batch(self):
+        columns = []
+        for field in self.schema:
+            if field.name == "load_timestamp":
+                columns.append(pa.repeat(pa.scalar(self.load_timestamp, type=field.type), self.rows))
+            else:
+                columns.append(self.columns[field.name])
+        return columns_to_record_batch(columns, self.schema)
+
+
+def record_batch_to_json_rows(record_batch):
+    """Row dicts for ``load_table_from_json``: timestamps become ISO-8601 strings."""
+    rows = record_batch.to_pylist()
+    timestamps = [f.name for f in record_batch.schema if pa.types.is_timestamp(f.type)]
+    for row in rows:
+        for name in timestamps:
+            if row[name] is not None:
+                row[name] = row[name].isoformat()
+    return rows
+
+
+def record_batch_to_parquet(record_batch):
+    """Serialize a record batch to an in-memory Parquet file and return its bytes."""
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_batches([record_batch]), sink, compression=PARQUET_COMPRESSION)
+    return sink.getvalue().to_pybytes()
+
+
+# --------------------
+# Sinks
+# --------------------
+def submit_record_batch_load(client, record_batch, table_id, job_id=None):
+    """Start a Parquet load job appending an Arrow record batch to a BigQuery table; return the job."""
+    from google.cloud import bigquery
+
+    metrics = current_metrics()
+    with metrics.time("parquet_encode"):
+        payload = record_batch_to_parquet(record_batch)
+    parquet_options = bigquery.ParquetOptions()
+    parquet_options.enable_list_inference = True
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition="WRITE_APPEND",
+        parquet_options=parquet_options,
+        # Columns added to TABLE_SCHEMAS (e.g. code keys) are added to existing tables on load
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+    )
+    job = client.load_table_from_file(io.BytesIO(payload), table_id, job_config=job_config, job_id=job_id)
+    metrics.add("bytes_uploaded", len(payload))
+    logging.info(f"Submitted {record_batch.num_rows} records ({len(payload)} Parquet bytes) for {table_id}")
+    return job
+
+
+def write_record_batch_local(record_batch, root_dir, table_name, partition_column="load_timestamp"):
+    """Write a record batch as Parquet under ``root_dir/table_name/load_date=YYYY-MM-DD/``; return file paths."""
+    table = pa.Table.from_batches([record_batch])
+    partition_values = [
+        ts.date().isoformat() if ts is not None else "unknown"
+        for ts in table.column(partition_column).to_pylist()
+    ]
+
+    paths = []
+    for load_date in dict.fromkeys(partition_values):
+        mask = pa.array([p == load_date for p in partition_values])
+        part_dir = os.path.join(root_dir, table_name, f"load_date={load_date}")
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, f"part-{uuid.uuid4().hex}.parquet")
+        pq.write_table(table.filter(mask), path, compression=PARQUET_COMPRESSION)
+        paths.append(path)
+    current_metrics().add("bytes_written", sum(os.path.getsize(p) for p in paths))
+    logging.info(f"Wrote {table.num_rows} records for {table_name} to {len(paths)} Parquet file(s)")
+    return paths
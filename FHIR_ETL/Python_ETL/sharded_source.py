@@ -0,0 +1,244 @@
+"""Concurrent, resumable shard scans of the staging tables.
+
+A single staging scan is one result stream, read page by page, however many
+transform workers are waiting. Here the table is split into disjoint
+shards, each shard is read on its own thread, and batches are handed on in
+the order they arrive:
+
+* BigQuery (``fetch_sharded_batches``): one query per shard, selecting rows
+  by a hash of ``explanationofbenefit_id`` (see ``staging_source.shard_condition``).
+* Postgres ``fhir_staging`` tables (``fetch_id_range_batches``): the ``id``
+  SERIAL key space is cut into contiguous ranges, each read with keyset
+  pagination (``id > last ORDER BY id LIMIT n``) on its own connection.
+
+Every batch is a ``ShardBatch`` carrying its shard number, so commits can
+be tracked per shard. Checkpointed hash-shard scans also end each shard with
+an empty ShardBatch, so a shard with nothing to read is still seen to be
+caught up. ``shard_watermark_hooks`` and ``id_range_hooks`` wire a
+``CheckpointStore`` into ``etl_pipeline.run_pipelined`` (which must commit
+in order) so that each shard resumes from its own last committed position.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import staging_source
+from etl_checkpoint import batch_position, position_order, to_watermark
+
+SHARD_CONFIG = {
+    "SHARDS": 4,
+    "READERS": None,      # concurrent shard readers; default one per shard
+    "QUEUE_BATCHES": 8,   # batches read ahead of the consumer, across all shards
+}
+
+_DONE = "done"
+_BATCH = "batch"
+_ERROR = "error"
+
+
+class ShardBatch(list):
+    """A batch of rows read from one shard."""
+
+    def __init__(self, rows=(), shard=0):
+        super().__init__(rows)
+        self.shard = shard
+
+    def __reduce__(self):
+        return ShardBatch, (list(self), self.shard)
+
+
+def interleave_shards(sources, readers=None, queue_batches=None, mark_done=False):
+    """Read ``sources`` (``{shard: iterable of batches}``) concurrently; yield ShardBatches as they arrive.
+
+    At most ``readers`` shards are read at a time. A reader's exception is re-raised here, and
+    closing the generator stops the readers at their next batch. With ``mark_done``, an empty
+    ShardBatch follows the last batch of each shard.
+    """
+    readers = readers or SHARD_CONFIG["READERS"] or len(sources)
+    queue_batches = queue_batches or SHARD_CONFIG["QUEUE_BATCHES"]
+    events = queue.Queue(maxsize=max(1, queue_batches))
+    stop = threading.Event()
+
+    def put(event):
+        while not stop.is_set():
+            try:
+                events.put(event, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(shard, batches):
+        try:
+            for batch in batches:
+                if not put((_BATCH, shard, batch)):
+                    return
+        except Exception as e:
+            put((_ERROR, shard, e))
+            return
+        put((_DONE, shard, None))
+
+    pool = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="shard-read")
+    try:
+        for shard, batches in sources.items():
+            pool.submit(read, shard, batches)
+        remaining = len(sources)
+        while remaining:
+            kind, shard, payload = events.get()
+            if kind == _ERROR:
+                raise RuntimeError(f"Reading shard {shard} failed: {type(payload).__name__} - {payload}") from payload
+            if kind == _DONE:
+                remaining -= 1
+                logging.info(f"Shard {shard} finished; {remaining} still reading")
+                if mark_done:
+                    yield ShardBatch((), shard)
+                continue
+            yield ShardBatch(payload, shard)
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# --------------------
+# BigQuery: hash shards
+# --------------------
+def fetch_sharded_batches(client, table_id, batch_size=5000, shards=None, since=None, ordered=False,
+                          paths=None, readers=None, batcher=None):
+    """``staging_source.fetch_staging_batches`` over ``shards`` hash shards read concurrently.
+
+    ``since`` is one watermark or position for every shard, or ``{shard: position}`` to resume
+    each shard from its own. With ``ordered=True`` each shard is read in ``load_timestamp`` order
+    and ends with an empty ShardBatch (see ``shard_watermark_hooks``). A ``batcher`` is shared by
+    all shards.
+    """
+    shards = shards or SHARD_CONFIG["SHARDS"]
+    marks = since if isinstance(since, dict) else {shard: since for shard in range(shards)}
+    sources = {
+        shard: staging_source.fetch_staging_batches(
+            client, table_id, batch_size, since=marks.get(shard), ordered=ordered, paths=paths, shard=(shard, shards),
+            batcher=batcher,
+        )
+        for shard in range(shards)
+    }
+    return interleave_shards(sources, readers, mark_done=ordered)
+
+
+def shard_watermark_hooks(store, pipeline, shards, until=None):
+    """Return ``(since, batch_token, on_commit)`` resuming each hash shard from its own watermark.
+
+    ``since`` is a ``{shard: (load_timestamp, eob_id)}`` dict for ``fetch_sharded_batches``; a
+    shard without a saved position starts from the pipeline's watermark. The pipeline's watermark
+    itself moves to the lowest shard position, so an unsharded run can still pick up from it.
+
+    ``until`` is the staging high-water mark read before the scan started (see
+    ``staging_source.staging_high_water``). When the empty batch that ends a shard commits, every
+    row of the shard up to ``until`` has loaded, so the shard moves to ``until``. Without this, a
+    shard with no rows would never record a position and would hold the pipeline watermark back.
+    """
+    base = store.get_position(pipeline)
+    saved = store.get_shard_positions(pipeline, shards)
+    since = {shard: saved.get(shard, base) for shard in range(shards)}
+    caught_up = (to_watermark(until), None) if until is not None else None
+
+    def batch_token(batch):
+        return batch.shard, batch_position(batch)
+
+    def on_commit(seq, token, rows_out):
+        shard, position = token
+        if position is None:
+            # The shard's end-of-scan marker
+            if caught_up is None:
+                return
+            position = caught_up
+        last_load_timestamp, last_id = position
+        store.advance_shard(pipeline, shards, shard, to_watermark(last_load_timestamp), last_id)
+        positions = store.get_shard_positions(pipeline, shards)
+        if len(positions) == shards:
+            store.advance_watermark(pipeline, *min(positions.values(), key=position_order))
+
+    return since, batch_token, on_commit
+
+
+# --------------------
+# Postgres: id ranges
+# --------------------
+def plan_id_ranges(conn, schema, table, shards):
+    """Cut ``min(id)..max(id)`` into ``shards`` ranges ``(after, upto)``, i.e. ``after < id <= upto``.
+
+    The last range has no upper bound, so rows added later fall into it.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT min(id), max(id) FROM {schema}.{table}")
+        low, high = cur.fetchone()
+    if low is None:
+        return [(0, 0)] * (shards - 1) + [(0, None)]
+    width = (high - low + shards) // shards
+    bounds = [(low - 1 + i * width, low - 1 + (i + 1) * width) for i in range(shards)]
+    bounds[-1] = (bounds[-1][0], None)
+    return bounds
+
+
+def fetch_id_range(conn, schema, table, id_field, after, upto=None, batch_size=5000, paths=None):
+    """Yield batches of ``{"id", "resource_id", "resource", "load_timestamp"}`` for ``after < id <= upto``."""
+    upper = "AND id <= %s" if upto is not None else ""
+    sql = f"""
+        SELECT id, {id_field}, {staging_source.postgres_resource_projection(paths)}, load_timestamp
+        FROM {schema}.{table}
+        WHERE id > %s {upper}
+        ORDER BY id
+        LIMIT %s
+    """
+    last = after
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(sql, (last, upto, batch_size) if upto is not None else (last, batch_size))
+            rows = cur.fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [{"id": r[0], "resource_id": r[1], "resource": r[2], "load_timestamp": r[3]} for r in rows]
+
+
+def fetch_id_range_batches(connect, schema, table, id_field, ranges, batch_size=5000, paths=None, readers=None):
+    """Read ``ranges`` (``{shard: (after, upto)}``) concurrently, each on its own ``connect()`` connection."""
+    def read(after, upto):
+        conn = connect()
+        conn.autocommit = True  # plain reads: no transaction held open between pages
+        try:
+            yield from fetch_id_range(conn, schema, table, id_field, after, upto, batch_size, paths)
+        finally:
+            conn.close()
+
+    return interleave_shards({shard: read(after, upto) for shard, (after, upto) in ranges.items()}, readers)
+
+
+def id_range_hooks(store, pipeline, connect, schema, table, shards):
+    """Return ``(ranges, batch_token, on_commit)`` resuming each id range after its last committed id.
+
+    The ranges are planned on the first run and saved, so later runs split the table the same
+    way; ``store.reset_shards(pipeline)`` re-plans.
+    """
+    saved = store.get_shards(pipeline, shards)
+    if len(saved) != shards:
+        conn = connect()
+        try:
+            store.save_shard_bounds(pipeline, plan_id_ranges(conn, schema, table, shards))
+        finally:
+            conn.close()
+        saved = store.get_shards(pipeline, shards)
+    ranges = {
+        shard: (int(position) if position is not None else after, upto)
+        for shard, (after, upto, position) in saved.items()
+    }
+
+    def batch_token(batch):
+        return batch.shard, batch[-1]["id"] if batch else None
+
+    def on_commit(seq, token, rows_out):
+        shard, last_id = token
+        if last_id is not None:
+            # Zero-padded so positions compare correctly as strings
+            store.advance_shard(pipeline, shards, shard, f"{last_id:020d}")
+
+    return ranges, batch_token, on_commit
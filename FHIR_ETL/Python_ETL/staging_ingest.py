@@ -0,0 +1,512 @@
+"""Bulk ingest of FHIR bundle folders into the Postgres staging tables.
+
+``fhir_staging_loader`` issues one COPY per table per file and commits per
+file, on threads that share the GIL for JSON decoding. For the usual
+Synthea output (thousands of small bundles) that is thousands of tiny
+COPYs and commits. This engine instead:
+
+* parses bundles in a process pool; each worker streams one file through
+  ``iter_staging_rows`` and returns its rows already encoded for COPY
+  (binary by default: no CSV quoting, and ``jsonb`` goes in as-is),
+* appends those encoded rows to per-table buffers that span files; a table
+  is flushed once its buffer reaches ``FLUSH_ROWS`` rows or ``FLUSH_BYTES``
+  bytes, or ``COMMIT_INTERVAL`` seconds after its oldest row arrived,
+* runs each flush as one COPY plus one commit on one of
+  ``WRITER_CONNECTIONS`` long-lived connections from a connection pool,
+  with at most that many flushes in flight (parsing waits otherwise),
+* checkpoints a file only once every flush holding its rows has committed.
+  If a flush fails, none of the files in it are checkpointed.
+
+Duplicate ids (across files, or against rows already staged) are merged
+per ``ON_CONFLICT`` as in ``fhir_staging_loader.copy_payload``.
+
+With a ``FINGERPRINT_PATH`` (see ``fingerprints.py``) workers drop every
+resource whose content hash matches the version last committed to its
+table, so re-ingesting a mostly unchanged export costs parsing and hashing
+only. Fingerprints are recorded by the writer once the COPY has committed,
+and only for rows the merge wrote: under ``ON_CONFLICT="skip"`` a changed
+resource that ``DO NOTHING`` left out keeps its old fingerprint, so it is
+offered again on the next ingest.
+
+Bundles larger than ``LARGE_FILE_BYTES`` skip the process pool and are
+streamed by ``stream_large_file`` on a writer connection, so memory stays
+bounded however big a bundle is. They are fingerprinted the same way.
+
+    python staging_ingest.py <folder>
+"""
+import csv
+import glob
+import io
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from etl_metrics import current_metrics
+from fingerprints import FingerprintIndex, canonical_json, fingerprint
+from fhir_staging_loader import (
+    DB_CONFIG,
+    LOADER_CONFIG,
+    TABLE_TO_TYPE,
+    TableBuffers,
+    copy_payload,
+    iter_staging_rows,
+    load_checkpoint,
+    save_checkpoint,
+)
+
+logger = logging.getLogger("staging_ingest")
+
+# -----------------------------
+# Configuration
+# -----------------------------
+INGEST_CONFIG = {
+    "PARSE_WORKERS": os.cpu_count() or 1,
+    "MAX_PENDING_FILES": None,        # files parsed ahead of the writers; default 2 x PARSE_WORKERS
+    "WRITER_CONNECTIONS": 4,          # long-lived connections, = max concurrent COPY+commit
+    "FLUSH_ROWS": 50000,              # per-table buffer size that triggers a COPY ...
+    "FLUSH_BYTES": 64 * 2**20,        # ... or encoded bytes, whichever comes first
+    "COMMIT_INTERVAL": 30.0,          # seconds a row may wait in a buffer before its table is flushed
+    "COPY_FORMAT": "binary",          # "binary" or "csv"
+    "LARGE_FILE_BYTES": 256 * 2**20,  # bundles above this are streamed by fhir_staging_loader instead
+    "CHECKPOINT_INTERVAL": 10.0,      # seconds between checkpoint saves
+    "FINGERPRINT_PATH": "staging_fingerprints.db",  # skip unchanged resources; None loads everything
+}
+
+_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_BINARY_TRAILER = struct.pack("!h", -1)
+_JSONB_VERSION = b"\x01"
+
+
+def encode_binary_row(rid, resource_json):
+    """One ``(text id, jsonb resource)`` tuple in COPY binary format."""
+    rid = rid.encode("utf-8")
+    return b"".join((
+        struct.pack("!hi", 2, len(rid)), rid,
+        struct.pack("!i", len(resource_json) + 1), _JSONB_VERSION, resource_json,
+    ))
+
+
+def encode_csv_row(rid, resource_json):
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_MINIMAL).writerow((rid, resource_json.decode("utf-8")))
+    return buffer.getvalue().encode("utf-8")
+
+
+# -----------------------------
+# Parse workers (run in the process pool)
+# -----------------------------
+_worker_index = {}  # fingerprint path -> FingerprintIndex, one per worker process
+
+
+def fingerprint_scope(schema, table):
+    return f"{schema}.{table}"
+
+
+def written_digests(digests, written_ids, on_conflict):
+    """The digests to record after a merge: under ``"skip"`` only those of rows it inserted."""
+    if on_conflict != "skip":
+        return digests
+    return [d for d in digests if d[0] in written_ids]
+
+
+def parse_bundle_file(file_path, copy_format=None, chunk_chars=None, fingerprint_path=None, schema=None):
+    """Encode one bundle's rows for COPY.
+
+    Returns ``(file_path, {(table, id_field): (n_rows, payload, digests)}, skipped)`` where ``payload``
+    is the concatenated encoded rows (no binary header/trailer), ``digests`` the rows'
+    ``(id, fingerprint)`` pairs (empty without ``fingerprint_path``) and ``skipped`` counts unmapped
+    resourceTypes and, under ``"unchanged"``, resources dropped because their fingerprint matched.
+    """
+    encode = encode_binary_row if (copy_format or INGEST_CONFIG["COPY_FORMAT"]) == "binary" else encode_csv_row
+    schema = schema or LOADER_CONFIG["SCHEMA"]
+    skipped = Counter()
+    rows = {}
+    with open(file_path, "r", encoding="utf-8") as f:
+        for table, id_field, rid, resource in iter_staging_rows(f, skipped, chunk_chars):
+            resource_json = canonical_json(resource)
+            rows.setdefault((table, id_field), []).append((rid, resource_json))
+
+    index = None
+    if fingerprint_path:
+        index = _worker_index.get(fingerprint_path)
+        if index is None:
+            index = _worker_index[fingerprint_path] = FingerprintIndex(fingerprint_path)
+    tables = {}
+    for (table, id_field), table_rows in rows.items():
+        digests = []
+        if index is not None:
+            digests = [(rid, fingerprint(resource_json)) for rid, resource_json in table_rows]
+            unchanged = index.unchanged(fingerprint_scope(schema, table), digests)
+            if unchanged:
+                skipped["unchanged"] += len(unchanged)
+                table_rows = [row for row in table_rows if row[0] not in unchanged]
+                digests = [d for d in digests if d[0] not in unchanged]
+        payload = b"".join(encode(rid, resource_json) for rid, resource_json in table_rows)
+        tables[(table, id_field)] = (len(table_rows), payload, digests)
+    return file_path, tables, skipped
+
+
+# -----------------------------
+# Cross-file table buffers and writers
+# -----------------------------
+class _TableBuffer:
+    def __init__(self):
+        self.parts = []
+        self.rows = 0
+        self.bytes = 0
+        self.files = []
+        self.digests = []
+        self.started = time.monotonic()
+
+
+class IngestWriter:
+    """Per-table COPY buffers shared by many files, flushed on pooled connections.
+
+    ``pool`` has the ``psycopg2.pool.ThreadedConnectionPool`` surface (``getconn``/``putconn``) and
+    at least ``writer_connections`` connections. Files whose rows have all committed are collected
+    and handed out by ``drain_done()``; files that were part of a failed flush by ``drain_failed()``.
+    With ``fingerprints`` (a FingerprintIndex) the digests of committed rows are recorded there.
+    """
+
+    def __init__(self, pool, schema=None, copy_format=None, flush_rows=None, flush_bytes=None,
+                 commit_interval=None, writer_connections=None, on_conflict=None, fingerprints=None):
+        self.pool = pool
+        self.schema = schema or LOADER_CONFIG["SCHEMA"]
+        self.copy_format = copy_format or INGEST_CONFIG["COPY_FORMAT"]
+        self.flush_rows = INGEST_CONFIG["FLUSH_ROWS"] if flush_rows is None else flush_rows
+        self.flush_bytes = INGEST_CONFIG["FLUSH_BYTES"] if flush_bytes is None else flush_bytes
+        self.commit_interval = INGEST_CONFIG["COMMIT_INTERVAL"] if commit_interval is None else commit_interval
+        self.writer_connections = writer_connections or INGEST_CONFIG["WRITER_CONNECTIONS"]
+        self.on_conflict = on_conflict or LOADER_CONFIG["ON_CONFLICT"]
+        self.fingerprints = fingerprints
+
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(self.writer_connections)
+        self._executor = ThreadPoolExecutor(max_workers=self.writer_connections, thread_name_prefix="staging-copy")
+        self._pending = {}      # file -> flushes still holding its rows
+        self._failed = set()
+        self._done = []
+        self._failed_files = []
+        self.counts = Counter()  # resourceType -> rows committed
+        self.stats = {"copies": 0, "commits": 0, "rows": 0, "merged": 0, "bytes": 0, "failed_copies": 0}
+
+    # --------------------
+    # Buffering
+    # --------------------
+    def add_file(self, file_path, tables):
+        """Buffer one parsed file (``tables`` as returned by ``parse_bundle_file``)."""
+        tables = {key: value for key, value in tables.items() if value[0]}
+        if not tables:
+            with self._lock:
+                self._done.append(file_path)
+            return
+        with self._lock:
+            self._pending[file_path] = len(tables)
+        for key, (n_rows, payload, digests) in tables.items():
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = _TableBuffer()
+            buffer.parts.append(payload)
+            buffer.rows += n_rows
+            buffer.bytes += len(payload)
+            buffer.files.append(file_path)
+            buffer.digests.extend(digests)
+            if buffer.rows >= self.flush_rows or buffer.bytes >= self.flush_bytes:
+                self.flush_table(key)
+
+    def add_committed_file(self, file_path, counts):
+        """Record a file that was loaded and committed outside the buffers (a large bundle)."""
+        with self._lock:
+            self.counts.update(counts)
+            self._done.append(file_path)
+
+    def flush_stale(self):
+        """Flush tables whose oldest buffered row has waited ``commit_interval`` seconds."""
+        now = time.monotonic()
+        for key in [k for k, b in self._buffers.items() if now - b.started >= self.commit_interval]:
+            self.flush_table(key)
+
+    def flush_table(self, key):
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            return
+        with current_metrics().time("copy_wait"):
+            self._slots.acquire()
+        self._executor.submit(self._write, key, buffer)
+
+    def flush_all(self):
+        for key in list(self._buffers):
+            self.flush_table(key)
+
+    def close(self):
+        """Flush every buffer and wait for all writes to finish."""
+        self.flush_all()
+        self._executor.shutdown(wait=True)
+
+    def drain_done(self):
+        with self._lock:
+            done, self._done = self._done, []
+        return done
+
+    def drain_failed(self):
+        with self._lock:
+            failed, self._failed_files = self._failed_files, []
+        return failed
+
+    # --------------------
+    # Writers
+    # --------------------
+    def _payload(self, buffer):
+        if self.copy_format == "binary":
+            return io.BytesIO(b"".join([_BINARY_HEADER, *buffer.parts, _BINARY_TRAILER]))
+        return io.BytesIO(b"".join(buffer.parts))
+
+    def run_on_connection(self, fn, *args):
+        """Call ``fn(conn, *args)`` with a pooled connection."""
+        conn = self.pool.getconn()
+        try:
+            return fn(conn, *args)
+        finally:
+            self.pool.putconn(conn)
+
+    def _copy_and_commit(self, conn, table, id_field, buffer):
+        metrics = current_metrics()
+        written_ids = set() if buffer.digests and self.on_conflict == "skip" else None
+        try:
+            with metrics.time("copy"):
+                merged = copy_payload(
+                    conn, table, id_field, self._payload(buffer),
+                    "binary" if self.copy_format == "binary" else "csv", self.schema, self.on_conflict,
+                    written_ids,
+                )
+            with metrics.time("commit"):
+                conn.commit()
+            if written_ids is not None:
+                buffer.digests = written_digests(buffer.digests, written_ids, self.on_conflict)
+            return merged
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _write(self, key, buffer):
+        table, id_field = key
+        try:
+            merged = self.run_on_connection(self._copy_and_commit, table, id_field, buffer)
+        except Exception as e:
+            logger.error(f"COPY of {buffer.rows} rows into {table} from {len(buffer.files)} file(s) failed: {e}")
+            with self._lock:
+                self.stats["failed_copies"] += 1
+                self._failed.update(buffer.files)
+            ok = False
+        else:
+            if self.fingerprints is not None:
+                self.fingerprints.record(fingerprint_scope(self.schema, table), buffer.digests)
+            metrics = current_metrics()
+            metrics.add("rows_copied", buffer.rows)
+            metrics.add("bytes_copied", buffer.bytes)
+            metrics.add("rows_merged", merged)
+            with self._lock:
+                self.stats["copies"] += 1
+                self.stats["commits"] += 1
+                self.stats["rows"] += buffer.rows
+                self.stats["merged"] += merged
+                self.stats["bytes"] += buffer.bytes
+                self.counts[TABLE_TO_TYPE[table]] += buffer.rows
+            logger.info(f"Copied {buffer.rows} rows into {table} from {len(buffer.files)} file(s), {merged} inserted or updated")
+            ok = True
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            for file_path in buffer.files:
+                self._pending[file_path] -= 1
+                if self._pending[file_path]:
+                    continue
+                del self._pending[file_path]
+                if file_path in self._failed:
+                    self._failed.discard(file_path)
+                    self._failed_files.append(file_path)
+                else:
+                    self._done.append(file_path)
+        return ok
+
+
+# -----------------------------
+# Large bundles
+# -----------------------------
+def stream_large_file(conn, file_path, schema, on_conflict, fingerprints=None):
+    """Stream one bundle into the staging tables on ``conn`` and commit once.
+
+    Rows are merged in ``fhir_staging_loader.TableBuffers`` flushes, as ``process_file`` does, but
+    with the writer's schema and ``on_conflict`` and, with ``fingerprints``, the same skipping of
+    unchanged resources as ``parse_bundle_file``. The digests to record are held until the commit.
+    Returns ``(rows copied per resourceType, skipped)``; the caller handles errors.
+    """
+    skipped = Counter()
+    committed = {}  # scope -> digests to record once the file commits
+
+    def flush(table, id_field, rows):
+        scope = fingerprint_scope(schema, table)
+        digests = []
+        if fingerprints is not None:
+            digests = [(rid, fingerprint(resource_json)) for rid, resource_json in rows]
+            unchanged = fingerprints.unchanged(scope, digests)
+            if unchanged:
+                skipped["unchanged"] += len(unchanged)
+                rows = [row for row in rows if row[0] not in unchanged]
+                digests = [d for d in digests if d[0] not in unchanged]
+        if not rows:
+            return
+        written_ids = set() if digests and on_conflict == "skip" else None
+        payload = b"".join([_BINARY_HEADER, *(encode_binary_row(*row) for row in rows), _BINARY_TRAILER])
+        copy_payload(conn, table, id_field, io.BytesIO(payload), "binary", schema, on_conflict, written_ids)
+        counts[TABLE_TO_TYPE[table]] += len(rows)
+        committed.setdefault(scope, []).extend(written_digests(digests, written_ids, on_conflict))
+
+    counts = Counter()
+    buffers = TableBuffers(flush)
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            for table, id_field, rid, resource in iter_staging_rows(f, skipped):
+                buffers.add(table, id_field, rid, canonical_json(resource))
+        buffers.flush_all()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if fingerprints is not None:
+        for scope, digests in committed.items():
+            fingerprints.record(scope, digests)
+    logger.info(f"Streamed {os.path.basename(file_path)}: {dict(counts)}")
+    return counts, skipped
+
+
+# -----------------------------
+# Folder ingest
+# -----------------------------
+def make_connection_pool(size=None):
+    """A ``psycopg2`` ThreadedConnectionPool with ``size`` long-lived connections to the staging DB."""
+    from psycopg2.pool import ThreadedConnectionPool
+
+    size = size or INGEST_CONFIG["WRITER_CONNECTIONS"]
+    return ThreadedConnectionPool(1, size, **DB_CONFIG)
+
+
+def ingest_files(files, pool=None, parse_workers=None, max_pending_files=None, checkpoint_path=None,
+                 processed_files=None, fingerprint_path=None, **writer_options):
+    """Load ``files`` into the staging tables; returns (rows committed per resourceType, failed files).
+
+    ``processed_files`` (a set) is updated with committed files and saved to ``checkpoint_path``
+    every ``CHECKPOINT_INTERVAL`` seconds and at the end, when a path is given.
+    ``fingerprint_path`` defaults to ``FINGERPRINT_PATH``; pass ``""`` to load every resource.
+    """
+    parse_workers = parse_workers or INGEST_CONFIG["PARSE_WORKERS"]
+    fingerprint_path = INGEST_CONFIG["FINGERPRINT_PATH"] if fingerprint_path is None else fingerprint_path
+    max_pending_files = max_pending_files or INGEST_CONFIG["MAX_PENDING_FILES"] or 2 * parse_workers
+    processed_files = set() if processed_files is None else processed_files
+    owns_pool = pool is None
+    pool = pool or make_connection_pool(writer_options.get("writer_connections"))
+    # Created here first, so the table exists before the workers open the file
+    fingerprints = FingerprintIndex(fingerprint_path) if fingerprint_path else None
+    writer = IngestWriter(pool, fingerprints=fingerprints, **writer_options)
+    metrics = current_metrics()
+    failed = []
+    skipped = Counter()
+    last_save = time.monotonic()
+
+    def collect():
+        nonlocal last_save
+        processed_files.update(writer.drain_done())
+        failed.extend(writer.drain_failed())
+        if checkpoint_path and time.monotonic() - last_save >= INGEST_CONFIG["CHECKPOINT_INTERVAL"]:
+            save_checkpoint(processed_files, checkpoint_path)
+            last_save = time.monotonic()
+
+    small = []
+    for file_path in files:
+        if os.path.getsize(file_path) > INGEST_CONFIG["LARGE_FILE_BYTES"]:
+            logger.info(f"Streaming large bundle {os.path.basename(file_path)} on its own connection")
+            try:
+                counts, file_skipped = writer.run_on_connection(
+                    stream_large_file, file_path, writer.schema, writer.on_conflict, fingerprints
+                )
+            except Exception as e:
+                logger.error(f"Failed to stream {file_path}: {e}")
+                failed.append(file_path)
+            else:
+                skipped.update(file_skipped)
+                writer.add_committed_file(file_path, counts)
+        else:
+            small.append(file_path)
+
+    try:
+        with ProcessPoolExecutor(max_workers=parse_workers) as parsers:
+            queued = iter(small)
+            running = set()
+            while True:
+                while len(running) < max_pending_files:
+                    file_path = next(queued, None)
+                    if file_path is None:
+                        break
+                    running.add(parsers.submit(
+                        parse_bundle_file, file_path, writer.copy_format, None, fingerprint_path, writer.schema
+                    ))
+                if not running:
+                    break
+                with metrics.time("parse_wait"):
+                    finished, running = wait(running, timeout=max(0.1, writer.commit_interval / 4),
+                                             return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        file_path, tables, file_skipped = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to parse bundle: {e}")
+                        continue
+                    skipped.update(file_skipped)
+                    metrics.add("files_parsed")
+                    writer.add_file(file_path, tables)
+                writer.flush_stale()
+                collect()
+    finally:
+        writer.close()
+        if owns_pool:
+            pool.closeall()
+        if fingerprints is not None:
+            fingerprints.close()
+    collect()
+    if checkpoint_path:
+        save_checkpoint(processed_files, checkpoint_path)
+
+    unchanged = skipped.pop("unchanged", 0)
+    metrics.add("rows_unchanged", unchanged)
+    if skipped:
+        logger.warning(f"Skipped unsupported resourceTypes: {dict(skipped)}")
+    if unchanged:
+        logger.info(f"Skipped {unchanged} resources unchanged since they were last staged")
+    logger.info(f"Ingest finished: {writer.stats}, {len(failed)} file(s) failed")
+    return writer.counts, failed
+
+
+def ingest_folder(folder_path, pool=None, checkpoint_path=None, **options):
+    """Ingest every ``*.json`` bundle in ``folder_path`` not yet listed in the checkpoint."""
+    checkpoint_path = checkpoint_path or LOADER_CONFIG["CHECKPOINT_FILE"]
+    files = [os.path.abspath(f) for f in glob.glob(os.path.join(folder_path, "*.json"))]
+    processed_files = load_checkpoint(checkpoint_path)
+    remaining_files = [f for f in files if f not in processed_files]
+    logger.info(f"Ingesting {len(remaining_files)} of {len(files)} files...")
+    totals, failed = ingest_files(
+        remaining_files, pool=pool, checkpoint_path=checkpoint_path, processed_files=processed_files, **options
+    )
+    logger.info(f"All files processed. Totals by resourceType: {dict(totals)}")
+    return totals
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    ingest_folder(sys.argv[1])
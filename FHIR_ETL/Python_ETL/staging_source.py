@@ -0,0 +1,186 @@
+"""Batched reads of the BigQuery ``fhir_staging`` ExplanationOfBenefit table.
+
+Shared by the curated EOB pipelines. In incremental mode only rows past a
+high-water mark are read, in ``(load_timestamp, eob_id)`` order. The mark is
+a position in that order (see ``etl_checkpoint``), so a batch can be cut
+anywhere, even inside the single timestamp of one large COPY, and committing
+it advances the mark to its last row.
+
+Transforms declare the top-level resource keys they read (``RESOURCE_PATHS``).
+When given, the scan projects only those sub-documents server-side with
+``JSON_QUERY`` and re-assembles a smaller resource document client-side,
+so the rest of each EOB is never transferred or parsed.
+
+A scan can be limited to one of N disjoint shards by hash of the EOB id
+(``shard=(index, count)``); ``sharded_source`` runs the shards concurrently.
+"""
+import re
+import time
+
+from etl_metrics import current_metrics
+
+_PATH_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def staging_table_id(config):
+    return f"{config['BQ_PROJECT']}.{config['BQ_DATASET_RAW']}.{config['BQ_TABLE_RAW']}"
+
+
+def _check_paths(paths):
+    for path in paths:
+        if not _PATH_RE.match(path):
+            raise ValueError(f"Only top-level resource keys can be projected, got {path!r}")
+    return list(dict.fromkeys(paths))
+
+
+def merge_paths(*path_lists):
+    """Union of several transforms' resource paths; None if any transform needs the whole resource."""
+    if any(paths is None for paths in path_lists):
+        return None
+    return [p for paths in path_lists for p in paths]
+
+
+def resource_projection(paths):
+    """``SELECT`` list fragment for the resource: the whole column, or one JSON_QUERY per path."""
+    if not paths:
+        return "resource"
+    return ", ".join(f"JSON_QUERY(resource, '$.{path}') AS res_{i}" for i, path in enumerate(_check_paths(paths)))
+
+
+def postgres_resource_projection(paths):
+    """The same projection for the Postgres ``fhir_staging`` JSONB tables, as one JSON text column.
+
+    Text rather than jsonb: orjson parses it faster than psycopg2's jsonb typecaster. Like
+    ``assemble_resource``, absent keys are left out and everything under a kept key is unchanged.
+    """
+    if not paths:
+        return "resource::text AS resource"
+    keys = ", ".join(f"'{path}'" for path in _check_paths(paths))
+    return (
+        f"COALESCE((SELECT jsonb_object_agg(key, value) FROM jsonb_each(resource) WHERE key IN ({keys})), "
+        f"'{{}}'::jsonb)::text AS resource"
+    )
+
+
+def assemble_resource(row, paths):
+    """Rebuild a (partial) resource document from projected ``res_<i>`` columns.
+
+    The staging ``resource`` column is JSON text, so JSON_QUERY returns JSON text too and the
+    parts are spliced into one document without being parsed here.
+    """
+    parts = []
+    for i, path in enumerate(paths):
+        value = row[f"res_{i}"]
+        if value is not None:
+            parts.append(f'"{path}":{value}')
+    return "{" + ",".join(parts) + "}"
+
+
+def shard_condition(shard):
+    """Predicate selecting shard ``index`` of ``count`` by a hash of the EOB id.
+
+    ``ABS`` is taken after ``MOD``: ``ABS(FARM_FINGERPRINT(...))`` overflows for the minimum INT64.
+    """
+    index, count = shard
+    return f"ABS(MOD(FARM_FINGERPRINT(explanationofbenefit_id), {int(count)})) = {int(index)}"
+
+
+def _staging_filter(since=None, shard=None):
+    """``(where, job_config)`` for the rows past ``since`` in ``shard``.
+
+    ``since`` is a ``load_timestamp`` or a ``(load_timestamp, eob_id)`` position; rows at that
+    timestamp with an id up to ``eob_id`` are excluded too.
+    """
+    mark, key = since if isinstance(since, tuple) else (since, None)
+    conditions = []
+    if mark is not None:
+        if key is None:
+            conditions.append("load_timestamp > @since")
+        else:
+            conditions.append(
+                "(load_timestamp > @since OR (load_timestamp = @since AND explanationofbenefit_id > @since_id))"
+            )
+    if shard is not None:
+        conditions.append(shard_condition(shard))
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    job_config = None
+    if mark is not None:
+        from google.cloud import bigquery
+
+        params = [bigquery.ScalarQueryParameter("since", "TIMESTAMP", mark)]
+        if key is not None:
+            params.append(bigquery.ScalarQueryParameter("since_id", "STRING", key))
+        job_config = bigquery.QueryJobConfig(query_parameters=params)
+    return where, job_config
+
+
+def build_staging_query(table_id, since=None, ordered=False, paths=None, shard=None):
+    """Return ``(sql, job_config)`` for the staging scan, optionally past a watermark and for one shard.
+
+    An ordered scan is one ``ORDER BY`` over every row it reads. Past a watermark that is the new
+    rows only, but from no watermark it is the whole table (or shard), which BigQuery may refuse
+    with "resources exceeded" when the table is large; more shards make each sort smaller.
+    """
+    where, job_config = _staging_filter(since, shard)
+    order = "ORDER BY load_timestamp, explanationofbenefit_id" if ordered else ""
+    sql = f"""
+        SELECT explanationofbenefit_id AS eob_id, {resource_projection(paths)}, load_timestamp
+        FROM `{table_id}`
+        {where}
+        {order}
+    """
+    return sql, job_config
+
+
+def count_staging_rows(client, table_id, since=None, shard=None):
+    """Rows the staging scan with the same filters would read, counted server-side.
+
+    Only ``load_timestamp`` (and the id, for a shard) is referenced, so the count reads a small
+    fraction of the bytes of the scan itself.
+    """
+    where, job_config = _staging_filter(since, shard)
+    rows = client.query(f"SELECT COUNT(*) AS row_count FROM `{table_id}` {where}", job_config=job_config).result()
+    row = next(iter(rows), None)
+    return row["row_count"] if row is not None else 0
+
+
+def staging_high_water(client, table_id):
+    """Latest ``load_timestamp`` in the staging table, or None when it is empty."""
+    rows = client.query(f"SELECT MAX(load_timestamp) AS high_water FROM `{table_id}`").result()
+    row = next(iter(rows), None)
+    return row["high_water"] if row is not None else None
+
+
+def fetch_staging_batches(client, table_id, batch_size=5000, since=None, ordered=False, paths=None, shard=None,
+                          batcher=None):
+    """Yield lists of ``{"eob_id", "resource", "load_timestamp"}`` dicts from the staging table.
+
+    With ``ordered=True`` rows come in ``(load_timestamp, eob_id)`` order, so a batch's last row
+    is a position to resume after. With ``paths`` the resource only contains those top-level
+    keys. ``shard=(index, count)`` reads one hash shard only.
+    With an ``adaptive_batcher.AdaptiveBatcher`` as ``batcher``, the batcher decides where each
+    batch is cut instead, from its row count and resource bytes.
+    """
+    paths = _check_paths(paths) if paths else None
+    sql, job_config = build_staging_query(table_id, since=since, ordered=ordered, paths=paths, shard=shard)
+    start = time.perf_counter()
+    query_job = client.query(sql, job_config=job_config)
+    iterator = query_job.result(page_size=batch_size)
+    current_metrics().observe("query", time.perf_counter() - start)
+
+    metrics = current_metrics()
+    batch = []
+    resource_bytes = 0
+    for row in iterator:
+        if len(batch) >= batch_size if batcher is None else batcher.full(len(batch), resource_bytes):
+            metrics.add("resource_bytes_fetched", resource_bytes)
+            yield batch
+            batch = []
+            resource_bytes = 0
+        resource = assemble_resource(row, paths) if paths else row["resource"]
+        resource_bytes += len(resource) if isinstance(resource, str) else 0
+        batch.append({"eob_id": row["eob_id"], "resource": resource, "load_timestamp": row["load_timestamp"]})
+
+    if batch:
+        metrics.add("resource_bytes_fetched", resource_bytes)
+        yield batch
@@ -0,0 +1,182 @@
+"""Seeded synthetic FHIR ExplanationOfBenefit generator.
+
+Produces staging-shaped rows (``{"eob_id", "resource", "load_timestamp"}``,
+resource as JSON text) that look like Synthea output closely enough to
+exercise the curated transforms, with knobs for the things that drive their
+cost and their edge cases:
+
+* ``items_per_eob`` / ``coverage_per_eob``: an int or an inclusive ``(lo, hi)`` range
+* ``shape``: ``"dict"`` (canonical FHIR), ``"list"`` (single-valued fields wrapped
+  in one-element lists, as some exports do) or ``"mixed"`` (random per field)
+* ``malformed_rate``: fraction of items/Coverages with a bad value (unparseable
+  amount, wrong-typed or missing element)
+
+The same seed always yields the same rows.
+"""
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+
+CATEGORIES = [
+    ("https://bluebutton.cms.gov/resources/variables/line_cms_type_srvc_cd", "1", "Medical care"),
+    ("https://bluebutton.cms.gov/resources/variables/line_cms_type_srvc_cd", "5", "Diagnostic laboratory"),
+    ("https://bluebutton.cms.gov/resources/variables/line_cms_type_srvc_cd", "9", "Other medical items or services"),
+]
+PRODUCTS = [
+    ("http://snomed.info/sct", "185349003", "Encounter for check up (procedure)"),
+    ("http://snomed.info/sct", "162673000", "General examination of patient (procedure)"),
+    ("http://snomed.info/sct", "430193006", "Medication Reconciliation (procedure)"),
+    ("http://snomed.info/sct", "710824005", "Assessment of health and social care needs (procedure)"),
+    ("http://hl7.org/fhir/sid/cvx", "140", "Influenza, seasonal, injectable, preservative free"),
+    ("http://loinc.org", "24323-8", "Comprehensive metabolic 2000 panel - Serum or Plasma"),
+]
+LOCATIONS = [
+    ("http://terminology.hl7.org/CodeSystem/ex-serviceplace", "19", "Off Campus-Outpatient Hospital"),
+    ("http://terminology.hl7.org/CodeSystem/ex-serviceplace", "21", "Inpatient Hospital"),
+    ("http://terminology.hl7.org/CodeSystem/ex-serviceplace", "11", "Office"),
+]
+ADJUDICATIONS = [
+    ("https://bluebutton.cms.gov/resources/variables/line_coinsrnc_amt", "Line Beneficiary Coinsurance Amount"),
+    ("https://bluebutton.cms.gov/resources/variables/line_prvdr_pmt_amt", "Line Provider Payment Amount"),
+    ("https://bluebutton.cms.gov/resources/variables/line_sbmtd_chrg_amt", "Line Submitted Charge Amount"),
+    ("https://bluebutton.cms.gov/resources/variables/line_alowd_chrg_amt", "Line Allowed Charge Amount"),
+    ("https://bluebutton.cms.gov/resources/variables/line_bene_ptb_ddctbl_amt", "Line Beneficiary Part B Deductible Amount"),
+]
+PAYORS = ["Medicare", "Medicaid", "Blue Cross Blue Shield", "Aetna", "UnitedHealthcare", "NO_INSURANCE"]
+
+
+class SyntheticEOBGenerator:
+    def __init__(self, seed=0, items_per_eob=(1, 12), coverage_per_eob=(1, 2), shape="dict",
+                 malformed_rate=0.0, start=datetime(2015, 1, 1)):
+        if shape not in ("dict", "list", "mixed"):
+            raise ValueError(f"Unknown shape: {shape!r}")
+        self.rng = random.Random(seed)
+        self.items_per_eob = items_per_eob
+        self.coverage_per_eob = coverage_per_eob
+        self.shape = shape
+        self.malformed_rate = malformed_rate
+        self.start = start
+
+    # --------------------
+    # Helpers
+    # --------------------
+    def _count(self, spec):
+        return self.rng.randint(*spec) if isinstance(spec, tuple) else spec
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def _shaped(self, value):
+        """Wrap a single-valued element in a list according to ``shape``."""
+        if self.shape == "list" or (self.shape == "mixed" and self.rng.random() < 0.5):
+            return [value]
+        return value
+
+    def _malformed(self):
+        return self.malformed_rate and self.rng.random() < self.malformed_rate
+
+    def _coding(self, system, code, display):
+        return {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+
+    def _money(self):
+        return {"value": round(self.rng.uniform(0, 2500), 2), "currency": "USD"}
+
+    # --------------------
+    # Resources
+    # --------------------
+    def item(self, sequence, encounter_ref, start, end):
+        item = {
+            "sequence": self._shaped(sequence),
+            "category": self._shaped(self._coding(*self.rng.choice(CATEGORIES))),
+            "productOrService": self._coding(*self.rng.choice(PRODUCTS)),
+            "servicedPeriod": {"start": start, "end": end},
+            "locationCodeableConcept": self._shaped(self._coding(*self.rng.choice(LOCATIONS))),
+            "encounter": [{"reference": encounter_ref}],
+            "diagnosisSequence": [self.rng.randint(1, 3)],
+            "adjudication": [
+                {
+                    "category": {"coding": [{"system": system, "code": system.rsplit("/", 1)[-1], "display": display}]},
+                    "amount": self._money(),
+                }
+                for system, display in self.rng.sample(ADJUDICATIONS, self.rng.randint(1, len(ADJUDICATIONS)))
+            ],
+        }
+        if self.rng.random() < 0.5:
+            item["net"] = self._money()
+        else:
+            item["total"] = [{"amount": self._money()}]
+        if self.rng.random() < 0.3:
+            item["quantity"] = {"value": self.rng.randint(1, 4)}
+
+        if self._malformed():
+            kind = self.rng.randrange(3)
+            if kind == 0:
+                item["adjudication"][0]["amount"]["value"] = "N/A"
+            elif kind == 1:
+                item["category"] = "unknown"
+            else:
+                del item["productOrService"]
+        return item
+
+    def coverage(self, index, patient_ref):
+        payor = self.rng.choice(PAYORS)
+        coverage = {
+            "resourceType": "Coverage",
+            "id": f"coverage{index}" if self.rng.random() < 0.95 else None,
+            "status": "active",
+            "type": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "PUBLICPOL", "display": payor}]},
+            "beneficiary": {"reference": patient_ref},
+            "payor": [{"display": payor}],
+            "identifier": [{"system": "https://bluebutton.cms.gov/resources/variables/bene_id", "value": self._uuid()}],
+            "period": {"start": self.start.isoformat() + "Z"},
+        }
+        if coverage["id"] is None:
+            del coverage["id"]
+        if self._malformed():
+            coverage["type"] = "unknown" if self.rng.random() < 0.5 else [None]
+        return coverage
+
+    def eob(self, index):
+        eob_id = self._uuid()
+        patient_ref = f"urn:uuid:{self._uuid()}"
+        encounter_ref = f"urn:uuid:{self._uuid()}"
+        start_dt = self.start + timedelta(minutes=self.rng.randint(0, 60 * 24 * 365 * 8))
+        start = start_dt.isoformat() + "+00:00"
+        end = (start_dt + timedelta(minutes=self.rng.randint(15, 240))).isoformat() + "+00:00"
+
+        contained = [self.coverage(i, patient_ref) for i in range(self._count(self.coverage_per_eob))]
+        return {
+            "resourceType": "ExplanationOfBenefit",
+            "id": eob_id,
+            "contained": contained,
+            "status": "active",
+            "type": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/claim-type", "code": "professional"}]},
+            "patient": {"reference": patient_ref},
+            "billablePeriod": {"start": start, "end": end},
+            "created": end,
+            "insurer": {"display": contained[0]["payor"][0]["display"] if contained else "NO_INSURANCE"},
+            "provider": {"reference": f"urn:uuid:{self._uuid()}"},
+            "outcome": "complete",
+            "insurance": [
+                {"focal": i == 0, "coverage": {"reference": f"#{c.get('id', '')}"}}
+                for i, c in enumerate(contained)
+            ],
+            "item": [
+                self.item(seq, encounter_ref, start, end)
+                for seq in range(1, self._count(self.items_per_eob) + 1)
+            ],
+            "total": [{"category": {"coding": [{"code": "submitted"}]}, "amount": self._money()}],
+            "payment": {"amount": self._money()},
+        }
+
+    def rows(self, count, load_timestamp="2025-01-01 00:00:00"):
+        """Staging rows for ``count`` EOBs, resources serialized as JSON text."""
+        for index in range(count):
+            resource = self.eob(index)
+            yield {"eob_id": resource["id"], "resource": json.dumps(resource), "load_timestamp": load_timestamp}
+
+
+def generate_rows(count, seed=0, **options):
+    """Convenience wrapper: a list of ``count`` staging rows from a fresh generator."""
+    return list(SyntheticEOBGenerator(seed=seed, **options).rows(count))
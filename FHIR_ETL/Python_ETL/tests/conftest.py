@@ -0,0 +1,74 @@
+"""Shared fixtures. Tests run against ``local_bq`` / ``local_pg``, never the real services.
+
+    cd FHIR_ETL/Python_ETL && python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EOBS_etl
+import etl_profile
+from etl_checkpoint import CheckpointStore
+from etl_metrics import METRICS_CONFIG
+from local_bq import LocalBigQueryClient
+from staging_source import staging_table_id
+from synthetic_eob import generate_rows
+
+
+@pytest.fixture(autouse=True)
+def run_outputs(tmp_path, monkeypatch):
+    """Run reports and profiles go to the test's temporary directory, not the working directory."""
+    monkeypatch.setitem(METRICS_CONFIG, "REPORT_DIR", str(tmp_path / "etl_reports"))
+    monkeypatch.setitem(METRICS_CONFIG, "PROMETHEUS_TEXTFILE_DIR", None)
+    monkeypatch.setitem(METRICS_CONFIG, "PROFILE_INTERVAL", 0)
+    monkeypatch.setitem(etl_profile.PROFILE_CONFIG, "DIR", str(tmp_path / "etl_profiles"))
+
+
+@pytest.fixture
+def bq():
+    return LocalBigQueryClient(seed=0)
+
+
+@pytest.fixture
+def checkpoints():
+    store = CheckpointStore(":memory:")
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def items_config(monkeypatch):
+    """``EOBS_etl.ETL_CONFIG`` with fixed 100-row batches and the optional stages off."""
+    for key, value in {
+        "BATCH_SIZE": 100, "ADAPTIVE_BATCHES": False, "PROFILE": False, "SKIP_UNCHANGED": False,
+        "CODE_DICTIONARY": False, "COALESCE_LOADS": False, "SINK": "parquet", "SHARDS": 1, "INCREMENTAL": True,
+    }.items():
+        monkeypatch.setitem(EOBS_etl.ETL_CONFIG, key, value)
+    return EOBS_etl.ETL_CONFIG
+
+
+@pytest.fixture
+def stage(bq):
+    """``stage(count, seed, load_timestamp)`` appends synthetic EOBs to the staging table; returns their ids."""
+    def stage(count, seed=0, load_timestamp="2025-01-01 00:00:00"):
+        rows = generate_rows(count, seed=seed)
+        bq.insert_rows(staging_table_id(EOBS_etl.ETL_CONFIG), [
+            {"explanationofbenefit_id": r["eob_id"], "resource": r["resource"], "load_timestamp": load_timestamp}
+            for r in rows
+        ])
+        return [r["eob_id"] for r in rows]
+
+    return stage
+
+
+@pytest.fixture
+def curated_rows(bq):
+    """``curated_rows(table)``: the rows loaded into a curated table so far."""
+    def curated_rows(table="eob_items"):
+        config = EOBS_etl.ETL_CONFIG
+        return bq.fetch_rows(f"{config['BQ_PROJECT']}.{config['BQ_DATASET_CURATED']}.{table}")
+
+    return curated_rows
@@ -0,0 +1,69 @@
+"""AdaptiveBatcher: limits converge on the output targets and move at most MAX_STEP per batch."""
+import pytest
+
+from adaptive_batcher import AdaptiveBatcher, pipeline_batcher
+
+RESOURCE = "x" * 100  # every source resource is 100 bytes
+
+
+def sizes(result):
+    """The fake transform result is its own ``(rows, bytes)``."""
+    return result
+
+
+def cut(batcher, resource=RESOURCE):
+    """Source rows of the next batch the batcher would cut from a stream of ``resource`` rows."""
+    batch = []
+    while not batcher.full(len(batch), len(resource) * len(batch)):
+        batch.append({"resource": resource})
+    return batch
+
+
+def test_byte_limit_converges_on_the_row_target():
+    batcher = AdaptiveBatcher(initial=1000, target_rows=2000, target_bytes=10**12, memory_budget=10**12,
+                              min_batch=1, max_batch=10**6, measure=sizes)
+    # Every source row fans out into 10 output rows: the target is met by 200 rows (20000 bytes)
+    for _ in range(10):
+        batch = cut(batcher)
+        batcher.observe(batch, (10 * len(batch), 0))
+    assert len(cut(batcher)) == 200
+    assert batcher.stats()["batch_bytes"] == 20000
+
+    # The fan-out quadruples: the limit follows, never shrinking by more than MAX_STEP at once
+    limits = [batcher.batch_bytes]
+    for _ in range(30):
+        batch = cut(batcher)
+        batcher.observe(batch, (40 * len(batch), 0))
+        limits.append(batcher.batch_bytes)
+    assert all(new >= old / batcher.max_step for old, new in zip(limits, limits[1:]))
+    assert batcher.batch_bytes == pytest.approx(5000, rel=0.01)
+
+
+def test_memory_budget_is_shared_by_the_batches_in_flight():
+    batcher = AdaptiveBatcher(inflight=4, target_rows=10**9, target_bytes=10**12, memory_budget=400000,
+                              min_batch=1, max_batch=10**6, measure=sizes)
+    batch = [{"resource": RESOURCE}] * 10
+    # 1000 source bytes turn into 3000 output bytes: 4 source bytes in memory per source byte
+    batcher.observe(batch, (10, 3000))
+    assert batcher.batch_bytes == 400000 / 4 / 4
+
+
+@pytest.mark.parametrize("out_rows, expected", [(1, 2000), (10**6, 500)])
+def test_row_limit_moves_at_most_max_step_per_batch(out_rows, expected):
+    batcher = AdaptiveBatcher(initial=1000, target_rows=5000, target_bytes=10**12, memory_budget=10**12,
+                              min_batch=1, max_batch=10**6, max_step=2.0, smoothing=1.0, measure=sizes)
+    # Parsed resources have no byte size, so the limit is in source rows
+    batch = [{"resource": {"id": str(i)}} for i in range(1000)]
+    batcher.observe(batch, (out_rows, 0))
+    assert batcher.batch_size == expected
+    assert batcher.batch_bytes is None
+
+
+def test_pipeline_batcher_observes_transformed_batches():
+    seen = []
+    options = {"prefetch": 1, "workers": 2, "max_inflight_loads": 3, "on_transformed": lambda b, r: seen.append(r)}
+    batcher = pipeline_batcher(options, 1000, measure=sizes)
+    assert batcher.inflight == 6
+    options["on_transformed"]([{"resource": RESOURCE}], (5, 50))
+    assert seen == [(5, 50)]
+    assert batcher.stats()["batches"] == 1
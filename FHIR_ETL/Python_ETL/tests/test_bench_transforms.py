@@ -0,0 +1,17 @@
+"""Every benchmark case still imports and runs (bench_transforms.py)."""
+import logging
+
+import pytest
+
+import bench_transforms
+
+
+@pytest.mark.parametrize("case", bench_transforms.CASES)
+def test_case_runs(case):
+    options = {**bench_transforms.BENCH_CONFIG, "REPEAT": 1}
+    try:
+        result = bench_transforms.run_case(case, 20, options)
+    finally:
+        logging.disable(logging.NOTSET)
+    assert result["case"] == case
+    assert result["rows_out"] > 0
@@ -0,0 +1,60 @@
+"""BigQuerySession: one client per process, rebuilt after a fork, and cached table metadata."""
+import os
+
+import pytest
+
+import bq_session
+from bq_session import BigQuerySession, get_session
+from local_bq import LocalBigQueryClient
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """Clients built by sessions, which build local clients instead of real ones."""
+    clients = []
+
+    def create_client(session):
+        clients.append(LocalBigQueryClient(seed=0))
+        return clients[-1]
+
+    monkeypatch.setattr(BigQuerySession, "_create_client", create_client)
+    return clients
+
+
+def test_client_is_built_on_first_use_and_reused(created, monkeypatch):
+    monkeypatch.setattr(bq_session, "_sessions", {})
+    session = get_session("test-project", "/no/such/key.json")
+    assert created == []
+    assert session.client is session.client
+    assert get_session("test-project", "/no/such/key.json").client is created[0]
+    assert len(created) == 1
+
+
+def test_client_is_rebuilt_after_a_fork(created, monkeypatch):
+    session = BigQuerySession("test-project")
+    parent = session.client
+    monkeypatch.setattr(bq_session.os, "getpid", lambda pid=os.getpid(): pid + 1)
+    child = session.client
+    assert child is not parent and child is session.client
+    assert created == [parent, child]
+
+
+def test_a_wrapped_client_is_kept_after_a_fork(created, monkeypatch):
+    client = LocalBigQueryClient(seed=0)
+    session = bq_session.session_for(client)
+    monkeypatch.setattr(bq_session.os, "getpid", lambda pid=os.getpid(): pid + 1)
+    assert session.client is client
+    assert created == []
+
+
+def test_table_metadata_is_cached_but_a_missing_table_is_not(bq, stage, monkeypatch):
+    session = BigQuerySession("test-project", client=bq)
+    assert session.get_table("fhir-synthea-data.fhir_staging.explanationofbenefits") is None
+    stage(1)
+    calls = []
+    get_table = bq.get_table
+    monkeypatch.setattr(bq, "get_table", lambda table_id: calls.append(table_id) or get_table(table_id))
+    first = session.get_table("fhir-synthea-data.fhir_staging.explanationofbenefits")
+    assert first is not None
+    assert session.get_table("fhir-synthea-data.fhir_staging.explanationofbenefits") is first
+    assert len(calls) == 1
@@ -0,0 +1,72 @@
+"""The streaming bundle parser (fhir_staging_loader.iter_bundle_entries) against json.load."""
+import io
+import json
+
+import pytest
+
+import fhir_staging_loader
+from fhir_staging_loader import iter_bundle_entries
+
+ENTRIES = [
+    {"resource": {"resourceType": "Patient", "id": "p1", "name": [{"text": 'Quote " and \\ backslash'}]}},
+    {"resource": {"resourceType": "Patient", "id": "p2", "name": [{"text": "Zoë Ångström 漢字 😀"}]}},
+    {"resource": {"resourceType": "Observation", "id": "o1", "valueQuantity": {"value": 1234.5e-3},
+                  "note": "é😀\n\t\u0000", "flags": [True, False, None], "count": -1700000}},
+    {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Claim", "id": "c1", "item": [[], {}, [1, [2, [3]]]]}},
+    {},
+]
+
+
+def bundle_text(entries=ENTRIES, ensure_ascii=False, indent=None):
+    bundle = {"resourceType": "Bundle", "meta": {"tag": ["a\\\"b"]}, "entry": entries, "type": "collection"}
+    return json.dumps(bundle, ensure_ascii=ensure_ascii, indent=indent)
+
+
+class CountingReader(io.StringIO):
+    def __init__(self, text):
+        super().__init__(text)
+        self.chars_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.chars_read += len(data)
+        return data
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 7, None])
+@pytest.mark.parametrize("ensure_ascii", [False, True])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_entries_match_json_load(tmp_path, chunk_chars, ensure_ascii, indent):
+    path = tmp_path / "bundle.json"
+    path.write_text(bundle_text(ensure_ascii=ensure_ascii, indent=indent), encoding="utf-8")
+    with open(path, encoding="utf-8") as f:
+        expected = json.load(f)["entry"]
+    with open(path, encoding="utf-8") as f:
+        assert list(iter_bundle_entries(f, chunk_chars)) == expected
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 7, None])
+@pytest.mark.parametrize("text", [
+    '{}', '{"entry": []}', ' { "resourceType" : "Bundle" , "entry" : [ ] } ', '{"entry": [1, 2.5e3, "x"]}',
+])
+def test_edge_bundles_match_json_load(chunk_chars, text):
+    assert list(iter_bundle_entries(io.StringIO(text), chunk_chars)) == json.loads(text).get("entry", [])
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 7, None])
+def test_malformed_entry_fails_without_reading_the_rest(chunk_chars):
+    good = json.dumps({"resource": {"resourceType": "Patient", "id": "p", "text": "x" * 100}})
+    text = '{"entry": [{"resource": {"id": tru, "x": 1}}, ' + ", ".join([good] * 2000) + "]}"
+    reader = CountingReader(text)
+    with pytest.raises(ValueError):
+        list(iter_bundle_entries(reader, chunk_chars))
+    assert reader.chars_read < 1000 + (chunk_chars or fhir_staging_loader.LOADER_CONFIG["READ_CHUNK_CHARS"])
+
+
+def test_value_larger_than_the_cap_fails_early(monkeypatch):
+    monkeypatch.setitem(fhir_staging_loader.LOADER_CONFIG, "MAX_VALUE_CHARS", 1000)
+    # An unterminated string swallows the rest of the file
+    reader = CountingReader('{"entry": [{"resource": "' + "x" * 100000 + "]}")
+    with pytest.raises(ValueError, match="exceeds"):
+        list(iter_bundle_entries(reader, 64))
+    assert reader.chars_read < 5000
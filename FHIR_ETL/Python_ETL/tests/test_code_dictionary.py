@@ -0,0 +1,70 @@
+"""Code dictionary: distinct codings of a record batch, and each new coding emitted once."""
+import glob
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from code_dictionary import CodeDictionary, CodeDomain, code_key, distinct_codings, emit_new_codes
+
+SYSTEM = "http://snomed.info/sct"
+PRODUCT = CodeDomain("product_key", "product_system", "product_code", "product_display")
+ADJUDICATION = CodeDomain("code_key", "system", "code", "display", within="adjudication")
+
+
+def product(code, display):
+    return {"product_key": code_key(SYSTEM, code), "product_system": SYSTEM, "product_code": code,
+            "product_display": display}
+
+
+def adjudication(*codes):
+    return [{"code_key": code_key(SYSTEM, code), "system": SYSTEM, "code": code, "display": code.upper()}
+            for code in codes]
+
+
+def record_batch(rows):
+    return pa.RecordBatch.from_pylist(rows)
+
+
+def codes(codings):
+    return sorted((coding["code"], coding["display"]) for coding in codings)
+
+
+def test_distinct_codings_take_the_least_display_of_a_key():
+    batch = record_batch([
+        product("1", "Visit"), product("2", "Lab"), product("1", "Another visit"),
+        product(None, None),
+    ])
+    assert codes(distinct_codings(batch, PRODUCT)) == [("1", "Another visit"), ("2", "Lab")]
+    assert distinct_codings(batch, ADJUDICATION) == []
+
+
+def test_distinct_codings_inside_a_list_column():
+    batch = record_batch([{"adjudication": adjudication("a", "b")}, {"adjudication": adjudication("b")},
+                          {"adjudication": []}])
+    codings = distinct_codings(batch, ADJUDICATION)
+    assert codes(codings) == [("a", "A"), ("b", "B")]
+    assert {c["code_key"] for c in codings} == {code_key(SYSTEM, "a"), code_key(SYSTEM, "b")}
+
+
+def emitted_codes(local_dir):
+    files = glob.glob(os.path.join(local_dir, "dim_code", "*", "*.parquet"))
+    return sorted(row["code"] for path in files for row in pq.read_table(path).to_pylist())
+
+
+def test_new_codes_are_emitted_once(tmp_path):
+    path, local_dir = str(tmp_path / "codes.db"), str(tmp_path / "sink")
+    dictionary = CodeDictionary(path)
+    assert dictionary.add("item_product", distinct_codings(record_batch([product("1", "Visit")]), PRODUCT)) == 1
+    assert dictionary.add("item_product", distinct_codings(record_batch([product("1", "Visit")]), PRODUCT)) == 0
+    assert emit_new_codes(dictionary, local_dir=local_dir) == 1
+    assert emit_new_codes(dictionary, local_dir=local_dir) == 0
+    dictionary.close()
+
+    # A later run knows what was emitted and only appends the codings it adds
+    dictionary = CodeDictionary(path)
+    batch = record_batch([product("1", "Visit"), product("2", "Lab")])
+    assert dictionary.add("item_product", distinct_codings(batch, PRODUCT)) == 1
+    assert emit_new_codes(dictionary, local_dir=local_dir) == 1
+    dictionary.close()
+    assert emitted_codes(local_dir) == ["1", "2"]
@@ -0,0 +1,23 @@
+"""Per-Coverage transform of etl_eob_items_coverage."""
+from etl_eob_items_coverage import CoverageColumns, transform_resource
+
+
+def coverage(cov_id, status="active"):
+    return {"resourceType": "Coverage", "id": cov_id, "status": status,
+            "type": {"coding": [{"system": "s", "code": cov_id.upper()}]}}
+
+
+def test_a_bad_coverage_does_not_drop_the_others():
+    eob = {
+        "resourceType": "ExplanationOfBenefit",
+        "insurance": {"focal": True, "coverage": {"reference": "#c2"}},
+        "contained": [coverage("c1", status={"not": "a code"}), coverage("c2"), "junk", {"resourceType": "Patient"}],
+    }
+    columns = CoverageColumns()
+    assert transform_resource("e1", eob, columns) == 1
+    rows = columns.to_record_batch().to_pylist()
+    assert [(row["coverage_id"], row["focal"], row["type_code"]) for row in rows] == [("c2", True, "C2")]
+
+
+def test_non_eob_resources_are_ignored():
+    assert transform_resource("e1", {"resourceType": "Claim", "contained": [coverage("c1")]}, CoverageColumns()) == 0
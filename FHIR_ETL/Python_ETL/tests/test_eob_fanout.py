@@ -0,0 +1,27 @@
+"""The single-scan fan-out writes what the standalone item and coverage transforms write."""
+import EOBS_etl
+import etl_eob_items_coverage
+from eob_fanout import SINKS, FanOutTransform
+from synthetic_eob import generate_rows
+
+
+def without_load_timestamp(record_batch):
+    rows = record_batch.to_pylist()
+    for row in rows:
+        del row["load_timestamp"]  # the time of each transform
+    return rows
+
+
+def test_fanout_matches_the_standalone_transforms():
+    batch = generate_rows(100, seed=3)
+    transforms = [(name, sink.transform, sink.new_columns) for name, sink in SINKS.items()]
+    outputs = FanOutTransform(transforms, {name: None for name in SINKS})(batch)
+
+    assert set(outputs) == {"eob_items", "eob_coverage"}
+    for name, transform_batch in (
+        ("eob_items", EOBS_etl.transform_batch), ("eob_coverage", etl_eob_items_coverage.transform_batch),
+    ):
+        standalone = transform_batch(batch)
+        assert outputs[name].schema == standalone.schema
+        assert outputs[name].num_rows > 0
+        assert without_load_timestamp(outputs[name]) == without_load_timestamp(standalone)
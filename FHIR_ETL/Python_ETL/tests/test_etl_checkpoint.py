@@ -0,0 +1,101 @@
+"""Watermark / resume path of the curated runs (etl_checkpoint, staging_source)."""
+import pytest
+
+import EOBS_etl
+from etl_checkpoint import CheckpointStore, covers, earliest_position, position_order
+
+DAY1 = "2025-01-01 00:00:00"
+DAY2 = "2025-01-02 00:00:00"
+
+
+def run(bq, checkpoints, **options):
+    return EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0, **options)
+
+
+# --------------------
+# Positions
+# --------------------
+def test_position_order_puts_whole_timestamp_after_its_keys():
+    positions = [(DAY1, None), (DAY1, "b"), (DAY2, "a"), (DAY1, "a")]
+    assert sorted(positions, key=position_order) == [(DAY1, "a"), (DAY1, "b"), (DAY1, None), (DAY2, "a")]
+
+
+def test_covers():
+    assert covers((DAY1, "m"), DAY1, "a")
+    assert covers((DAY1, "m"), DAY1, "m")
+    assert not covers((DAY1, "m"), DAY1, "z")
+    assert covers((DAY1, None), DAY1, "z")
+    assert not covers((DAY1, None), DAY2, "a")
+    assert not covers(None, DAY1, "a")
+
+
+def test_earliest_position():
+    assert earliest_position([(DAY2, "a"), (DAY1, None), (DAY1, "z")]) == (DAY1, "z")
+    assert earliest_position([(DAY2, "a"), None]) is None
+
+
+def test_watermark_only_moves_forward(checkpoints):
+    checkpoints.advance_watermark("p", DAY1, "m")
+    checkpoints.advance_watermark("p", DAY1, "c")
+    assert checkpoints.get_position("p") == (DAY1, "m")
+    checkpoints.advance_watermark("p", DAY1)
+    assert checkpoints.get_position("p") == (DAY1, None)
+    checkpoints.advance_watermark("p", DAY1, "z")
+    assert checkpoints.get_position("p") == (DAY1, None)
+    checkpoints.advance_watermark("p", DAY2, "a")
+    assert checkpoints.get_position("p") == (DAY2, "a")
+
+
+def test_position_key_survives_reopening(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    store = CheckpointStore(path)
+    store.advance_watermark("p", DAY1, "m")
+    store.close()
+    store = CheckpointStore(path)
+    assert store.get_position("p") == (DAY1, "m")
+    store.close()
+
+
+# --------------------
+# Incremental runs
+# --------------------
+def test_single_load_timestamp_is_cut_into_batches(bq, checkpoints, items_config, stage):
+    # One large COPY: every staged row shares a load_timestamp
+    ids = stage(1000, seed=1)
+    stats = run(bq, checkpoints)
+    assert stats["batches"] == 10
+    assert checkpoints.get_position("eob_items") == (DAY1, max(ids))
+
+
+def test_resume_after_failed_load(bq, checkpoints, items_config, stage, curated_rows, monkeypatch):
+    ids = sorted(stage(1000, seed=1))
+    load = EOBS_etl.load_batch_to_bq
+    calls = []
+
+    def flaky_load(batch, client=None):
+        calls.append(batch.num_rows)
+        if len(calls) == 4:
+            raise RuntimeError("load failed")
+        return load(batch, client=client)
+
+    monkeypatch.setattr(EOBS_etl, "load_batch_to_bq", flaky_load)
+    with pytest.raises(RuntimeError):
+        run(bq, checkpoints, max_inflight_loads=1)
+    # Batches commit in order, so the position stops at the last row of the third batch
+    assert checkpoints.get_position("eob_items") == (DAY1, ids[299])
+
+    monkeypatch.setattr(EOBS_etl, "load_batch_to_bq", load)
+    run(bq, checkpoints)
+    assert checkpoints.get_position("eob_items") == (DAY1, ids[-1])
+    assert {row["eob_id"] for row in curated_rows()} == set(ids)
+
+
+def test_second_run_reads_only_new_rows(bq, checkpoints, items_config, stage):
+    stage(150, seed=1)
+    run(bq, checkpoints)
+    new_ids = stage(120, seed=2, load_timestamp=DAY2)
+    stats = run(bq, checkpoints)
+    assert stats["batches"] == 2
+    assert checkpoints.get_position("eob_items") == (DAY2, max(new_ids))
+    assert run(bq, checkpoints)["batches"] == 0
+
@@ -0,0 +1,58 @@
+"""Run reports: what a run records, including worker snapshots, is what its report file holds."""
+import json
+import os
+
+import pytest
+
+from etl_metrics import current_metrics, instrumented_run, measured_call
+
+
+def transform(rows):
+    current_metrics().add("rows_out", 2 * len(rows))
+    current_metrics().count_values("items_per_eob", {2: len(rows)})
+    return rows
+
+
+def read_report(report_dir, suffix):
+    paths = [os.path.join(report_dir, name) for name in os.listdir(report_dir) if name.endswith(suffix)]
+    assert len(paths) == 1
+    with open(paths[0]) as f:
+        return f.read()
+
+
+def test_report_round_trips(tmp_path):
+    report_dir, prometheus_dir = str(tmp_path / "reports"), str(tmp_path / "textfiles")
+    with instrumented_run("eob_items", report_dir=report_dir, prometheus_dir=prometheus_dir) as metrics:
+        metrics.add("rows_in", 3)
+        metrics.observe("load", 0.25)
+        metrics.observe("load", 0.75)
+        # A worker process records into its own collector, merged back with the result
+        _, snapshot = measured_call("transform", transform, [1, 2, 3])
+        metrics.merge(snapshot)
+
+    report = json.loads(read_report(report_dir, ".json"))
+    assert report["pipeline"] == "eob_items"
+    assert (report["status"], report["error"]) == ("success", None)
+    assert report["counters"] == {"rows_in": 3, "rows_out": 6}
+    assert report["histograms"] == {"items_per_eob": {"2": 3}}
+    assert report["stages"]["load"] == {
+        "count": 2, "total_seconds": 1.0, "mean_seconds": 0.5, "max_seconds": 0.75,
+    }
+    assert report["stages"]["transform"]["count"] == 1
+
+    prometheus = read_report(prometheus_dir, ".prom")
+    assert 'etl_counter{pipeline="eob_items",name="rows_out"} 6' in prometheus
+    assert 'etl_stage_calls{pipeline="eob_items",stage="load"} 2' in prometheus
+    assert 'etl_run_success{pipeline="eob_items"} 1' in prometheus
+
+
+def test_failed_run_still_writes_its_report(tmp_path):
+    report_dir = str(tmp_path / "reports")
+    with pytest.raises(RuntimeError):
+        with instrumented_run("eob_items", report_dir=report_dir) as metrics:
+            metrics.add("rows_in", 5)
+            raise RuntimeError("load job failed")
+
+    report = json.loads(read_report(report_dir, ".json"))
+    assert (report["status"], report["error"]) == ("failed", "RuntimeError: load job failed")
+    assert report["counters"] == {"rows_in": 5}
@@ -0,0 +1,71 @@
+"""Overlapped fetch / transform / load (etl_pipeline.run_pipelined)."""
+import random
+import threading
+import time
+
+import pytest
+
+from etl_pipeline import PipelineError, run_pipelined
+
+
+def double(batch):
+    return [2 * n for n in batch]
+
+
+def fail_on_seven(batch):
+    if 7 in batch:
+        raise ValueError("bad row")
+    return batch
+
+
+def batches(count, size=3):
+    return ([seq * size + n for n in range(size)] for seq in range(count))
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_ordered_commits_follow_the_source_order(workers):
+    rng = random.Random(0)
+    loaded, committed = [], []
+    lock = threading.Lock()
+
+    def load(rows):
+        time.sleep(rng.random() / 200)  # loads finish out of order
+        with lock:
+            loaded.extend(rows)
+
+    stats = run_pipelined(
+        batches(20), double, load, workers=workers, max_inflight_loads=4, ordered=True,
+        batch_token=lambda batch: batch[-1], on_commit=lambda seq, token, n: committed.append((seq, token)),
+    )
+    assert stats == {"batches": 20, "rows_out": 60, "loads": 20}
+    assert committed == [(seq + 1, seq * 3 + 2) for seq in range(20)]
+    assert sorted(loaded) == [2 * n for n in range(60)]
+
+
+def test_fetch_stops_at_the_in_flight_budget():
+    fetched = 0
+    ahead = []
+    committed = 0
+
+    def source():
+        nonlocal fetched
+        for batch in batches(30):
+            fetched += 1
+            ahead.append(fetched - committed)
+            yield batch
+
+    def on_commit(seq, token, n):
+        nonlocal committed
+        committed += 1
+
+    run_pipelined(source(), double, lambda rows: time.sleep(0.002), prefetch=1, workers=0, max_inflight_loads=2,
+                  on_commit=on_commit)
+    # prefetch + workers + max_inflight_loads batches, plus the one the fetch thread holds while blocked
+    assert 1 < max(ahead) <= 1 + 0 + 2 + 1
+
+
+def test_transform_failure_names_its_batch():
+    with pytest.raises(PipelineError) as error:
+        run_pipelined(batches(5), fail_on_seven, lambda rows: None, workers=0)
+    assert (error.value.stage, error.value.seq) == ("transform", 3)
+    assert isinstance(error.value.cause, ValueError)
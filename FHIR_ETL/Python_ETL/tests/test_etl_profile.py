@@ -0,0 +1,50 @@
+"""Run profiles: HyperLogLog distinct counts and run planning (plan_run)."""
+import pytest
+
+from etl_profile import PROFILE_CONFIG, HyperLogLog, plan_run
+
+
+@pytest.mark.parametrize("distinct", [50, 3000, 100000])
+def test_distinct_count_is_within_the_sketch_error(distinct):
+    sketch = HyperLogLog()
+    for i in range(distinct):
+        sketch.add(f"code-{i}")
+        sketch.add(f"code-{i // 2}")  # repeats do not count
+    # Three standard errors (1.04 / sqrt(registers)), about 5% at the default precision
+    assert sketch.count() == pytest.approx(distinct, rel=3 * 1.04 / len(sketch.registers) ** 0.5)
+
+
+def test_merged_sketches_count_the_union():
+    left, right, both = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for i in range(20000):
+        (left if i % 2 else right).add(i)
+        both.add(i)
+    left.add(0)  # shared by both halves
+    left.merge(right)
+    assert left.registers == both.registers
+
+
+def profile(eobs, source_bytes, rows, output_bytes):
+    return {"eobs": eobs, "source_bytes": source_bytes, "rows": rows, "output_bytes": output_bytes}
+
+
+def test_plan_without_a_profile_only_inlines_a_single_batch():
+    assert plan_run(500, None, max_workers=8, batch_size=1000) == {"eobs": 500, "workers": 0}
+    assert "workers" not in plan_run(5000, None, max_workers=8, batch_size=1000)
+    assert "workers" not in plan_run(5000, {"eobs": 0}, max_workers=8, batch_size=1000)
+
+
+@pytest.mark.parametrize("eobs, workers", [
+    (1000, 0),                                                       # 1 MB expected: inline
+    (PROFILE_CONFIG["SMALL_RUN_BYTES"] // 1000 + 1, 1),              # just past the small-run threshold
+    (3 * PROFILE_CONFIG["BYTES_PER_WORKER"] // 1000, 3),             # one worker per BYTES_PER_WORKER
+    (100 * PROFILE_CONFIG["BYTES_PER_WORKER"] // 1000, 8),           # capped at max_workers
+])
+def test_plan_sizes_workers_from_expected_source_bytes(eobs, workers):
+    # The last run read 1000 bytes per EOB and wrote 4 rows (2000 bytes) per EOB
+    previous = profile(10000, 10000 * 1000, 40000, 10000 * 2000)
+    plan = plan_run(eobs, previous, max_workers=8, batch_size=1000)
+    assert plan["workers"] == workers
+    assert plan["expected_source_bytes"] == eobs * 1000
+    assert plan["expected_rows"] == eobs * 4
+    assert (plan["rows_per_byte"], plan["bytes_per_byte"]) == (0.004, 2.0)
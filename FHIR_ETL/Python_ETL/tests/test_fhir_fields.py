@@ -0,0 +1,93 @@
+"""The declarative field compiler and converters (fhir_fields)."""
+import pytest
+
+from fhir_fields import Derived, Field, Repeated, compile_columns, compile_path, integer, interned, parse_path, text
+
+
+def extract_row(fields, obj):
+    columns = [[] for _ in fields]
+    compile_columns(fields)(obj, [column.append for column in columns])
+    return dict(zip(fields, (column[0] for column in columns)))
+
+
+def test_parse_path():
+    assert parse_path("a.b[1].c") == [("key", "a"), ("key", "b"), ("idx", 1), ("key", "c")]
+    for spec in ("", "a..b", "a[x]", "a]"):
+        with pytest.raises(ValueError):
+            parse_path(spec)
+
+
+def test_generated_extractor_walks_shared_prefixes_once():
+    fields = {"system": "concept.coding[0].system", "code": "concept.coding[0].code", "second": "concept.coding[1].code"}
+    source = compile_columns(fields).__source__
+    assert source.count(".get('concept')") == 1
+    assert source.count(".get('coding')") == 1
+    obj = {"concept": {"coding": [{"system": "s", "code": "a"}, {"code": "b"}]}}
+    assert extract_row(fields, obj) == {"system": "s", "code": "a", "second": "b"}
+
+
+@pytest.mark.parametrize("obj, expected", [
+    ({"category": {"coding": {"code": "x"}}}, "x"),      # dicts where lists are expected
+    ({"category": [{"coding": [{"code": "x"}]}]}, "x"),
+    ({"category": []}, None),
+    ({"category": "oops"}, None),                        # mistyped node
+    ({}, None),
+])
+def test_paths_tolerate_loose_cardinality(obj, expected):
+    assert compile_path("category.coding[0].code")(obj) == expected
+
+
+def test_fallback_paths_and_derived():
+    fields = {
+        "price": Field(("unitPrice.value", "quantity.unitPrice"), float),
+        "total": Derived(("quantity.value", ("unitPrice.value", "quantity.unitPrice")),
+                         lambda q, p: q * p if q is not None and p is not None else None),
+    }
+    assert extract_row(fields, {"quantity": {"value": 2, "unitPrice": 3}}) == {"price": 3.0, "total": 6}
+    assert extract_row(fields, {}) == {"price": None, "total": None}
+
+
+def test_nested_repeated():
+    fields = {
+        "id": "id",
+        "items": Repeated("item", {
+            "sequence": Field("sequence", integer),
+            "details": Repeated("detail", {"code": "productOrService.coding[0].code"}),
+        }),
+    }
+    obj = {"id": "e1", "item": [
+        {"sequence": "1", "detail": [{"productOrService": {"coding": [{"code": "a"}]}}, {}]},
+        {"sequence": 2, "detail": {"productOrService": {"coding": {"code": "b"}}}},
+        {"sequence": 3},
+        "not an item",
+    ]}
+    assert extract_row(fields, obj) == {"id": "e1", "items": [(1, [("a",), (None,)]), (2, [("b",)]), (3, [])]}
+    assert extract_row(fields, {"id": "e2"})["items"] == []
+
+
+@pytest.mark.parametrize("convert, value, expected", [
+    (integer, 3, 3), (integer, "3", 3), (integer, 3.0, 3), (integer, None, None),
+    (text, "a", "a"), (text, 3, "3"), (text, 2.5, "2.5"), (text, None, None),
+    (interned, "a", "a"), (interned, 7, "7"), (interned, None, None),
+])
+def test_converters_coerce(convert, value, expected):
+    assert convert(value) == expected
+
+
+@pytest.mark.parametrize("convert, value, error", [
+    (integer, "1.5", ValueError), (integer, "one", ValueError), (integer, 2.5, TypeError),
+    (integer, [1], TypeError), (integer, {"value": 1}, TypeError),
+    (text, True, TypeError), (text, ["a"], TypeError), (text, {"code": "a"}, TypeError),
+    (interned, False, TypeError), (interned, {"code": "a"}, TypeError),
+])
+def test_converters_reject_wrong_types(convert, value, error):
+    with pytest.raises(error):
+        convert(value)
+
+
+def test_failing_converter_appends_nothing():
+    fields = {"id": "id", "sequence": Field("sequence", integer)}
+    columns = [[], []]
+    with pytest.raises(TypeError):
+        compile_columns(fields)({"id": "e1", "sequence": {"value": 1}}, [c.append for c in columns])
+    assert columns == [[], []]
@@ -0,0 +1,75 @@
+"""Skipping unchanged resources (fingerprints), alone and shared between the fan-out and the table runs."""
+import pytest
+
+import EOBS_etl
+import eob_fanout
+import etl_eob_items_coverage
+from fingerprints import FingerprintIndex, resource_fingerprint
+
+DAY2 = "2025-01-02 00:00:00"
+
+
+@pytest.fixture
+def skip_config(items_config, tmp_path, monkeypatch):
+    path = str(tmp_path / "fingerprints.db")
+    for config in (EOBS_etl.ETL_CONFIG, etl_eob_items_coverage.ETL_CONFIG, eob_fanout.FANOUT_CONFIG):
+        for key, value in {
+            "SKIP_UNCHANGED": True, "FINGERPRINT_PATH": path, "BATCH_SIZE": 100, "ADAPTIVE_BATCHES": False,
+            "PROFILE": False, "CODE_DICTIONARY": False, "COALESCE_LOADS": False, "SHARDS": 1,
+        }.items():
+            monkeypatch.setitem(config, key, value)
+
+
+def restage(bq):
+    """Stage every EOB again, unchanged, with a later load_timestamp."""
+    table = "fhir-synthea-data.fhir_staging.explanationofbenefits"
+    rows = bq.fetch_rows(table)
+    bq.insert_rows(table, [{**row, "load_timestamp": DAY2} for row in rows])
+
+
+def test_fingerprint_ignores_key_order():
+    assert resource_fingerprint('{"a": 1, "b": [1, 2]}') == resource_fingerprint({"b": [1, 2], "a": 1})
+    assert resource_fingerprint('{"a": 1}') != resource_fingerprint('{"a": 2}')
+
+
+def test_index_records_per_scope(tmp_path):
+    index = FingerprintIndex(str(tmp_path / "fingerprints.db"))
+    index.record("items", [("a", b"1"), ("b", b"2")])
+    assert index.unchanged("items", [("a", b"1"), ("b", b"3"), ("c", b"1")]) == {"a"}
+    assert index.unchanged("coverage", [("a", b"1")]) == set()
+    index.reset("items")
+    assert index.unchanged("items", [("a", b"1")]) == set()
+    index.close()
+
+
+def test_unchanged_restage_is_skipped(bq, checkpoints, skip_config, stage, curated_rows):
+    stage(50, seed=1)
+    EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+    loaded = len(curated_rows())
+    restage(bq)
+    assert EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)["rows_out"] == 0
+    assert len(curated_rows()) == loaded
+
+
+def test_fanout_fingerprints_are_shared_with_the_table_runs(bq, checkpoints, skip_config, stage, curated_rows):
+    stage(50, seed=1)
+    eob_fanout.run_fanout(client=bq, checkpoints=checkpoints, workers=0)
+    items, coverage = len(curated_rows("eob_items")), len(curated_rows("eob_coverage"))
+
+    restage(bq)
+    EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+    etl_eob_items_coverage.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+    assert len(curated_rows("eob_items")) == items
+    assert len(curated_rows("eob_coverage")) == coverage
+
+
+def test_fanout_only_feeds_the_sinks_a_resource_changed_for(bq, checkpoints, skip_config, stage, curated_rows):
+    stage(50, seed=1)
+    EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+    items = len(curated_rows("eob_items"))
+
+    # Items already have every EOB at this version; coverage has never run
+    restage(bq)
+    eob_fanout.run_fanout(client=bq, checkpoints=checkpoints, workers=0)
+    assert len(curated_rows("eob_items")) == items
+    assert {row["coverage_id"] for row in curated_rows("eob_coverage")}
@@ -0,0 +1,123 @@
+"""Coalescing, retries and lost-response handling of load_manager.LoadManager."""
+import threading
+
+from load_manager import LoadManager
+
+TABLE = "fhir-synthea-data.fhir_curated_sample.load_test"
+
+
+def make_manager(client, **options):
+    loaded, failed = [], []
+    lock = threading.Lock()
+
+    def on_loaded(seq, rows_out):
+        with lock:
+            loaded.append((seq, rows_out))
+
+    def on_failed(seq, error):
+        with lock:
+            failed.append((seq, error))
+
+    manager = LoadManager(
+        lambda rows, job_id: client.load_table_from_json(rows, TABLE, job_id=job_id),
+        name="test", backoff_base=0.0, on_loaded=on_loaded, on_failed=on_failed, **options,
+    )
+    return manager, loaded, failed
+
+
+def add_batches(manager, batches, size=10):
+    for seq in range(batches):
+        manager.add(seq, [{"seq": seq, "n": n} for n in range(size)])
+    manager.close()
+
+
+def loaded_rows(client):
+    return sorted((row["seq"], row["n"]) for row in client.fetch_rows(TABLE))
+
+
+def expected_rows(batches, size=10):
+    return sorted((seq, n) for seq in range(batches) for n in range(size))
+
+
+def test_batches_are_coalesced_into_one_job(bq):
+    manager, loaded, failed = make_manager(bq, target_rows=1000)
+    add_batches(manager, 5)
+    assert manager.stats["jobs"] == 1
+    assert sorted(loaded) == [(seq, 10) for seq in range(5)]
+    assert not failed
+    assert loaded_rows(bq) == expected_rows(5)
+
+
+def test_failed_jobs_are_retried(bq):
+    bq.load_failure_rate = 0.5
+    manager, loaded, failed = make_manager(bq, target_rows=10, max_retries=20)
+    add_batches(manager, 20)
+    assert manager.stats["retries"] > 0
+    assert sorted(loaded) == [(seq, 10) for seq in range(20)]
+    assert not failed
+    assert loaded_rows(bq) == expected_rows(20)
+
+
+def test_lost_response_is_not_loaded_twice(bq):
+    # Every job writes its rows, but its result() still raises
+    bq.lost_response_rate = 1.0
+    manager, loaded, failed = make_manager(bq, target_rows=10, lookup_job=bq.get_job)
+    add_batches(manager, 5)
+    assert manager.stats["retries"] == 0
+    assert sorted(loaded) == [(seq, 10) for seq in range(5)]
+    assert not failed
+    assert loaded_rows(bq) == expected_rows(5)
+
+
+def test_job_still_running_after_a_timeout_is_waited_for(bq):
+    # result() times out before the job has run; it is still RUNNING when looked up
+    bq.timeout_rate = 1.0
+    states = []
+
+    def lookup(job_id):
+        job = bq.get_job(job_id)
+        states.append(job.state)
+        return job
+
+    manager, loaded, failed = make_manager(bq, target_rows=10, lookup_job=lookup)
+    add_batches(manager, 5)
+    assert states == ["RUNNING"] * 5
+    assert manager.stats["retries"] == 0
+    assert sorted(loaded) == [(seq, 10) for seq in range(5)]
+    assert not failed
+    assert loaded_rows(bq) == expected_rows(5)
+
+
+def test_unknown_outcome_is_not_resubmitted(bq):
+    bq.timeout_rate = 1.0
+
+    def lookup(job_id):
+        raise ConnectionError("lookup failed")
+
+    manager, loaded, failed = make_manager(bq, target_rows=10, lookup_job=lookup, max_retries=2)
+    add_batches(manager, 1)
+    assert [seq for seq, _ in failed] == [0]
+    assert len(bq.jobs) == 1
+
+
+def test_lost_response_without_lookup_retries_and_duplicates(bq):
+    bq.lost_response_rate = 1.0
+    manager, loaded, failed = make_manager(bq, target_rows=10, max_retries=2)
+    add_batches(manager, 1)
+    # Without a job lookup each retry appends the chunk again, then the manager gives up
+    assert loaded_rows(bq) == sorted(expected_rows(1) * 3)
+    assert not loaded
+    assert [seq for seq, _ in failed] == [0]
+
+
+def test_non_retryable_error_fails_the_first_batch_of_the_job(bq):
+    def reject(rows, job_id):
+        raise ValueError("bad rows")
+
+    failed = []
+    manager = LoadManager(reject, name="test", target_rows=20, backoff_base=0.0,
+                          on_loaded=lambda seq, rows_out: None, on_failed=lambda seq, e: failed.append((seq, e)))
+    add_batches(manager, 4)
+    assert manager.stats["retries"] == 0
+    assert [seq for seq, _ in failed] == [0, 2]
+    assert all(isinstance(e, ValueError) for _, e in failed)
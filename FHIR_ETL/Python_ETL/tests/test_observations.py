@@ -0,0 +1,141 @@
+"""The observations pipeline (etl_observations) over a local Postgres staging table."""
+import json
+
+import pytest
+
+import etl_observations
+from code_dictionary import code_key
+from fhir_staging_loader import copy_rows
+from local_pg import LocalPostgres
+
+SCHEMA = "fhir_staging_sample"
+TABLE = "observations_fhir_raw"
+CURATED = "fhir-synthea-data.fhir_curated_sample.observations"
+
+
+def observation(n):
+    resource = {
+        "resourceType": "Observation", "id": f"obs-{n:04d}", "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": f"{n % 7}-1", "display": "Test"}], "text": "Test"},
+        "subject": {"reference": "urn:uuid:patient-1"},
+        "encounter": {"reference": f"urn:uuid:enc-{n % 3}"},
+        "effectiveDateTime": "2024-05-01T10:00:00+00:00",
+        "meta": {"profile": ["http://example.org/big"] * 20},
+    }
+    value = n % 4
+    if value == 0:
+        resource["valueQuantity"] = {"value": n / 2, "unit": "mg"}
+    elif value == 1:
+        resource["valueCodeableConcept"] = {"coding": [{"system": "s", "code": "pos"}], "text": "Positive"}
+    elif value == 2:
+        resource["valueString"] = f"note {n}"
+    else:
+        resource["valuePeriod"] = {"start": "2024-01-01", "end": None}
+    return resource
+
+
+@pytest.fixture
+def pg():
+    local = LocalPostgres()
+    local.create_staging_tables(SCHEMA)
+    yield local
+    local.cleanup()
+
+
+@pytest.fixture
+def stage_observations(pg):
+    """``stage_observations(start, count)`` stages observations ``start .. start + count - 1``."""
+    def stage(start, count):
+        conn = pg.connect()
+        rows = [(f"obs-{n:04d}", json.dumps(observation(n))) for n in range(start, start + count)]
+        copy_rows(conn, TABLE, "observation_id", rows, schema=SCHEMA, on_conflict="overwrite")
+        conn.commit()
+        conn.close()
+
+    return stage
+
+
+@pytest.fixture
+def obs_config(monkeypatch):
+    for key, value in {
+        "PG_SCHEMA": SCHEMA, "BATCH_SIZE": 10, "ITERSIZE": 4, "SHARDS": 1, "INCREMENTAL": True, "SINK": "parquet",
+        "ADAPTIVE_BATCHES": False, "PROFILE": False, "SKIP_UNCHANGED": False, "CODE_DICTIONARY": False,
+        "COALESCE_LOADS": False,
+    }.items():
+        monkeypatch.setitem(etl_observations.OBS_CONFIG, key, value)
+    return etl_observations.OBS_CONFIG
+
+
+def run(pg, bq, checkpoints):
+    return etl_observations.run_pipeline(client=bq, checkpoints=checkpoints, connect=pg.connect, workers=0)
+
+
+def loaded_ids(bq):
+    return sorted(row["observation_id"] for row in bq.fetch_rows(CURATED))
+
+
+def test_transform_columns():
+    rows = [{"id": n, "resource_id": f"obs-{n:04d}", "resource": json.dumps(observation(n))} for n in range(4)]
+    bad = {**observation(4), "status": {"not": "a code"}}
+    rows.append({"id": 4, "resource_id": "obs-0004", "resource": json.dumps(bad)})
+    out = etl_observations.transform_observations(rows).to_pylist()
+    assert [row["observation_id"] for row in out] == ["obs-0000", "obs-0001", "obs-0002", "obs-0003"]
+    quantity, concept, string, period = out
+    assert (quantity["value_numeric"], quantity["unit"], quantity["value_text"]) == (0.0, "mg", None)
+    assert concept["value_text"] == "Positive"
+    assert [(c["system"], c["code"]) for c in concept["value_codings"]] == [("s", "pos")]
+    assert string["value_text"] == "note 2"
+    assert json.loads(period["value_text"]) == {"start": "2024-01-01", "end": None}
+    for n, row in enumerate(out):
+        assert (row["status"], row["system"], row["obs_code"]) == ("final", "http://loinc.org", f"{n}-1")
+        assert (row["patient_id"], row["encounter_id"]) == ("patient-1", f"enc-{n % 3}")
+        assert row["obs_code_key"] == code_key("http://loinc.org", f"{n}-1")
+
+
+@pytest.mark.parametrize("features", [False, True])
+def test_incremental_run_resumes_after_the_last_id(pg, bq, checkpoints, obs_config, stage_observations, tmp_path,
+                                                   monkeypatch, features):
+    if features:
+        # The load manager, profile, adaptive batches, fingerprints and code dictionary of etl_run
+        for key in ("ADAPTIVE_BATCHES", "PROFILE", "SKIP_UNCHANGED", "CODE_DICTIONARY", "COALESCE_LOADS"):
+            monkeypatch.setitem(obs_config, key, True)
+        monkeypatch.setitem(obs_config, "FINGERPRINT_PATH", str(tmp_path / "fingerprints.db"))
+    stage_observations(0, 35)
+    assert run(pg, bq, checkpoints)["rows_out"] == 35
+    assert checkpoints.get_watermark("observations") == f"{35:020d}"
+
+    stage_observations(35, 5)
+    assert run(pg, bq, checkpoints)["rows_out"] == 5
+    assert checkpoints.get_watermark("observations") == f"{40:020d}"
+    assert run(pg, bq, checkpoints)["rows_out"] == 0
+    assert loaded_ids(bq) == [f"obs-{n:04d}" for n in range(40)]
+
+
+def test_id_range_shards_load_every_row_once(pg, bq, checkpoints, obs_config, stage_observations, monkeypatch):
+    monkeypatch.setitem(obs_config, "SHARDS", 3)
+    stage_observations(0, 40)
+    assert run(pg, bq, checkpoints)["rows_out"] == 40
+    assert len(checkpoints.get_shards("observations", 3)) == 3
+
+    # New rows land in the open-ended last range; every range resumes after its own last id
+    stage_observations(40, 10)
+    assert run(pg, bq, checkpoints)["rows_out"] == 10
+    assert run(pg, bq, checkpoints)["rows_out"] == 0
+    assert loaded_ids(bq) == [f"obs-{n:04d}" for n in range(50)]
+
+
+def test_projection_transforms_like_the_full_resource(pg, obs_config, stage_observations):
+    stage_observations(0, 30)
+
+    def transformed(paths):
+        source = etl_observations.ObservationScan(connect=pg.connect, batch_size=8, shards=1, paths=paths)
+        batches = list(source.batches())
+        rows = [row for batch in batches for row in etl_observations.transform_observations(batch).to_pylist()]
+        for row in rows:
+            del row["load_timestamp"]  # the time of the transform
+        return batches, rows
+
+    (projected, projected_rows), (_, full_rows) = transformed(etl_observations.RESOURCE_PATHS), transformed(None)
+    assert all(set(json.loads(row["resource"])) <= set(etl_observations.RESOURCE_PATHS)
+               for batch in projected for row in batch)
+    assert projected_rows == full_rows
@@ -0,0 +1,44 @@
+"""Sharded staging scans (sharded_source): BigQuery hash shards and Postgres id ranges."""
+import EOBS_etl
+from local_pg import LocalPostgres
+from sharded_source import plan_id_ranges
+
+DAY1 = "2025-01-01 00:00:00"
+DAY2 = "2025-01-02 00:00:00"
+
+
+def run(bq, checkpoints, **options):
+    return EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0, **options)
+
+
+def test_empty_shards_let_the_watermark_advance(bq, checkpoints, items_config, stage, curated_rows, monkeypatch):
+    monkeypatch.setitem(items_config, "SHARDS", 8)
+    # Fewer EOBs than shards: some shards have no rows at all
+    stage(3, seed=1)
+    run(bq, checkpoints)
+    assert checkpoints.get_position("eob_items") == (DAY1, None)
+
+    stage(2, seed=2, load_timestamp=DAY2)
+    run(bq, checkpoints)
+    assert checkpoints.get_position("eob_items") == (DAY2, None)
+    assert len({row["eob_id"] for row in curated_rows()}) == 5
+
+
+def test_id_ranges_cover_the_table_and_stay_open_ended():
+    pg = LocalPostgres()
+    try:
+        pg.create_staging_tables("fhir_staging_sample")
+        conn = pg.connect()
+        table = "fhir_staging_sample.observations_fhir_raw"
+        assert plan_id_ranges(conn, "fhir_staging_sample", "observations_fhir_raw", 3) == [(0, 0), (0, 0), (0, None)]
+        conn.cursor().executemany(f"INSERT INTO {table} (observation_id, resource) VALUES (%s, '{{}}')",
+                                  [(f"o{n}",) for n in range(10)])
+        conn.commit()
+        ranges = plan_id_ranges(conn, "fhir_staging_sample", "observations_fhir_raw", 3)
+        conn.close()
+    finally:
+        pg.cleanup()
+    assert ranges[0][0] == 0 and ranges[-1][1] is None
+    assert all(upto == after for (_, upto), (after, _) in zip(ranges, ranges[1:]))
+    ids = range(1, 11)
+    assert sorted(i for after, upto in ranges for i in ids if i > after and (upto is None or i <= upto)) == list(ids)
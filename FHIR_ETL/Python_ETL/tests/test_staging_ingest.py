@@ -0,0 +1,93 @@
+"""staging_ingest: COPY payload encoding, and fingerprint skipping for pooled and streamed bundles."""
+import io
+import json
+
+import pytest
+
+import staging_ingest
+from fhir_staging_loader import copy_payload
+from local_pg import JSONB_COLUMNS, LocalConnectionPool, LocalPostgres, decode_binary_copy
+
+SCHEMA = "fhir_staging_sample"
+
+
+@pytest.fixture
+def pg():
+    local = LocalPostgres()
+    local.create_staging_tables(SCHEMA)
+    yield local
+    local.cleanup()
+
+
+# Ids and resources that CSV would have to quote: commas, quotes, newlines and non-ASCII text
+ROWS = [
+    ("a", '{"resourceType": "Patient", "id": "a", "name": "Ann"}'),
+    ("b,1", '{"resourceType": "Patient", "id": "b,1", "name": "Bob \\"Bobby\\", Jr.\\nIII"}'),
+    ("c", '{"resourceType": "Patient", "id": "c", "name": "Zoë 李"}'),
+]
+
+
+def binary_payload(rows):
+    encoded = [staging_ingest.encode_binary_row(rid, resource.encode("utf-8")) for rid, resource in rows]
+    return b"".join([staging_ingest._BINARY_HEADER, *encoded, staging_ingest._BINARY_TRAILER])
+
+
+def write_bundle(path, names):
+    entries = [{"resource": {"resourceType": "Patient", "id": rid, "name": name}} for rid, name in names.items()]
+    path.write_text(json.dumps({"resourceType": "Bundle", "type": "collection", "entry": entries}))
+    return str(path)
+
+
+def ingest(pg, path, fingerprint_path, on_conflict):
+    pool = LocalConnectionPool(1, 2, pg)
+    try:
+        counts, failed = staging_ingest.ingest_files(
+            [path], pool=pool, parse_workers=1, fingerprint_path=fingerprint_path, schema=SCHEMA,
+            writer_connections=2, on_conflict=on_conflict,
+        )
+    finally:
+        pool.closeall()
+    assert not failed
+    return counts
+
+
+def staged(pg):
+    rows = pg.fetch(f"SELECT patients_id, resource FROM {SCHEMA}.patients_fhir_raw")
+    return {rid: json.loads(resource)["name"] for rid, resource in rows}
+
+
+@pytest.mark.parametrize("large", [False, True])
+def test_skip_does_not_fingerprint_rows_it_left_out(pg, tmp_path, monkeypatch, large):
+    if large:
+        monkeypatch.setitem(staging_ingest.INGEST_CONFIG, "LARGE_FILE_BYTES", 0)
+    fingerprint_path = str(tmp_path / "fingerprints.db")
+    path = write_bundle(tmp_path / "bundle.json", {"a": "Ann", "b": "Bob"})
+    assert ingest(pg, path, fingerprint_path, "skip")["Patient"] == 2
+    # Unchanged resources are dropped before the COPY
+    assert not ingest(pg, path, fingerprint_path, "skip")
+
+    # "skip" leaves the changed patient out, so it is offered again and an overwrite picks it up
+    write_bundle(tmp_path / "bundle.json", {"a": "Changed", "b": "Bob"})
+    assert ingest(pg, path, fingerprint_path, "skip")["Patient"] == 1
+    assert staged(pg) == {"a": "Ann", "b": "Bob"}
+    assert ingest(pg, path, fingerprint_path, "overwrite")["Patient"] == 1
+    assert staged(pg) == {"a": "Changed", "b": "Bob"}
+
+
+def test_binary_rows_decode_to_what_was_encoded():
+    columns = ["patients_id", "resource"]
+    assert decode_binary_copy(binary_payload(ROWS), [c in JSONB_COLUMNS for c in columns]) == ROWS
+
+
+def test_binary_and_csv_payloads_stage_the_same_rows(pg):
+    csv_payload = b"".join(staging_ingest.encode_csv_row(rid, resource.encode("utf-8")) for rid, resource in ROWS)
+    conn = pg.connect()
+    for copy_format, payload in (("binary", binary_payload(ROWS)), ("csv", csv_payload)):
+        staged_ids = set()
+        copy_payload(
+            conn, "patients_fhir_raw", "patients_id", io.BytesIO(payload), copy_format, SCHEMA, "overwrite", staged_ids,
+        )
+        conn.commit()
+        assert staged_ids == {rid for rid, _ in ROWS}
+        assert pg.fetch(f"SELECT patients_id, resource FROM {SCHEMA}.patients_fhir_raw ORDER BY patients_id") == ROWS
+    conn.close()
@@ -0,0 +1,110 @@
+"""ON_CONFLICT modes of the staging COPY + merge (fhir_staging_loader.merge_sql / copy_rows / copy_payload)."""
+import csv
+import io
+import json
+
+import pytest
+
+from fhir_staging_loader import copy_payload, copy_rows, merge_sql
+from local_pg import LocalPostgres, LocalUniqueViolation
+
+SCHEMA = "fhir_staging_sample"
+TABLE, ID_FIELD = "patients_fhir_raw", "patients_id"
+OLD_TIMESTAMP = "2000-01-01 00:00:00"
+
+
+@pytest.fixture
+def pg():
+    local = LocalPostgres()
+    local.create_staging_tables(SCHEMA)
+    yield local
+    local.cleanup()
+
+
+def resource(rid, name):
+    return json.dumps({"resourceType": "Patient", "id": rid, "name": name})
+
+
+def load(pg, rows, on_conflict):
+    conn = pg.connect()
+    try:
+        copy_rows(conn, TABLE, ID_FIELD, rows, schema=SCHEMA, on_conflict=on_conflict)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def staged(pg):
+    """``{id: (name, load_timestamp)}`` of the staged rows."""
+    rows = pg.fetch(f"SELECT {ID_FIELD}, resource, load_timestamp FROM {SCHEMA}.{TABLE}")
+    return {rid: (json.loads(res)["name"], ts) for rid, res, ts in rows}
+
+
+def age_rows(pg):
+    conn = pg.connect()
+    conn.cursor().execute(f"UPDATE {SCHEMA}.{TABLE} SET load_timestamp = %s", (OLD_TIMESTAMP,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def existing(pg):
+    """Two staged patients, ``a`` and ``b``, loaded long ago."""
+    load(pg, [("a", resource("a", "Ann")), ("b", resource("b", "Bob"))], "skip")
+    age_rows(pg)
+
+
+def test_skip_keeps_staged_rows(pg, existing):
+    load(pg, [("a", resource("a", "Changed")), ("c", resource("c", "Cat"))], "skip")
+    rows = staged(pg)
+    assert rows["a"] == ("Ann", OLD_TIMESTAMP)
+    assert rows["c"][0] == "Cat"
+
+
+def test_overwrite_replaces_every_reloaded_row(pg, existing):
+    load(pg, [("a", resource("a", "Changed")), ("b", resource("b", "Bob"))], "overwrite")
+    rows = staged(pg)
+    assert rows["a"][0] == "Changed" and rows["a"][1] != OLD_TIMESTAMP
+    assert rows["b"][0] == "Bob" and rows["b"][1] != OLD_TIMESTAMP
+
+
+def test_overwrite_if_changed_leaves_identical_rows_alone(pg, existing):
+    load(pg, [("a", resource("a", "Changed")), ("b", resource("b", "Bob"))], "overwrite_if_changed")
+    rows = staged(pg)
+    assert rows["a"][0] == "Changed" and rows["a"][1] != OLD_TIMESTAMP
+    assert rows["b"] == ("Bob", OLD_TIMESTAMP)
+
+
+def test_error_fails_on_a_duplicate(pg, existing):
+    with pytest.raises(LocalUniqueViolation):
+        load(pg, [("a", resource("a", "Changed"))], "error")
+
+
+@pytest.mark.parametrize("on_conflict", ["skip", "overwrite", "overwrite_if_changed"])
+def test_last_duplicate_in_a_batch_wins(pg, on_conflict):
+    load(pg, [("a", resource("a", "First")), ("a", resource("a", "Last"))], on_conflict)
+    assert staged(pg)["a"][0] == "Last"
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        merge_sql(SCHEMA, TABLE, ID_FIELD, "upsert")
+
+
+@pytest.mark.parametrize("on_conflict, written", [
+    ("skip", {"c"}),
+    ("overwrite", {"a", "b", "c"}),
+    ("overwrite_if_changed", {"a", "c"}),
+])
+def test_written_ids_are_the_rows_the_merge_wrote(pg, existing, on_conflict, written):
+    rows = [("a", resource("a", "Changed")), ("b", resource("b", "Bob")), ("c", resource("c", "Cat"))]
+    payload = io.StringIO()
+    csv.writer(payload).writerows(rows)
+    payload.seek(0)
+    written_ids = set()
+    conn = pg.connect()
+    merged = copy_payload(conn, TABLE, ID_FIELD, payload, "csv", SCHEMA, on_conflict, written_ids)
+    conn.commit()
+    conn.close()
+    assert written_ids == written
+    assert merged == len(written)
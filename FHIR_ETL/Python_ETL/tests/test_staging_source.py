@@ -0,0 +1,35 @@
+"""Server-side resource projection (staging_source): projected scans transform like full ones.
+
+The Postgres projection is tested with the observations pipeline (tests/test_observations.py).
+"""
+import json
+
+import pytest
+
+import EOBS_etl
+import etl_eob_items_coverage
+import staging_source
+
+MODULES = [EOBS_etl, etl_eob_items_coverage]
+
+
+def transformed(batches, transform):
+    rows = [row for batch in batches for row in transform(batch).to_pylist()]
+    for row in rows:
+        del row["load_timestamp"]  # the time of the transform
+    return rows
+
+
+@pytest.mark.parametrize("module", MODULES, ids=lambda m: m.__name__)
+def test_bigquery_projection_transforms_like_the_full_resource(bq, items_config, stage, module):
+    stage(120, seed=4)
+    table_id = staging_source.staging_table_id(items_config)
+
+    def scan(paths):
+        return staging_source.fetch_staging_batches(bq, table_id, 50, ordered=True, paths=paths)
+
+    projected = list(scan(module.RESOURCE_PATHS))
+    full = list(scan(None))
+    assert all(set(json.loads(row["resource"])) <= set(module.RESOURCE_PATHS) for batch in projected for row in batch)
+    assert transformed(projected, module.transform_batch) == transformed(full, module.transform_batch)
+
@@ -0,0 +1,43 @@
+"""Incremental refresh of the warehouse facts (warehouse_materializer)."""
+import json
+
+import EOBS_etl
+import warehouse_materializer
+from etl_checkpoint import CheckpointStore
+from staging_source import staging_table_id
+
+
+def fact_rows(bq, fact):
+    rows = bq.fetch_rows(warehouse_materializer.target_table_id(fact))
+    return sorted(tuple(sorted(row.items())) for row in rows)
+
+
+def test_incremental_refresh_matches_full_rebuild(bq, checkpoints, items_config, stage):
+    fact = warehouse_materializer.FACTS["fact_eob_item"]
+    ids = stage(200, seed=3)
+    EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+    facts = CheckpointStore(":memory:")
+    assert warehouse_materializer.materialize(fact, client=bq, checkpoints=facts)["full"]
+
+    # Reload some EOBs with an item dropped and moved service dates, so rows leave old partitions
+    staged = {row["explanationofbenefit_id"]: row["resource"] for row in bq.fetch_rows(staging_table_id(items_config))}
+    reloaded = []
+    for day, eob_id in enumerate(ids[:20]):
+        resource = json.loads(staged[eob_id])
+        resource["item"].pop()
+        for item in resource["item"]:
+            item["servicedPeriod"]["start"] = f"2030-06-{day % 5 + 1:02d}T10:00:00+00:00"
+        reloaded.append({"explanationofbenefit_id": eob_id, "resource": json.dumps(resource),
+                         "load_timestamp": "2025-02-01 00:00:00"})
+    bq.insert_rows(staging_table_id(items_config), reloaded)
+    EOBS_etl.run_pipeline(client=bq, checkpoints=checkpoints, workers=0)
+
+    estimate = warehouse_materializer.materialize(fact, client=bq, checkpoints=facts, dry_run=True)
+    assert estimate["detect_bytes"] < estimate["full_rebuild_bytes"]
+    stats = warehouse_materializer.materialize(fact, client=bq, checkpoints=facts)
+    assert not stats["full"] and stats["partitions"] > 0
+    incremental = fact_rows(bq, fact)
+    assert warehouse_materializer.materialize(fact, client=bq, checkpoints=facts)["partitions"] == 0
+
+    warehouse_materializer.materialize(fact, client=bq, checkpoints=facts, full=True)
+    assert incremental == fact_rows(bq, fact)
@@ -0,0 +1,323 @@
+"""Incremental, partitioned warehouse facts built from the curated tables.
+
+``Warehouse_Queries.sql`` rebuilds every fact with ``CREATE OR REPLACE TABLE``
+over the whole history, so each refresh costs more than the last. Here,
+after the ETL has loaded:
+
+* a ``Fact`` is a query over a curated ``source`` table plus the DATE column
+  it is partitioned by,
+* only source rows loaded since the fact's last run (``load_timestamp`` past
+  its checkpoint) are read: their entities (``key``) are the changed ones,
+  and the latest version of each is among them,
+* the changed partitions are those of the new rows, plus the partitions the
+  fact holds the changed entities in now, since a reloaded EOB replaces its
+  older rows. The latter come from the fact itself, not the source history,
+* in those partitions, in groups of ``PARTITIONS_PER_STATEMENT``, the
+  changed entities' rows are replaced by their latest versions: ``DELETE``
+  + ``INSERT`` in one transaction (``MODE`` "replace") or one
+  ``MERGE ... ON FALSE`` (``MODE`` "merge", BigQuery only),
+* the first run, or ``full=True``, creates the partitioned, clustered table
+  with a single ``CREATE OR REPLACE TABLE``.
+
+So a refresh reads the new source rows and the touched fact partitions,
+whatever the size of the history. In BigQuery the source scan is bounded as
+well once the curated table is partitioned on ``load_timestamp``; otherwise
+only the referenced columns are read in full.
+
+``dry_run=True`` changes nothing and reports the bytes BigQuery estimates
+for the statements it would run, next to the estimate for a full rebuild.
+The checkpoint only moves once the rebuild has committed. Everything except
+MERGE also runs against ``local_bq.LocalBigQueryClient``.
+
+Usage::
+
+    python warehouse_materializer.py                  # every registered fact
+    python warehouse_materializer.py --dry-run fact_eob_item
+"""
+import argparse
+import logging
+import sys
+from datetime import date
+
+from bq_session import get_session, session_for
+from etl_checkpoint import CheckpointStore
+
+MATERIALIZE_CONFIG = {
+    "BQ_PROJECT": "fhir-synthea-data",
+    "BQ_DATASET_CURATED": "fhir_curated_sample",
+    "BQ_DATASET_WAREHOUSE": "fhir_warehouse",
+    "CHECKPOINT_PATH": "etl_checkpoints.db",
+    "MODE": "replace",  # "replace" (DELETE + INSERT per partition group) or "merge" (MERGE, BigQuery only)
+    "PARTITIONS_PER_STATEMENT": 100,
+    "KEY_PATH": "/keys/bq_key.json",
+}
+
+bq_session = get_session(MATERIALIZE_CONFIG["BQ_PROJECT"], MATERIALIZE_CONFIG["KEY_PATH"])
+
+
+class Fact:
+    """A warehouse table partitioned by the DATE column ``partition_by``.
+
+    ``select`` reads the curated ``source`` table as ``src``; ``{curated}`` in it stands for the
+    curated dataset, ``{changed}`` for a condition selecting the ``src`` rows to build from (rows
+    loaded since the last run, or all of them) and ``{partition_filter}`` for a condition on
+    ``partition_source``, the expression over ``src`` that becomes ``partition_by``. ``key``
+    identifies an entity and is a column of both ``source`` and the fact: when one is reloaded,
+    its rows are replaced wherever they are.
+    """
+
+    def __init__(self, name, select, partition_by, partition_source, source, key, cluster_by=()):
+        self.name = name
+        self.select = select
+        self.partition_by = partition_by
+        self.partition_source = partition_source
+        self.source = source
+        self.key = key
+        self.cluster_by = tuple(cluster_by)
+
+
+FACTS = {}
+
+
+def register_fact(fact):
+    FACTS[fact.name] = fact
+    return fact
+
+
+# Curated EOB items, latest load of each EOB, keyed into dim_code (see code_dictionary.py)
+register_fact(Fact(
+    "fact_eob_item",
+    """
+SELECT
+    src.eob_id,
+    src.sequence AS item_sequence,
+    src.encounter AS encounter_id,
+    DATE(src.service_start) AS service_date,
+    DATE(src.service_end) AS service_end_date,
+    src.category_key,
+    src.product_key,
+    src.location_key,
+    src.quantity,
+    src.unit_price,
+    src.net_value,
+    src.net_currency,
+    1 AS item_count,
+    src.load_timestamp
+FROM `{curated}.eob_items` AS src
+JOIN (
+    SELECT src.eob_id, MAX(src.load_timestamp) AS load_timestamp
+    FROM `{curated}.eob_items` AS src
+    WHERE {changed}
+    GROUP BY src.eob_id
+) AS latest
+    ON latest.eob_id = src.eob_id AND latest.load_timestamp = src.load_timestamp
+WHERE {changed} AND {partition_filter}
+""",
+    partition_by="service_date",
+    partition_source="DATE(src.service_start)",
+    source="eob_items",
+    key="eob_id",
+    cluster_by=("product_key", "eob_id"),
+))
+
+
+# --------------------
+# SQL
+# --------------------
+# Source rows loaded since the fact's last run: a changed entity's latest version is always among them
+_CHANGED = "src.load_timestamp > @since"
+
+
+def _curated():
+    return f"{MATERIALIZE_CONFIG['BQ_PROJECT']}.{MATERIALIZE_CONFIG['BQ_DATASET_CURATED']}"
+
+
+def target_table_id(fact):
+    return f"{MATERIALIZE_CONFIG['BQ_PROJECT']}.{MATERIALIZE_CONFIG['BQ_DATASET_WAREHOUSE']}.{fact.name}"
+
+
+def partition_filter(expr):
+    """Condition selecting the ``@partitions`` dates (and NULL when ``@null_partition``) of ``expr``."""
+    return f"({expr} IN UNNEST(@partitions) OR (@null_partition AND {expr} IS NULL))"
+
+
+def fact_query(fact, partitioned=True):
+    """The fact's SELECT over rows loaded after ``@since`` in the ``@partitions``, or (``partitioned=False``) over everything."""
+    if partitioned:
+        return fact.select.format(
+            curated=_curated(), changed=_CHANGED, partition_filter=partition_filter(fact.partition_source)
+        ).strip()
+    return fact.select.format(curated=_curated(), changed="TRUE", partition_filter="TRUE").strip()
+
+
+def _changed_keys(fact):
+    return f"(SELECT src.{fact.key} FROM `{_curated()}.{fact.source}` AS src WHERE {_CHANGED})"
+
+
+def full_build_sql(fact):
+    cluster = f"\nCLUSTER BY {', '.join(fact.cluster_by)}" if fact.cluster_by else ""
+    return (
+        f"CREATE OR REPLACE TABLE `{target_table_id(fact)}`\n"
+        f"PARTITION BY {fact.partition_by}{cluster}\n"
+        f"AS\n{fact_query(fact, partitioned=False)}"
+    )
+
+
+def rebuild_statements(fact, mode):
+    """Statements replacing the changed entities' rows in the ``@partitions``: DELETE + INSERT, or one MERGE."""
+    target = target_table_id(fact)
+    if mode == "merge":
+        return [
+            f"MERGE `{target}` AS target\n"
+            f"USING (\n{fact_query(fact)}\n) AS source\n"
+            f"ON FALSE\n"
+            f"WHEN NOT MATCHED BY SOURCE AND {partition_filter('target.' + fact.partition_by)}\n"
+            f"    AND target.{fact.key} IN {_changed_keys(fact)} THEN DELETE\n"
+            f"WHEN NOT MATCHED THEN INSERT ROW"
+        ]
+    if mode != "replace":
+        raise ValueError(f"Unknown materialize mode: {mode!r}")
+    return [
+        f"DELETE FROM `{target}`\n"
+        f"WHERE {partition_filter(fact.partition_by)} AND {fact.key} IN {_changed_keys(fact)}",
+        f"INSERT INTO `{target}`\n{fact_query(fact)}",
+    ]
+
+
+def changed_partitions_sql(fact):
+    """Partitions of the rows loaded after ``@since``, and those the fact holds the changed entities in."""
+    return (
+        f"SELECT DISTINCT {fact.partition_source} AS partition_date\n"
+        f"FROM `{_curated()}.{fact.source}` AS src\n"
+        f"WHERE {_CHANGED}\n"
+        f"UNION DISTINCT\n"
+        f"SELECT DISTINCT {fact.partition_by} AS partition_date\n"
+        f"FROM `{target_table_id(fact)}`\n"
+        f"WHERE {fact.key} IN {_changed_keys(fact)}"
+    )
+
+
+# --------------------
+# Queries
+# --------------------
+def _job_config(partitions=None, since=None, dry_run=False):
+    from google.cloud import bigquery
+
+    params = []
+    if partitions is not None:
+        dates = [p for p in partitions if p is not None]
+        params.append(bigquery.ArrayQueryParameter("partitions", "DATE", dates))
+        params.append(bigquery.ScalarQueryParameter("null_partition", "BOOL", len(dates) < len(partitions)))
+    if since is not None:
+        params.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since))
+    if dry_run:
+        return bigquery.QueryJobConfig(query_parameters=params, dry_run=True, use_query_cache=False)
+    return bigquery.QueryJobConfig(query_parameters=params)
+
+
+def estimate_bytes(client, sql, **params):
+    """Bytes BigQuery reports for a dry run of ``sql``."""
+    job = client.query(sql, job_config=_job_config(dry_run=True, **params))
+    return job.total_bytes_processed or 0
+
+
+def _as_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def changed_partitions(fact, client, since):
+    """Sorted partitions holding rows loaded after ``since`` or the fact's current rows of their entities."""
+    rows = client.query(changed_partitions_sql(fact), job_config=_job_config(since=since)).result()
+    partitions = {_as_date(row["partition_date"]) for row in rows}
+    return sorted(partitions, key=lambda p: (p is not None, p))
+
+
+def _groups(partitions, size):
+    for start in range(0, len(partitions), size):
+        yield partitions[start:start + size]
+
+
+# --------------------
+# Materialize
+# --------------------
+def materialize(fact, client=None, checkpoints=None, full=False, dry_run=False, mode=None):
+    """Bring one fact up to date with its source; returns a stats dict.
+
+    With ``dry_run`` nothing is executed and the checkpoint does not move; the stats carry the
+    estimated ``bytes_processed`` of the statements that would run and ``full_rebuild_bytes``.
+    """
+    if isinstance(fact, str):
+        fact = FACTS[fact]
+    client = client or bq_session.client
+    mode = MATERIALIZE_CONFIG["MODE"] if mode is None else mode
+    checkpoints = checkpoints or CheckpointStore(MATERIALIZE_CONFIG["CHECKPOINT_PATH"])
+    pipeline = f"warehouse_{fact.name}"
+    target = target_table_id(fact)
+    stats = {"fact": fact.name, "mode": mode, "full": False, "partitions": 0, "statements": 0}
+
+    source = f"{_curated()}.{fact.source}"
+    row = next(iter(client.query(f"SELECT MAX(load_timestamp) AS high_water FROM `{source}`").result()), None)
+    high_water = row["high_water"] if row is not None else None
+    if high_water is None:
+        logging.info(f"{fact.name}: {source} is empty, nothing to materialize")
+        return stats
+
+    since = None if full else checkpoints.get_watermark(pipeline)
+    session = session_for(client)
+    if since is None or session.get_table(target) is None:
+        stats["full"] = True
+        work = [([full_build_sql(fact)], None)]
+    else:
+        partitions = changed_partitions(fact, client, since)
+        stats["partitions"] = len(partitions)
+        statements = rebuild_statements(fact, mode)
+        work = [(statements, group) for group in _groups(partitions, MATERIALIZE_CONFIG["PARTITIONS_PER_STATEMENT"])]
+        if dry_run:
+            stats["detect_bytes"] = estimate_bytes(client, changed_partitions_sql(fact), since=since)
+    stats["statements"] = sum(len(statements) for statements, _ in work)
+
+    if dry_run:
+        stats["bytes_processed"] = sum(
+            estimate_bytes(client, sql, partitions=group, since=since)
+            for statements, group in work for sql in statements
+        )
+        stats["full_rebuild_bytes"] = estimate_bytes(client, full_build_sql(fact))
+        logging.info(f"{fact.name} dry run: {stats}")
+        return stats
+
+    for statements, group in work:
+        if group is not None and len(statements) > 1:
+            # One script, so a partition is never left deleted but not yet re-inserted
+            sql = "BEGIN TRANSACTION;\n" + ";\n".join(statements) + ";\nCOMMIT TRANSACTION;"
+        else:
+            sql = ";\n".join(statements)
+        client.query(sql, job_config=_job_config(partitions=group, since=since)).result()
+    session.invalidate(target)
+    checkpoints.advance_watermark(pipeline, high_water)
+    logging.info(f"Materialized {fact.name}: {stats}")
+    return stats
+
+
+def materialize_facts(names=None, client=None, checkpoints=None, **options):
+    """``materialize`` every selected fact (all registered facts by default); returns their stats."""
+    return [
+        materialize(FACTS[name], client=client, checkpoints=checkpoints, **options)
+        for name in (names or FACTS)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("facts", nargs="*", help="facts to materialize (default: all)")
+    parser.add_argument("--dry-run", action="store_true", help="estimate bytes processed, change nothing")
+    parser.add_argument("--full", action="store_true", help="rebuild from scratch instead of changed partitions")
+    parser.add_argument("--mode", choices=["replace", "merge"], default=None)
+    args = parser.parse_args(argv)
+    return materialize_facts(args.facts or None, full=args.full, dry_run=args.dry_run, mode=args.mode)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -32,9 +32,41 @@ SELECT DISTINCT
     patient_id
 FROM `fhir-synthea-data.fhir_curated_sample.encounter`;
 
+-- Code dimension appended incrementally by the Python ETL (code_dictionary.py): one row per
+-- (domain, code_key) the first time a run sees it, so it is never rebuilt with SELECT DISTINCT.
+-- code_key is a stable hash of (system, code), the same value as the curated *_key columns.
+CREATE TABLE IF NOT EXISTS `fhir-synthea-data.fhir_warehouse.dim_code` (
+    domain STRING,
+    code_key INT64,
+    system STRING,
+    code STRING,
+    display STRING,
+    first_seen TIMESTAMP
+)
+PARTITION BY DATE(first_seen)
+CLUSTER BY domain, code_key;
+
+-- Per-domain views, joined on the curated key columns (eob_items.product_key, ...)
+CREATE OR REPLACE VIEW `fhir-synthea-data.fhir_warehouse.dim_eob_product` AS
+SELECT code_key AS product_key, system AS product_system, code AS product_code, display AS product_display
+FROM `fhir-synthea-data.fhir_warehouse.dim_code`
+WHERE domain = 'item_product';
+
+CREATE OR REPLACE VIEW `fhir-synthea-data.fhir_warehouse.dim_coverage_type` AS
+SELECT code_key AS type_key, system AS type_system, code AS type_code, display AS type_display
+FROM `fhir-synthea-data.fhir_warehouse.dim_code`
+WHERE domain = 'coverage_type';
+
+CREATE OR REPLACE VIEW `fhir-synthea-data.fhir_warehouse.dim_observation_code` AS
+SELECT code_key AS obs_code_key, system, code AS obs_code, display AS obs_code_text
+FROM `fhir-synthea-data.fhir_warehouse.dim_code`
+WHERE domain = 'observation_code';
+
 
 --Creating fact table from curated normalized tables
 --Creating fact table from curated normalized tables
+-- (fact_eob_item, from the ETL's eob_items, is kept up to date partition by partition by
+-- Python_ETL/warehouse_materializer.py instead of a full CREATE OR REPLACE)
 CREATE OR REPLACE TABLE `fhir-synthea-data.fhir_warehouse.fact_claim_item` AS
 SELECT
     c.claim_id,